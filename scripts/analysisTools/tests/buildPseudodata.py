@@ -7,6 +7,7 @@ import argparse
 
 import narf
 import wremnants
+wremnants.headers.declare_registered() # for the ROOT.wrem functions used below
 import hist
 import lz4.frame, pickle
 from wremnants import histselections as sel
@@ -16,6 +16,7 @@ sys.path.append(os.getcwd() + "/plotUtils/")
 from utility import *
 
 import wremnants
+wremnants.headers.declare_registered() # for the ROOT.wrem functions used below
 
 def effStatVariations(outdir, covHisto, parHisto, nbins_pt, ptmin, ptmax,
                       smoothFunction="pol3", suffix=None,
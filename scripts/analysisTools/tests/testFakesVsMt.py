@@ -15,6 +15,7 @@ import argparse
 import narf
 import narf.fitutils
 import wremnants
+wremnants.headers.declare_registered() # for the ROOT.wrem functions used below
 import hist
 import lz4.frame, pickle
 from wremnants.datasets.datagroups import Datagroups
@@ -20,6 +20,7 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 from copy import *
 from scripts.analysisTools.plotUtils.utility import *
 import wremnants
+wremnants.headers.declare_registered() # for the ROOT.wrem functions used below
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -23,6 +23,7 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from copy import *
 import wremnants
+wremnants.headers.declare_registered() # for the ROOT.wrem functions used below
 
 from scripts.analysisTools.plotUtils.utility import *
 
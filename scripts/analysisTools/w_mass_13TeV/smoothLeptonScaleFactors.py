@@ -53,6 +53,7 @@ from scripts.analysisTools.plotUtils.utility import *
 from scripts.analysisTools.w_mass_13TeV.run2Dsmoothing import makeAntiSFfromSFandEffi
 
 import wremnants
+wremnants.headers.declare_registered() # for the ROOT.wrem functions used below
 
 # for a quick summary at the end
 badFitsID_data = {}
@@ -2,8 +2,9 @@
 from wremnants import CardTool,combine_helpers, combine_theory_helper, combine_theoryAgnostic_helper, HDF5Writer, syst_tools, theory_corrections
 from wremnants.syst_tools import massWeightNames
 from wremnants.datasets.datagroups import Datagroups
+from wremnants.datasets.proxy_cache import proxy_cache
 
-from utilities import common, logging, boostHistHelpers as hh
+from utilities import common, logging, boostHistHelpers as hh, h5pyutils
 from utilities.io_tools import input_tools
 import argparse
 import hist
@@ -22,6 +23,11 @@ def make_parser(parser=None):
     parser.add_argument("--noColorLogger", action="store_true", help="Do not use logging with colors")
     parser.add_argument("--hdf5", action="store_true", help="Write out datacard in hdf5")
     parser.add_argument("--sparse", action="store_true", help="Write out datacard in sparse mode (only for when using hdf5)")
+    parser.add_argument("--compression", type=str, default="gzip", choices=h5pyutils.compression_codecs, help="Compression codec for the tensors (only for when using hdf5), the blosc/zstd/lz4 codecs require hdf5plugin when reading the file")
+    parser.add_argument("--logkCache", type=str, default=None, help="Directory of an on-disk cache for the logk arrays of shape systematics, only changed systematics are recomputed (only for when using hdf5)")
+    parser.add_argument("--histCacheBudget", type=float, default=None, help="Memory budget in GB for the pickled histograms loaded from the input file and kept for reuse, the least recently used ones are released when it is exceeded (negative for no limit, default half of the physical memory). The summed group histograms and the output arrays are not included")
+    parser.add_argument("--prefetchWorkers", type=int, default=0, help="Number of threads reading and decompressing the histograms of the next group members ahead of their use (0 to read sequentially)")
+    parser.add_argument("-j", "--nProcesses", type=int, default=1, help="Number of parallel processes to compute the shape systematics (only for when using hdf5)")
     parser.add_argument("--excludeProcGroups", type=str, nargs="*", help="Don't run over processes belonging to these groups (only accepts exact group names)", default=["QCD"])
     parser.add_argument("--filterProcGroups", type=str, nargs="*", help="Only run over processes belonging to these groups", default=[])
     parser.add_argument("-x", "--excludeNuisances", type=str, default="", help="Regular expression to exclude some systematics from the datacard")
@@ -122,6 +128,7 @@ def setup(args, inputFile, fitvar, xnorm=False):
     logger.debug(f"Excluding these groups of processes: {args.excludeProcGroups}")
 
     datagroups = Datagroups(inputFile, excludeGroups=excludeGroup, filterGroups=filterGroup, applySelection= not xnorm and not args.ABCD, simultaneousABCD=args.ABCD)
+    datagroups.setPrefetch(args.prefetchWorkers)
 
     if not xnorm and (args.axlim or args.rebin or args.absval):
         datagroups.set_rebin_action(fitvar, args.axlim, args.rebin, args.absval, args.rebinBeforeSelection)
@@ -377,9 +384,7 @@ def setup(args, inputFile, fitvar, xnorm=False):
                     mirror=False,
                     systAxes=["massShift", f"{args.fitMassDecorr}Diff"],
                     passToFakes=passSystToFakes,
-                    actionRequiresNomi=True,
-                    action=syst_tools.decorrelateByAxis, 
-                    actionArgs=dict(axisToDecorrName=args.fitMassDecorr, decorrEdges=[], newDecorrAxisName=f"{args.fitMassDecorr}Diff")
+                    decorrelation=dict(axisToDecorrName=args.fitMassDecorr, decorrEdges=[], newDecorrAxisName=f"{args.fitMassDecorr}Diff")
                 )
 
         if args.fitMassDiff:
@@ -571,14 +576,12 @@ def setup(args, inputFile, fitvar, xnorm=False):
                                    baseName="ZmuonVeto_",
                                    systAxes=["decorrEta"],
                                    labelsByAxis=["decorrEta"],
-                                   actionRequiresNomi=True,
-                                   action=syst_tools.decorrelateByAxis,
-                                   actionArgs=dict(axisToDecorrName=decorrVarAxis,
-                                                   # empty array automatically uses all edges of the axis named "axisToDecorrName"
-                                                   # decorrEdges=[round(-2.4+i*0.1,1) for i in range(49)],
-                                                   decorrEdges=[], 
-                                                   newDecorrAxisName="decorrEta"
-                                                   )
+                                   decorrelation=dict(axisToDecorrName=decorrVarAxis,
+                                                      # empty array automatically uses all edges of the axis named "axisToDecorrName"
+                                                      # decorrEdges=[round(-2.4+i*0.1,1) for i in range(49)],
+                                                      decorrEdges=[], 
+                                                      newDecorrAxisName="decorrEta"
+                                                      )
                                    )
             # add also the fully inclusive systematic uncertainty, which is not kept in the previous step
             cardTool.addSystematic("ZmuonVeto",
@@ -844,6 +847,9 @@ if __name__ == "__main__":
     
     logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
+    if args.histCacheBudget is not None:
+        proxy_cache.set_budget(int(args.histCacheBudget*1024**3) if args.histCacheBudget >= 0 else None)
+
     if args.poiAsNoi and args.theoryAgnostic == args.unfolding:
         raise ValueError("Option --poiAsNoi requires either --theoryAgnostic or --unfolding but not both")    
     if args.noHist and args.noStatUncFakes:
@@ -864,7 +870,7 @@ if __name__ == "__main__":
             args.doStatOnly = True
     
     if args.hdf5: 
-        writer = HDF5Writer.HDF5Writer(sparse=args.sparse)
+        writer = HDF5Writer.HDF5Writer(sparse=args.sparse, nProcesses=args.nProcesses, logkCache=args.logkCache, compression=args.compression)
 
         # loop over all files
         outnames = []
@@ -886,6 +892,7 @@ if __name__ == "__main__":
             outfile, outfolder = f"{args.outfolder}/Combination{'_statOnly' if args.doStatOnly else ''}_{args.postfix}/", "Combination"
         logger.info(f"Writing HDF5 output to {outfile}")
         writer.write(args, outfile, outfolder)
+        logger.info(proxy_cache.summary())
     else:
         if len(args.inputFile) > 1:
             raise IOError(f"Multiple input files only supported within --hdf5 mode")
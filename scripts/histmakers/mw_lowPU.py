@@ -1,6 +1,5 @@
 import argparse
 from utilities import common, logging, differential
-from utilities.io_tools import output_tools
 
 parser,initargs = common.common_parser()
 parser.add_argument("--lumiUncertainty", type=float, help="Uncertainty for luminosity in excess to 1 (e.g. 1.017 means 1.7\%)", default=1.017)
@@ -10,11 +9,12 @@ parser.add_argument("--flavor", type=str, choices=["e", "mu"], help="Flavor (e o
 parser = common.set_parser_default(parser, "genVars", ["ptVGen"])
 args = parser.parse_args()
 
-import narf
+from utilities.io_tools import output_tools
 import wremnants
 from wremnants import theory_tools, syst_tools, theory_corrections, muon_selections, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
-from wremnants.datasets.dataset_tools import getDatasets
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, build_and_run
+from wremnants.incremental_tools import IncrementalOutput
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
 import math
 import hist
 import ROOT
@@ -30,7 +30,7 @@ else:
     sigProcs = ["Wminusenu", "Wplusenu"]
     base_group = "Wenu"
 
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                         filt=args.filterProcs,
                         excl=list(set(args.excludeProcs + ["singlemuon"] if flavor=="e" else ["singleelectron"])),
                         extended = "msht20an3lo" not in args.pdfs,
@@ -99,7 +99,7 @@ cols_mT = ["lep_pt", "lep_eta", "lep_charge", "transverseMass",  "passIso"]
 axis_cutFlow = hist.axis.Regular(1, 0, 1, name = "cutFlow")
 
 theory_corrs = [*args.theoryCorr, *args.ewTheoryCorr]
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], theory_corrs)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], theory_corrs, cache_dir=args.theoryCorrCacheDir)
 
 # recoil initialization
 args.noRecoil = True
@@ -470,10 +470,16 @@ def build_graph_cutFlow(df, dataset):
     return results, weightsum
 
 
-resultdict = narf.build_and_run(datasets, build_graph)
+outfile = f"mw_lowPU_{flavor}.hdf5"
+incremental = IncrementalOutput(outfile, args, datasets, groups_to_aggregate, scale_to_data=not args.noScaleToData and args.shard is None) if args.incremental else None
+
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, incremental=incremental, entry_cache=makeEntryCountCache(args))
+
+if incremental is not None:
+    incremental.add_reused(resultdict)
 
-if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, groups_to_aggregate)
+if not args.noScaleToData and args.shard is None:
+    scales = scale_to_data(resultdict)
+    aggregate_groups(datasets, resultdict, groups_to_aggregate, scales)
 
-output_tools.write_analysis_output(resultdict, f"mw_lowPU_{flavor}.hdf5", args)
+output_tools.write_analysis_output(resultdict, outfile, args, incremental=incremental)
@@ -1,27 +1,9 @@
 import argparse
 from utilities import common, rdf_tools, logging, differential
-from utilities.io_tools import output_tools
 from utilities.common import background_MCprocs as bkgMCprocs
-from wremnants.datasets.datagroups import Datagroups
 
 parser,initargs = common.common_parser(True)
 
-import ROOT
-import narf
-import wremnants
-from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools, theoryAgnostic_tools, helicity_utils
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
-from wremnants.datasets.dataset_tools import getDatasets
-from wremnants.helicity_utils_polvar import makehelicityWeightHelper_polvar 
-import hist
-import lz4.frame
-import math
-import time
-from utilities import boostHistHelpers as hh
-import pathlib
-import os
-import numpy as np
-
 data_dir = common.data_dir
 parser.add_argument("--lumiUncertainty", type=float, help="Uncertainty for luminosity in excess to 1 (e.g. 1.012 means 1.2\%)", default=1.012)
 parser.add_argument("--noGenMatchMC", action='store_true', help="Don't use gen match filter for prompt muons with MC samples (note: QCD MC never has it anyway)")
@@ -45,6 +27,25 @@ parser.add_argument("--theoryAgnosticSplitOOA", action='store_true', help="Defin
 
 args = parser.parse_args()
 
+from utilities.io_tools import output_tools
+from wremnants.datasets.datagroups import Datagroups
+import ROOT
+import wremnants
+from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools, theoryAgnostic_tools, helicity_utils
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, build_and_run
+from wremnants.incremental_tools import IncrementalOutput
+from wremnants.skim_tools import make_skimmer
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
+from wremnants.helicity_utils_polvar import makehelicityWeightHelper_polvar 
+import hist
+import lz4.frame
+import math
+import time
+from utilities import boostHistHelpers as hh
+import pathlib
+import os
+import numpy as np
+
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
 if args.poiAsNoi and not (args.theoryAgnostic or args.unfolding):
@@ -79,13 +80,18 @@ thisAnalysis = ROOT.wrem.AnalysisType.Wmass
 
 era = args.era
 
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                        filt=args.filterProcs,
                        excl=args.excludeProcs, 
                        nanoVersion="v9", base_path=args.dataPath, oneMCfileEveryN=args.oneMCfileEveryN,
                        extended = "msht20an3lo" not in args.pdfs,
                        era=era)
 
+if args.skimDir and (args.unfolding or args.theoryAgnostic):
+    # histograms are filled before the muon selection in these modes, they can not be made from skims
+    raise ValueError("Option --skimDir can not be used with --unfolding or --theoryAgnostic")
+skimmer = make_skimmer(args)
+
 # transverse boson mass cut
 mtw_min = args.mtCut
 
@@ -203,7 +209,7 @@ bias_helper = muon_calibration.make_muon_bias_helpers(args) if args.biasCalibrat
 theory_corrs = [*args.theoryCorr, *args.ewTheoryCorr]
 procsWithTheoryCorr = [d.name for d in datasets if d.name in common.vprocs]
 if len(procsWithTheoryCorr):
-    corr_helpers = theory_corrections.load_corr_helpers(procsWithTheoryCorr, theory_corrs)
+    corr_helpers = theory_corrections.load_corr_helpers(procsWithTheoryCorr, theory_corrs, cache_dir=args.theoryCorrCacheDir)
 else:
     corr_helpers = {}
     
@@ -327,6 +333,9 @@ def build_graph(df, dataset):
     df = muon_selections.select_veto_muons(df, nMuons=1)
     df = muon_selections.select_good_muons(df, template_minpt, template_maxpt, dataset.group, nMuons=1, use_trackerMuons=args.trackerMuons, use_isolation=False)
 
+    if skimmer is not None:
+        df = skimmer.snapshot(df, dataset)
+
     # the corrected RECO muon kinematics, which is intended to be used as the nominal
     df = muon_calibration.define_corrected_reco_muon_kinematics(df)
 
@@ -622,7 +631,10 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+outfile = f"{os.path.basename(__file__).replace('py', 'hdf5')}"
+incremental = IncrementalOutput(outfile, args, datasets, groups_to_aggregate, scale_to_data=not args.noScaleToData and args.shard is None) if args.incremental else None
+
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, skimmer=skimmer, incremental=incremental, entry_cache=makeEntryCountCache(args))
 if not args.onlyMainHistograms and args.muonScaleVariation == 'smearingWeightsGaus' and not (args.theoryAgnostic and not args.poiAsNoi):
     logger.debug("Apply smearingWeights")
     muon_calibration.transport_smearing_weights_to_reco(
@@ -633,8 +645,11 @@ if not args.onlyMainHistograms and args.muonScaleVariation == 'smearingWeightsGa
 if args.validationHists:
     muon_validation.muon_scale_variation_from_manual_shift(resultdict)
 
-if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, groups_to_aggregate)
+if incremental is not None:
+    incremental.add_reused(resultdict)
+
+if not args.noScaleToData and args.shard is None:
+    scales = scale_to_data(resultdict)
+    aggregate_groups(datasets, resultdict, groups_to_aggregate, scales)
 
-output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
+output_tools.write_analysis_output(resultdict, outfile, args, incremental=incremental)
@@ -1,17 +1,22 @@
 import argparse
 from utilities import common, rdf_tools, logging, differential
-from utilities.io_tools import output_tools
 from utilities.common import background_MCprocs as bkgMCprocs
-from wremnants.datasets.datagroups import Datagroups
 
 parser,initargs = common.common_parser(True)
 
+data_dir = common.data_dir
+parser.add_argument("--oneMCfileEveryN", type=int, default=None, help="Use 1 MC file every N, where N is given by this option. Mainly for tests")
+parser.add_argument("--vetoGenPartPt", type=float, default=0.0, help="Minimum pT for the postFSR gen muon when defining the variation of the veto efficiency")
+args = parser.parse_args()
+
+from utilities.io_tools import output_tools
+from wremnants.datasets.datagroups import Datagroups
 import ROOT
-import narf
 import wremnants
 from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools, theoryAgnostic_tools, helicity_utils
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
-from wremnants.datasets.dataset_tools import getDatasets
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, build_and_run
+from wremnants.incremental_tools import IncrementalOutput
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
 import hist
 import lz4.frame
 import math
@@ -21,10 +26,6 @@ import pathlib
 import os
 import numpy as np
 
-data_dir = common.data_dir
-parser.add_argument("--oneMCfileEveryN", type=int, default=None, help="Use 1 MC file every N, where N is given by this option. Mainly for tests")
-parser.add_argument("--vetoGenPartPt", type=float, default=0.0, help="Minimum pT for the postFSR gen muon when defining the variation of the veto efficiency")
-args = parser.parse_args()
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
 args = parser.parse_args()
@@ -32,7 +33,7 @@ args = parser.parse_args()
 thisAnalysis = ROOT.wrem.AnalysisType.Wmass
 
 era = args.era
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                        filt=args.filterProcs,
                        excl=args.excludeProcs, 
                        nanoVersion="v9", base_path=args.dataPath, oneMCfileEveryN=args.oneMCfileEveryN,
@@ -86,7 +87,7 @@ bias_helper = muon_calibration.make_muon_bias_helpers(args) if args.biasCalibrat
 theory_corrs = [*args.theoryCorr, *args.ewTheoryCorr]
 procsWithTheoryCorr = [d.name for d in datasets if d.name in common.vprocs]
 if len(procsWithTheoryCorr):
-    corr_helpers = theory_corrections.load_corr_helpers(procsWithTheoryCorr, [*args.theoryCorr, *args.ewTheoryCorr], allowMissingTheoryCorr=args.allowMissingTheoryCorr)
+    corr_helpers = theory_corrections.load_corr_helpers(procsWithTheoryCorr, [*args.theoryCorr, *args.ewTheoryCorr], allowMissingTheoryCorr=args.allowMissingTheoryCorr, cache_dir=args.theoryCorrCacheDir)
 else:
     corr_helpers = {}
 
@@ -153,10 +154,16 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+outfile = f"{os.path.basename(__file__).replace('py', 'hdf5')}"
+incremental = IncrementalOutput(outfile, args, datasets, groups_to_aggregate, scale_to_data=not args.noScaleToData and args.shard is None) if args.incremental else None
+
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, incremental=incremental, entry_cache=makeEntryCountCache(args))
+
+if incremental is not None:
+    incremental.add_reused(resultdict)
 
-if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, groups_to_aggregate)
+if not args.noScaleToData and args.shard is None:
+    scales = scale_to_data(resultdict)
+    aggregate_groups(datasets, resultdict, groups_to_aggregate, scales)
 
-output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
+output_tools.write_analysis_output(resultdict, outfile, args, incremental=incremental)
@@ -1,21 +1,7 @@
 from utilities import boostHistHelpers as hh, common, logging, differential
-from utilities.io_tools import output_tools
 
 parser,initargs = common.common_parser(True)
 
-import ROOT
-import narf
-import wremnants
-from wremnants import theory_tools,syst_tools,theory_corrections, muon_validation, muon_calibration, muon_selections, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
-from wremnants.datasets.dataset_tools import getDatasets
-from wremnants.datasets.datagroups import Datagroups
-import hist
-import lz4.frame
-import math
-import time
-import os
-
 parser.add_argument("--csVarsHist", action='store_true', help="Add CS variables to dilepton hist")
 parser.add_argument("--axes", type=str, nargs="*", default=["mll", "ptll"], help="")
 parser.add_argument("--finePtBinning", action='store_true', help="Use fine binning for ptll")
@@ -30,11 +16,25 @@ parser = common.set_parser_default(parser, "ewTheoryCorr", ["virtual_ew", "pythi
 
 args = parser.parse_args()
 
+from utilities.io_tools import output_tools
+import ROOT
+import wremnants
+from wremnants import theory_tools,syst_tools,theory_corrections, muon_validation, muon_calibration, muon_selections, unfolding_tools
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, build_and_run
+from wremnants.incremental_tools import IncrementalOutput
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
+from wremnants.datasets.datagroups import Datagroups
+import hist
+import lz4.frame
+import math
+import time
+import os
+
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
 thisAnalysis = ROOT.wrem.AnalysisType.Dilepton if args.useDileptonTriggerSelection else ROOT.wrem.AnalysisType.Wlike
 era = args.era
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                        filt=args.filterProcs,
                        excl=args.excludeProcs, 
                        nanoVersion="v9",
@@ -147,7 +147,7 @@ smearing_helper, smearing_uncertainty_helper = (None, None) if args.noSmearing e
 bias_helper = muon_calibration.make_muon_bias_helpers(args) 
 
 theory_corrs = [*args.theoryCorr, *args.ewTheoryCorr]
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], theory_corrs)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], theory_corrs, cache_dir=args.theoryCorrCacheDir)
 
 def build_graph(df, dataset):
     logger.info(f"build graph for dataset: {dataset.name}")
@@ -484,10 +484,16 @@ def build_graph(df, dataset):
     return results, weightsum
 
 logger.debug(f"Datasets are {[d.name for d in datasets]}")
-resultdict = narf.build_and_run(datasets, build_graph)
+outfile = f"{os.path.basename(__file__).replace('py', 'hdf5')}"
+incremental = IncrementalOutput(outfile, args, datasets, args.aggregateGroups, scale_to_data=not args.noScaleToData and args.shard is None) if args.incremental else None
+
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, incremental=incremental, entry_cache=makeEntryCountCache(args))
+
+if incremental is not None:
+    incremental.add_reused(resultdict)
 
-if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, args.aggregateGroups)
+if not args.noScaleToData and args.shard is None:
+    scales = scale_to_data(resultdict)
+    aggregate_groups(datasets, resultdict, args.aggregateGroups, scales)
 
-output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
+output_tools.write_analysis_output(resultdict, outfile, args, incremental=incremental)
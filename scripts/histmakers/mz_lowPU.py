@@ -1,6 +1,5 @@
 import argparse
 from utilities import common, logging, differential
-from utilities.io_tools import output_tools
 
 parser,initargs = common.common_parser()
 parser.add_argument("--flavor", type=str, choices=["ee", "mumu"], help="Flavor (ee or mumu)", default="mumu")
@@ -12,11 +11,12 @@ parser = common.set_parser_default(parser, "aggregateGroups", ["Diboson", "Top",
 args = parser.parse_args()
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
-import narf
+from utilities.io_tools import output_tools
 import wremnants
 from wremnants import theory_tools, syst_tools, theory_corrections, muon_selections, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
-from wremnants.datasets.dataset_tools import getDatasets
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, build_and_run
+from wremnants.incremental_tools import IncrementalOutput
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
 import hist
 import wremnants.lowpu as lowpu
 
@@ -30,7 +30,7 @@ base_group = sigProcs[0]
 mass_min = 60
 mass_max = 120
 
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                         filt=args.filterProcs,
                         excl=list(set(args.excludeProcs + ["singlemuon"] if flavor=="ee" else ["singleelectron"])),
                         extended = "msht20an3lo" not in args.pdfs,
@@ -85,7 +85,7 @@ axes_mT = [axis_mt]
 cols_mT = ["transverseMass"]
 
 theory_corrs = [*args.theoryCorr, *args.ewTheoryCorr]
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], theory_corrs)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs_lowpu], theory_corrs, cache_dir=args.theoryCorrCacheDir)
 
 # recoil initialization
 args.noRecoil = True
@@ -348,10 +348,16 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+outfile = f"mz_lowPU_{flavor}.hdf5"
+incremental = IncrementalOutput(outfile, args, datasets, args.aggregateGroups, scale_to_data=not args.noScaleToData and args.shard is None) if args.incremental else None
+
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, incremental=incremental, entry_cache=makeEntryCountCache(args))
+
+if incremental is not None:
+    incremental.add_reused(resultdict)
 
-if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, args.aggregateGroups)
+if not args.noScaleToData and args.shard is None:
+    scales = scale_to_data(resultdict)
+    aggregate_groups(datasets, resultdict, args.aggregateGroups, scales)
 
-output_tools.write_analysis_output(resultdict, f"mz_lowPU_{flavor}.hdf5", args)
+output_tools.write_analysis_output(resultdict, outfile, args, incremental=incremental)
@@ -1,14 +1,25 @@
 from utilities import boostHistHelpers as hh, common, logging, differential
-from utilities.io_tools import output_tools
 
 parser,initargs = common.common_parser(True)
 
+parser.add_argument("--mtCut", type=int, default=45, help="Value for the transverse mass cut in the event selection") # 40 for Wmass, thus be 45 here (roughly half the boson mass)
+
+parser = common.set_parser_default(parser, "genVars", ["qGen", "ptGen", "absEtaGen"])
+parser = common.set_parser_default(parser, "genBins", [18, 0])
+parser = common.set_parser_default(parser, "pt", [34, 26, 60])
+parser = common.set_parser_default(parser, "aggregateGroups", ["Diboson", "Top", "Wtaunu", "Wmunu"])
+parser = common.set_parser_default(parser, "ewTheoryCorr", ["virtual_ew_wlike", "pythiaew_ISR", "horaceqedew_FSR", "horacelophotosmecoffew_FSR",])
+
+args = parser.parse_args()
+
+from utilities.io_tools import output_tools
 import ROOT
-import narf
 import wremnants
 from wremnants import theory_tools,syst_tools,theory_corrections, muon_validation, muon_calibration, muon_selections, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
-from wremnants.datasets.dataset_tools import getDatasets
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, build_and_run
+from wremnants.incremental_tools import IncrementalOutput
+from wremnants.skim_tools import make_skimmer
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
 import hist
 import lz4.frame
 import math
@@ -16,15 +27,6 @@ import time
 import os
 import numpy as np
 
-parser.add_argument("--mtCut", type=int, default=45, help="Value for the transverse mass cut in the event selection") # 40 for Wmass, thus be 45 here (roughly half the boson mass)
-
-parser = common.set_parser_default(parser, "genVars", ["qGen", "ptGen", "absEtaGen"])
-parser = common.set_parser_default(parser, "genBins", [18, 0])
-parser = common.set_parser_default(parser, "pt", [34, 26, 60])
-parser = common.set_parser_default(parser, "aggregateGroups", ["Diboson", "Top", "Wtaunu", "Wmunu"])
-parser = common.set_parser_default(parser, "ewTheoryCorr", ["virtual_ew_wlike", "pythiaew_ISR", "horaceqedew_FSR", "horacelophotosmecoffew_FSR",])
-
-args = parser.parse_args()
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
 if args.unfolding:
@@ -34,13 +36,18 @@ if args.unfolding:
 thisAnalysis = ROOT.wrem.AnalysisType.Wlike
 era = args.era
 
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                        filt=args.filterProcs,
                        excl=args.excludeProcs, 
                        nanoVersion="v9", base_path=args.dataPath,
                        extended = "msht20an3lo" not in args.pdfs,
                        era=era)
 
+if args.skimDir and (args.unfolding):
+    # histograms are filled before the muon selection in these modes, they can not be made from skims
+    raise ValueError("Option --skimDir can not be used with --unfolding")
+skimmer = make_skimmer(args)
+
 # dilepton invariant mass cuts
 mass_min = 60
 mass_max = 120
@@ -113,7 +120,7 @@ smearing_helper, smearing_uncertainty_helper = (None, None) if args.noSmearing e
 bias_helper = muon_calibration.make_muon_bias_helpers(args) if args.biasCalibration else None
 
 theory_corrs = [*args.theoryCorr, *args.ewTheoryCorr]
-corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], theory_corrs)
+corr_helpers = theory_corrections.load_corr_helpers([d.name for d in datasets if d.name in common.vprocs], theory_corrs, cache_dir=args.theoryCorrCacheDir)
 
 # recoil initialization
 if not args.noRecoil:
@@ -170,6 +177,9 @@ def build_graph(df, dataset):
     df = muon_selections.select_veto_muons(df, nMuons=2)
     df = muon_selections.select_good_muons(df, template_minpt, template_maxpt, dataset.group, nMuons=2, use_trackerMuons=args.trackerMuons, use_isolation=True, isoDefinition=args.isolationDefinition)
 
+    if skimmer is not None:
+        df = skimmer.snapshot(df, dataset)
+
     df = muon_selections.define_trigger_muons(df)
 
     df = muon_selections.select_z_candidate(df, mass_min, mass_max)
@@ -402,10 +412,16 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+outfile = f"{os.path.basename(__file__).replace('py', 'hdf5')}"
+incremental = IncrementalOutput(outfile, args, datasets, args.aggregateGroups, scale_to_data=not args.noScaleToData and args.shard is None) if args.incremental else None
+
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, skimmer=skimmer, incremental=incremental, entry_cache=makeEntryCountCache(args))
+
+if incremental is not None:
+    incremental.add_reused(resultdict)
 
-if not args.noScaleToData:
-    scale_to_data(resultdict)
-    aggregate_groups(datasets, resultdict, args.aggregateGroups)
+if not args.noScaleToData and args.shard is None:
+    scales = scale_to_data(resultdict)
+    aggregate_groups(datasets, resultdict, args.aggregateGroups, scales)
 
-output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
+output_tools.write_analysis_output(resultdict, outfile, args, incremental=incremental)
@@ -1,19 +1,7 @@
 from utilities import boostHistHelpers as hh, common, logging
-from utilities.io_tools import output_tools
 
 parser,initargs = common.common_parser()
 
-import narf
-import wremnants
-from wremnants import theory_tools,syst_tools,theory_corrections
-from wremnants.datasets.dataset_tools import getDatasets
-import hist
-import math
-import os
-import numpy as np
-from utilities.differential import get_theoryAgnostic_axes
-
-
 parser.add_argument("--skipAngularCoeffs", action='store_true', help="Skip the conversion of helicity moments to angular coeff fractions")
 parser.add_argument("--propagatePDFstoHelicity", action='store_true', help="Propagate PDF uncertainties to helicity moments")
 parser.add_argument("--useTheoryAgnosticBinning", action='store_true', help="Use theory agnostic binning (coarser) to produce the gen results")
@@ -31,9 +19,20 @@ parser = common.set_parser_default(parser, "ewTheoryCorr", [])
 
 args = parser.parse_args()
 
+from utilities.io_tools import output_tools
+import wremnants
+from wremnants import theory_tools,syst_tools,theory_corrections
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
+from wremnants.histmaker_tools import build_and_run
+import hist
+import math
+import os
+import numpy as np
+from utilities.differential import get_theoryAgnostic_axes
+
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                         filt=args.filterProcs,
                         excl=args.excludeProcs,
                         extended = "msht20an3lo" not in args.pdfs,
@@ -94,7 +93,7 @@ axis_l_eta_gen = hist.axis.Regular(48, -2.4, 2.4, name = "eta")
 axis_l_pt_gen = hist.axis.Regular(29, 26., 55., name = "pt")
 
 theory_corrs = [*args.theoryCorr, *args.ewTheoryCorr]
-corr_helpers = theory_corrections.load_corr_helpers(common.vprocs, theory_corrs)
+corr_helpers = theory_corrections.load_corr_helpers(common.vprocs, theory_corrs, cache_dir=args.theoryCorrCacheDir)
 
 def build_graph(df, dataset):
     logger.info("build graph")
@@ -288,7 +287,7 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, entry_cache=makeEntryCountCache(args))
 output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
 
 logger.info("computing angular coefficients")
@@ -1,14 +1,17 @@
 import argparse
 from utilities import common, rdf_tools, logging, differential
-from utilities.io_tools import output_tools
 
 parser,initargs = common.common_parser(True)
 
-import narf
+parser.add_argument("--testHelpers", action="store_true", help="Test the smearing weights helper")
+
+args = parser.parse_args()
+
+from utilities.io_tools import output_tools
 import wremnants
 from wremnants import theory_tools,syst_tools,theory_corrections, muon_calibration, muon_selections, muon_validation, unfolding_tools
-from wremnants.histmaker_tools import scale_to_data, aggregate_groups
-from wremnants.datasets.dataset_tools import getDatasets
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups, build_and_run
+from wremnants.datasets.dataset_tools import getDatasets, makeFileListCache, makeEntryCountCache
 import hist
 import lz4.frame
 import math
@@ -19,14 +22,9 @@ import os
 import numpy as np
 import ROOT
 
-parser.add_argument("--testHelpers", action="store_true", help="Test the smearing weights helper")
-
-
-args = parser.parse_args()
-
 logger = logging.setup_logger(__file__, args.verbose, args.noColorLogger)
 
-datasets = getDatasets(maxFiles=args.maxFiles,
+datasets = getDatasets(maxFiles=args.maxFiles, shard=args.shard, filelist_cache=makeFileListCache(args),
                         filt=args.filterProcs,
                         excl=args.excludeProcs,
                         extended = "msht20an3lo" not in args.pdfs,
@@ -179,7 +177,7 @@ def build_graph(df, dataset):
 
     return results, weightsum
 
-resultdict = narf.build_and_run(datasets, build_graph)
+resultdict = build_and_run(datasets, build_graph, memoryBudget=args.memoryBudget, profileColumns=args.profileColumns, entry_cache=makeEntryCountCache(args))
 
 output_tools.write_analysis_output(resultdict, f"{os.path.basename(__file__).replace('py', 'hdf5')}", args)
 
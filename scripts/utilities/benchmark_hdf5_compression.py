@@ -0,0 +1,69 @@
+import argparse
+import os
+import tempfile
+import time
+import h5py
+import numpy as np
+
+from utilities import logging
+from utilities.h5pyutils import writeFlatInChunks, readFlatInChunks, writeSparse, compression_codecs
+
+parser = argparse.ArgumentParser(description="Benchmark the compression codecs for the fit input tensors on synthetic logk tensors")
+parser.add_argument("--nbins", type=int, default=2880, help="Number of bins of the synthetic tensor")
+parser.add_argument("--nproc", type=int, default=10, help="Number of processes of the synthetic tensor")
+parser.add_argument("--nsyst", type=int, default=1000, help="Number of systematics of the synthetic tensor")
+parser.add_argument("--fraction", type=float, default=0.1, help="Fraction of non-zero entries in the synthetic tensor")
+parser.add_argument("--sparse", action="store_true", help="Write the tensor in sparse format (as with setupCombine.py --sparse)")
+parser.add_argument("--codecs", type=str, nargs="+", default=compression_codecs, choices=compression_codecs, help="Codecs to benchmark")
+parser.add_argument("--chunkSize", type=int, default=4*1024**2, help="Maximum chunk size in bytes")
+parser.add_argument("--seed", type=int, default=42, help="Seed of the random number generator")
+parser.add_argument("-o", "--outfolder", type=str, default=None, help="Folder for the temporary output files (default is the system temporary folder)")
+parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4], help="Set verbosity level with logging, the larger the more verbose")
+args = parser.parse_args()
+logger = logging.setup_logger(__file__, args.verbose)
+
+rng = np.random.default_rng(args.seed)
+
+shape = (args.nbins, args.nproc, 2, args.nsyst)
+logger.info(f"Generate synthetic logk tensor with shape {shape} and {args.fraction:.1%} non-zero entries")
+logk = np.zeros(shape, dtype="float64")
+mask = rng.random(shape) < args.fraction
+logk[mask] = rng.normal(scale=0.01, size=np.count_nonzero(mask))
+mask = None
+
+if args.sparse:
+    indices = np.transpose(np.nonzero(logk.reshape(args.nbins*args.nproc, 2*args.nsyst))).astype("int32")
+    values = logk[logk != 0.]
+    dense_shape = (args.nbins*args.nproc, 2*args.nsyst)
+    logk = None
+
+results = []
+for codec in args.codecs:
+    with tempfile.TemporaryDirectory(dir=args.outfolder) as tmpdir:
+        outpath = os.path.join(tmpdir, f"benchmark_{codec}.hdf5")
+
+        time0 = time.time()
+        with h5py.File(outpath, mode="w", rdcc_nbytes=args.chunkSize) as f:
+            if args.sparse:
+                nbytes = writeSparse(indices, values, dense_shape, f, "hlogk_sparse", maxChunkBytes=args.chunkSize, compression=codec)
+            else:
+                nbytes = writeFlatInChunks(logk, f, "hlogk", maxChunkBytes=args.chunkSize, compression=codec)
+        time_write = time.time() - time0
+
+        time0 = time.time()
+        with h5py.File(outpath, mode="r", rdcc_nbytes=args.chunkSize) as f:
+            if args.sparse:
+                readFlatInChunks(f["hlogk_sparse/indices"])
+                readFlatInChunks(f["hlogk_sparse/values"])
+            else:
+                readFlatInChunks(f["hlogk"])
+        time_read = time.time() - time0
+
+        size = os.path.getsize(outpath)
+
+    logger.info(f"Codec {codec}: write {time_write:.2f}s, read {time_read:.2f}s, size {size/1024**2:.1f} MB")
+    results.append((codec, time_write, time_read, size, nbytes))
+
+print(f"{'codec':<12} {'write [s]':>10} {'read [s]':>10} {'size [MB]':>10} {'ratio':>8}")
+for codec, time_write, time_read, size, nbytes in results:
+    print(f"{codec:<12} {time_write:>10.2f} {time_read:>10.2f} {size/1024**2:>10.1f} {nbytes/size:>8.2f}")
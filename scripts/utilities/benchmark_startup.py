@@ -0,0 +1,56 @@
+import argparse
+import glob
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from utilities import common, logging
+
+parser = argparse.ArgumentParser(description="Measure the startup time of the histmakers (imports and argument parsing, running them with --help)")
+parser.add_argument("scripts", type=str, nargs="*", default=None, help="Scripts to benchmark (default all histmakers)")
+parser.add_argument("-n", "--repeat", type=int, default=3, help="Number of runs per script")
+parser.add_argument("--args", type=str, nargs="*", default=["--help"], help="Arguments given to the scripts")
+parser.add_argument("--importTime", type=int, default=10, help="Number of slowest imports to print per script (from python -X importtime, 0 to disable)")
+parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4], help="Set verbosity level with logging, the larger the more verbose")
+args = parser.parse_args()
+logger = logging.setup_logger(__file__, args.verbose)
+
+scripts = args.scripts if args.scripts else sorted(glob.glob(f"{common.base_dir}/scripts/histmakers/*.py"))
+env = {**os.environ, "PYTHONPATH" : os.pathsep.join(filter(None, [common.base_dir, os.environ.get("PYTHONPATH")]))}
+
+def run(script, extra=[]):
+    start = time.time()
+    proc = subprocess.run([sys.executable, *extra, script, *args.args], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.time() - start, proc
+
+def slowest_imports(stderr, n):
+    # cumulative time in us of the top level imports reported by -X importtime
+    times = []
+    for line in stderr.splitlines():
+        m = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if m and not m[2]:
+            times.append((int(m[1]), m[3]))
+    return sorted(times, reverse=True)[:n]
+
+rows = []
+for script in scripts:
+    times = []
+    for i in range(args.repeat):
+        elapsed, proc = run(script)
+        if proc.returncode != 0:
+            logger.warning(f"{script} exited with code {proc.returncode}: {proc.stderr.strip().splitlines()[-1:]}")
+        times.append(elapsed)
+    rows.append((os.path.basename(script), min(times), statistics.median(times)))
+    logger.info(f"{rows[-1][0]}: min {rows[-1][1]:.2f} s, median {rows[-1][2]:.2f} s")
+
+    if args.importTime > 0:
+        elapsed, proc = run(script, ["-X", "importtime"])
+        for us, module in slowest_imports(proc.stderr, args.importTime):
+            logger.info(f"    {module:<40} {us/1e6:8.3f} s")
+
+logger.info(f"{'script':<40} {'min [s]':>10} {'median [s]':>10}")
+for name, tmin, tmed in rows:
+    logger.info(f"{name:<40} {tmin:>10.2f} {tmed:>10.2f}")
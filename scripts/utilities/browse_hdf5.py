@@ -14,7 +14,7 @@ import h5py
 import narf
 from narf import ioutils
 import ROOT
-from utilities.io_tools import input_tools
+from utilities.io_tools import input_tools, hist_storage
 
 logger = logging.child_logger(__name__)
 
@@ -69,7 +69,7 @@ if __name__ == "__main__":
                      print(f"{space}{k}")                         
                      if not args.noAxes:
                           histObj = results[p]['output'][k]
-                          if isinstance(histObj, ioutils.H5PickleProxy):
+                          if isinstance(histObj, (ioutils.H5PickleProxy, hist_storage.PickledProxy)):
                                histObj = histObj.get()
                           print(f"{space}  Axes = {histObj.axes.name}")
                           for n in histObj.axes:
@@ -1,54 +1,23 @@
 import argparse
-import h5py
-import copy
+import os
 
 from utilities import logging
-from utilities.io_tools import input_tools
-import narf
-
-import pdb
+from utilities.io_tools import merge_tools
 
 parser = argparse.ArgumentParser()
 parser.add_argument("infiles", type=str, nargs="+", help="Input hdf5 files")
 parser.add_argument("-p", "--postfix", type=str, help="Postfix for output file name", default="merged")
 parser.add_argument("-o", "--outfolder", type=str, default="./", help="Output folder")
+parser.add_argument("--sum", action="store_true", help="Sum the results of processes present in several input files (e.g. from split jobs), histograms, weight_sum, event_count and lumi are added")
+parser.add_argument("--sliceable", action="store_true", help="Write the summed histograms in sliceable format, such that only one histogram is held in memory at a time")
+parser.add_argument("--lowMemory", action="store_true", help="Write each summed histogram as soon as it is complete, such that only one histogram is held in memory at a time (the output can only be read with input_tools.load_results_h5py)")
+parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4], help="Set verbosity level with logging, the larger the more verbose")
 args = parser.parse_args()
-logger = logging.setup_logger(__file__)
-
-
-def recursive_copy(res):
-    if type(res) == dict:
-        return {k: recursive_copy(v) for k, v in res.items()}
-    elif type(res) in [type(None), bool, int, float, str]:
-        return res
-    elif type(res) in [list, ]:
-        return copy.deepcopy(res)
-    elif type(res) == narf.ioutils.H5PickleProxy:
-        # need to copy the underlying object, then make a proxy again for lazy reading of output file
-        return narf.ioutils.H5PickleProxy(res.get()) 
-    else:
-        raise TypeError(f"Unknown type {type(res)} of object {res}")
-
-results = {}
-for i, infile in enumerate(args.infiles):
-    logger.info(f"Now at file {infile}")
-    h5file = h5py.File(infile, "r")
-    result = narf.ioutils.pickle_load_h5py(h5file["results"])
-
-    for key, value in result.items():
-        logger.info(f"Copying {key} ...")
-        if key in results.keys():
-            if key == "meta_info":
-                results[f"meta_info_{i}"] = copy.deepcopy(value)
-            else:
-                raise NotImplementedError(f"The object with key {key} from file {infile} was already present in a previous file; No implementation to solve this conflict")
-        else:
-            results[key] = recursive_copy(value)
+logger = logging.setup_logger(__file__, args.verbose)
 
 outfile = args.infiles[0].split("/")[-1]
 if args.postfix:
     outfile = outfile.replace(".hdf5", f"_{args.postfix}.hdf5" if args.postfix else ".hdf5")
 
 logger.info(f"Writing merged results into output file {args.outfolder}/{outfile}")
-with h5py.File(f"{args.outfolder}/{outfile}", 'w') as f:
-    narf.ioutils.pickle_dump_h5py("results", results, f)
\ No newline at end of file
+merge_tools.merge_files(args.infiles, os.path.join(args.outfolder, outfile), sum_duplicates=args.sum, sliceable=args.sliceable, refs=args.lowMemory)
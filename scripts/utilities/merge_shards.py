@@ -0,0 +1,27 @@
+import argparse
+import os
+
+from utilities import logging
+from utilities.io_tools import merge_tools
+from wremnants.datasets.dataset_tools import getDatasetGroups
+from wremnants.histmaker_tools import make_shard_merge_plan
+
+parser = argparse.ArgumentParser(description="Merge the outputs of histmakers run with --shard i/N")
+parser.add_argument("infiles", type=str, nargs="+", help="Input hdf5 files of the shards")
+parser.add_argument("-o", "--outfile", type=str, default=None, help="Output file (default is the name of the first input without the shard postfix)")
+parser.add_argument("--noScaleToData", action="store_true", help="Do not scale the MC histograms with xsec*lumi/sum(gen weights)")
+parser.add_argument("--aggregateGroups", type=str, nargs="*", default=["Diboson", "Top"], help="Sum up histograms from members of given groups")
+parser.add_argument("--sliceable", action="store_true", help="Write the summed histograms in sliceable format, such that only one histogram is held in memory at a time")
+parser.add_argument("--lowMemory", action="store_true", help="Write each summed histogram as soon as it is complete, such that only one histogram is held in memory at a time (the output can only be read with input_tools.load_results_h5py)")
+parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4], help="Set verbosity level with logging, the larger the more verbose")
+args = parser.parse_args()
+logger = logging.setup_logger(__file__, args.verbose)
+
+outfile = args.outfile
+if outfile is None:
+    basename = os.path.basename(args.infiles[0])
+    outfile = basename[:basename.rindex("_shard")]+".hdf5" if "_shard" in basename else basename.replace(".hdf5", "_merged.hdf5")
+
+logger.info(f"Merge {len(args.infiles)} shards into {outfile}")
+plan = make_shard_merge_plan(getDatasetGroups(), groups_to_aggregate=[] if args.noScaleToData else args.aggregateGroups, scale=not args.noScaleToData)
+merge_tools.merge_files(args.infiles, outfile, plan=plan, sliceable=args.sliceable, refs=args.lowMemory)
@@ -0,0 +1,85 @@
+import argparse
+import sys
+import h5py
+import numpy as np
+
+from utilities import logging
+from utilities.io_tools import input_tools, hist_storage
+from utilities.io_tools.merge_tools import release
+
+parser = argparse.ArgumentParser(description="Maximum difference in the logk of the variation histograms from storing them with reduced precision (--systStorage)")
+parser.add_argument("infile", type=str, help="Histmaker output file")
+parser.add_argument("--reference", type=str, default=None, help="Histmaker output with the variations in double precision to compare to, "
+    "by default the rounding to the precision given by --precision is applied to the input file")
+parser.add_argument("--precision", type=str, default="float32", choices=[p for p in hist_storage.precisions.keys() if p != "double"], help="Reduced precision to test without a reference file")
+parser.add_argument("--procs", type=str, nargs="*", default=None, help="Processes to check (default all)")
+parser.add_argument("--hists", type=str, nargs="*", default=None, help="Variation histograms to check (default all)")
+parser.add_argument("--minNominal", type=float, default=0., help="Only consider bins with nominal yield above this value")
+parser.add_argument("--threshold", type=float, default=None, help="Exit with an error if the maximum absolute difference of the logk exceeds this value")
+parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4], help="Set verbosity level with logging, the larger the more verbose")
+args = parser.parse_args()
+logger = logging.setup_logger(__file__, args.verbose)
+
+def values(h):
+    obj = h.get()
+    release(h)
+    return obj.values(flow=True).astype(np.float64)
+
+def logk(var, nom):
+    # log of the ratio of the variation to the nominal, broadcast over the trailing variation axes
+    nom = nom.reshape(nom.shape + (1,)*(var.ndim - nom.ndim))
+    valid = (var > 0) & (nom > args.minNominal)
+    return np.where(valid, np.log(np.where(valid, var, 1.)/np.where(valid, nom, 1.)), 0.), valid
+
+infile = h5py.File(args.infile, "r")
+results = input_tools.load_results_h5py(infile)
+if args.reference:
+    reffile = h5py.File(args.reference, "r")
+    refresults = input_tools.load_results_h5py(reffile)
+
+rows = []
+for proc, result in results.items():
+    if not isinstance(result, dict) or "output" not in result or (args.procs and proc not in args.procs):
+        continue
+    hists = result["output"]
+    # the axes are needed to identify the variations, LazyHist provides them without reading the data
+    axes_hists = {h_name : h if isinstance(h, hist_storage.LazyHist) else h.get() for h_name, h in hists.items()}
+    for h_name, h in hists.items():
+        if args.hists and h_name not in args.hists:
+            continue
+        base = hist_storage.variation_base(h_name, axes_hists[h_name], axes_hists)
+        if base is None:
+            continue
+
+        # the nominal histograms are always stored in double precision
+        if args.reference:
+            ref = values(refresults[proc]["output"][h_name])
+            nom = values(refresults[proc]["output"][base])
+            test = values(h)
+            nom_test = values(hists[base])
+        else:
+            ref = values(h)
+            nom = values(hists[base])
+            test = ref.astype(hist_storage.precisions[args.precision]).astype(np.float64)
+            nom_test = nom
+
+        logk_ref, valid = logk(ref, nom)
+        logk_test, valid_test = logk(test, nom_test)
+        valid &= valid_test
+        if not np.any(valid):
+            continue
+        diff = np.abs(logk_test - logk_ref)[valid]
+        absref = np.abs(logk_ref[valid])
+        rel = diff[absref > 0]/absref[absref > 0]
+        rows.append((proc, h_name, base, float(diff.max()), float(rel.max()) if rel.size else 0., float(absref.max())))
+        logger.debug(f"{proc} {h_name}: max |dlogk| = {rows[-1][3]:.3e}")
+
+logger.info(f"{'process':<30} {'histogram':<50} {'nominal':<20} {'max |dlogk|':>12} {'max rel':>12} {'max |logk|':>12}")
+for row in sorted(rows, key=lambda r: r[3], reverse=True):
+    logger.info(f"{row[0]:<30} {row[1]:<50} {row[2]:<20} {row[3]:>12.3e} {row[4]:>12.3e} {row[5]:>12.3e}")
+
+maxdiff = max([r[3] for r in rows], default=0.)
+logger.info(f"Maximum absolute difference of the logk: {maxdiff:.3e}")
+if args.threshold is not None and maxdiff > args.threshold:
+    logger.error(f"The maximum difference exceeds the threshold of {args.threshold}")
+    sys.exit(1)
@@ -0,0 +1,42 @@
+import importlib.util
+import os
+
+import hist
+import numpy as np
+import pytest
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1)
+
+@pytest.fixture
+def fill(rng):
+    # random contents of all bins (including flow), the variances of weighted histograms are set to the values
+    def fill(h, low=0.5, high=1.5):
+        vals = rng.uniform(low, high, size=h.values(flow=True).shape)
+        if h.storage_type == hist.storage.Weight:
+            h.view(flow=True).value[...] = vals
+            h.view(flow=True).variance[...] = vals
+        else:
+            h.values(flow=True)[...] = vals
+        return h
+    return fill
+
+@pytest.fixture
+def make_hist(fill):
+    def make_hist(*axes, storage=hist.storage.Double(), **kwargs):
+        return fill(hist.Hist(*axes, storage=storage), **kwargs)
+    return make_hist
+
+@pytest.fixture(scope="session")
+def load_module():
+    # load a module of the wremnants package from its file, without running the package __init__ (which needs ROOT and narf),
+    # for the modules that only depend on pure python packages, name is the path relative to the package (e.g. datasets/work_balancing)
+    def load(name):
+        spec = importlib.util.spec_from_file_location(f"wremnants_{name.replace('/', '_')}", f"{base_dir}/wremnants/{name}.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
@@ -0,0 +1,107 @@
+import hist
+import numpy as np
+import pytest
+
+pytest.importorskip("ROOT")
+pytest.importorskip("narf")
+pytest.importorskip("uproot")
+
+from wremnants import CardTool
+
+fit_axes = ["eta", "pt", "charge"]
+
+@pytest.fixture
+def make_fit_hist(make_hist):
+    def make_fit_hist(*syst_axes, storage=hist.storage.Double()):
+        axes = [
+            hist.axis.Regular(6, -2.4, 2.4, name="eta"),
+            hist.axis.Regular(4, 26, 56, name="pt"),
+            hist.axis.Regular(2, -2, 2, underflow=False, overflow=False, name="charge"),
+        ]
+        return make_hist(*axes, *syst_axes, storage=storage)
+    return make_fit_hist
+
+def make_card_tool(**kwargs):
+    card_tool = CardTool.CardTool()
+    card_tool.addSystematic("syst", processes=["proc"], baseName="syst_", **kwargs)
+    return card_tool
+
+def compare(make_fit_hist, hvar, axes=fit_axes, **kwargs):
+    # the bulk values against the histograms of each variation (the entries are bookkept in the systematic, use one card tool each)
+    hnom = make_fit_hist(storage=hist.storage.Weight())
+    ref = make_card_tool(**kwargs).systHists(hvar.copy(), "syst", hnom)
+    names, values, decorrelation = make_card_tool(**kwargs).systArray(hvar.copy(), "syst", hnom, axes)
+    assert names == list(ref.keys())
+    assert values.shape[-1] == np.prod([hnom.axes[n].size for n in axes])
+
+    nominal = hnom.project(*axes).values().flatten()
+    for i, name in enumerate(names):
+        expected = ref[name].project(*axes).values().flatten()
+        if decorrelation is None:
+            assert np.allclose(values[i], expected, rtol=1e-14, atol=0), name
+        else:
+            row, bins = decorrelation[i]
+            full = nominal.copy()
+            full[bins] = values[row][bins]
+            assert np.allclose(full, expected, rtol=1e-14, atol=0), name
+    return names, decorrelation
+
+def test_tensor_axes(make_fit_hist):
+    hvar = make_fit_hist(hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"), hist.axis.Regular(2, 0, 2, underflow=False, overflow=False, name="downUpVar"))
+    names, decorrelation = compare(make_fit_hist, hvar, systAxes=["var", "downUpVar"])
+    assert len(names) == 6
+    assert decorrelation is None
+
+def test_axes_order(make_fit_hist):
+    hvar = make_fit_hist(hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"))
+    compare(make_fit_hist, hvar, axes=["charge", "eta", "pt"], systAxes=["var"])
+
+def test_flow_entries(make_fit_hist):
+    hvar = make_fit_hist(hist.axis.Integer(0, 3, name="var"))
+    names, decorrelation = compare(make_fit_hist, hvar, systAxes=["var"], systAxesFlow=["var"])
+    assert len(names) == 5
+
+def test_skip_entries(make_fit_hist):
+    hvar = make_fit_hist(hist.axis.StrCategory(["m0", "m1", "m2"], name="massShift"), hist.axis.Integer(0, 2, underflow=False, overflow=False, name="side"))
+    names, decorrelation = compare(make_fit_hist, hvar, systAxes=["massShift", "side"], skipEntries=[("m1", -1)])
+    assert len(names) == 4
+
+def test_mirror(make_fit_hist):
+    # the mirrored variations are added as last axis when the histograms are read
+    hvar = make_fit_hist(hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"), hist.axis.Integer(0, 2, underflow=False, overflow=False, name="mirror"))
+    names, decorrelation = compare(make_fit_hist, hvar, systAxes=["var"], mirror=True)
+    assert len(names) == 6
+
+def test_action_and_extra_axis(make_fit_hist):
+    # axes that are neither fit nor systematic axes are projected out
+    hvar = make_fit_hist(hist.axis.Regular(2, 0, 1, name="extra"), hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"))
+    compare(make_fit_hist, hvar, systAxes=["var"], action=lambda h: h*2)
+
+def decorrelation(edges=[], name=None):
+    return {"axisToDecorrName" : "eta", "decorrEdges" : edges, "newDecorrAxisName" : name}
+
+@pytest.mark.parametrize("edges", [[], [-2.4, -0.8, 0.8, 2.4]])
+def test_implicit_decorrelation(make_fit_hist, edges):
+    hvar = make_fit_hist(hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"), hist.axis.Regular(2, 0, 2, underflow=False, overflow=False, name="downUpVar"))
+    names, decorr = compare(make_fit_hist, hvar, systAxes=["var", "eta_decorr", "downUpVar"], decorrelation=decorrelation(edges))
+    assert decorr is not None
+    assert len(names) == 6*(len(edges)-1 if edges else 6)
+
+def test_implicit_decorrelation_axes_order(make_fit_hist):
+    hvar = make_fit_hist(hist.axis.StrCategory(["m0", "m1", "m2"], name="massShift"), hist.axis.Integer(0, 2, underflow=False, overflow=False, name="mirror"))
+    names, decorr = compare(make_fit_hist, hvar, axes=["pt", "eta", "charge"], systAxes=["etaDiff", "massShift"], skipEntries=[(-1, "m1", -1)],
+        decorrelation=decorrelation([-2.4, 0, 1.6, 2.4], "etaDiff"))
+    assert decorr is not None
+    assert len(names) == 12
+
+def test_explicit_decorrelation(make_fit_hist):
+    # the decorrelated histogram is built explicitly when there are axes other than the fit and systematic axes
+    hvar = make_fit_hist(hist.axis.Regular(2, 0, 1, name="extra"), hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"))
+    names, decorr = compare(make_fit_hist, hvar, systAxes=["var", "eta_decorr"], decorrelation=decorrelation([-2.4, 0, 2.4]))
+    assert decorr is None
+    assert len(names) == 6
+
+def test_decorrelation_not_fit_axis(make_fit_hist):
+    hvar = make_fit_hist(hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"))
+    names, decorr = compare(make_fit_hist, hvar, axes=["pt", "charge"], systAxes=["var", "eta_decorr"], decorrelation=decorrelation([-2.4, 0, 2.4]))
+    assert decorr is None
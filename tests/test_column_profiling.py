@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip("ROOT")
+pytest.importorskip("narf")
+
+from wremnants.column_profiling import ColumnProfiling
+
+@pytest.mark.parametrize("expression, body", [
+    ("pt*2", "return pt*2;"),
+    ("returnCode > 0", "return returnCode > 0;"),
+    ("auto x = pt*2; return x;", "auto x = pt*2; return x;"),
+    ("if (pt > 0) {return pt;} else return -pt;", "if (pt > 0) {return pt;} else return -pt;"),
+])
+def test_wrap_expression(expression, body):
+    profiling = ColumnProfiling()
+    wrapped = profiling.wrap_expression("col", expression)
+    assert f"[&]() {{ {body} }}()" in wrapped
+    assert "wrem::profile_column(0, " in wrapped
+    assert profiling.columns == [(None, "col", None)]
@@ -0,0 +1,86 @@
+import copy
+
+import hist
+import numpy as np
+import pytest
+
+symmetrizations = [None, "conservative", "average", "linear", "quadratic"]
+
+# baseline: symmetrization of a single pair of up and down variations
+def symmetrize_pair(logkup, logkdown, symmetrize):
+    if symmetrize is None:
+        return {"" : (0.5*(logkup + logkdown), 0.5*(logkup - logkdown))}
+    elif symmetrize == "conservative":
+        return {"" : (np.where(np.abs(logkup) > np.abs(logkdown), logkup, logkdown), None)}
+    elif symmetrize == "average":
+        return {"" : (0.5*(logkup + logkdown), None)}
+    diff_fact = np.sqrt(3.) if symmetrize == "quadratic" else 1.
+    return {"SymAvg" : (0.5*(logkup + logkdown), None), "SymDiff" : (0.5*diff_fact*(logkup - logkdown), None)}
+
+@pytest.fixture(scope="module")
+def symmetrize_logk(load_module):
+    return load_module("combine_helpers").symmetrize_logk
+
+@pytest.fixture
+def card_tool():
+    pytest.importorskip("ROOT")
+    pytest.importorskip("narf")
+    pytest.importorskip("uproot")
+    from wremnants import CardTool
+    return CardTool.CardTool()
+
+@pytest.mark.parametrize("symmetrize", symmetrizations)
+def test_symmetrize_logk(symmetrize_logk, rng, symmetrize):
+    logkup = rng.normal(size=(4, 7)).astype(np.float32)
+    logkdown = rng.normal(size=(4, 7)).astype(np.float32)
+
+    result = symmetrize_logk(logkup, logkdown, symmetrize)
+    for i in range(len(logkup)):
+        expected = symmetrize_pair(logkup[i], logkdown[i], symmetrize)
+        assert [suffix for suffix, avg, halfdiff in result] == list(expected.keys())
+        for suffix, avg, halfdiff in result:
+            assert avg.dtype == expected[suffix][0].dtype
+            assert np.array_equal(avg[i], expected[suffix][0])
+            if expected[suffix][1] is None:
+                assert halfdiff is None
+            else:
+                assert np.array_equal(halfdiff[i], expected[suffix][1])
+
+def test_symmetrize_invalid(symmetrize_logk):
+    with pytest.raises(ValueError):
+        symmetrize_logk(np.zeros(2), np.zeros(2), "unknown")
+
+@pytest.fixture
+def make_var_hist(make_hist):
+    def make_var_hist():
+        h = make_hist(hist.axis.Regular(5, 0, 1, name="x"), storage=hist.storage.Weight(), low=0.1, high=1.1)
+        # sign flip w.r.t. the nominal
+        h.values()[0] = -0.3
+        return h
+    return make_var_hist
+
+@pytest.mark.parametrize("symmetrize", symmetrizations[1:])
+def test_symmetrize_hists(card_tool, make_var_hist, symmetrize):
+    # the histograms of CardTool.symmetrize against the symmetrization of each pair of variations
+    hnom = make_var_hist()
+    hnom.values()[0] = 1.
+    var_map = {f"var{i}{d}" : make_var_hist() for i in range(3) for d in ["Up", "Down"]}
+    result = card_tool.symmetrize(copy.deepcopy(var_map), hnom, symmetrize)
+
+    nom = hnom.values()
+    expected = {}
+    for i in range(3):
+        logkup = card_tool.getLogk(var_map[f"var{i}Up"], hnom)
+        logkdown = -card_tool.getLogk(var_map[f"var{i}Down"], hnom)
+        for suffix, (logk, halfdiff) in symmetrize_pair(logkup, logkdown, symmetrize).items():
+            expected[f"var{i}{suffix}Up"] = (nom*np.exp(logk), var_map[f"var{i}Up"].variances())
+            expected[f"var{i}{suffix}Down"] = (nom*np.exp(-logk), var_map[f"var{i}Down"].variances())
+
+    assert set(result.keys()) == set(expected.keys())
+    for name, (values, variances) in expected.items():
+        assert np.allclose(result[name].values(), values, rtol=1e-14, atol=0), name
+        assert np.array_equal(result[name].variances(), variances), name
+
+def test_symmetrize_hists_none(card_tool, make_var_hist):
+    var_map = {"varUp" : make_var_hist(), "varDown" : make_var_hist()}
+    assert card_tool.symmetrize(var_map, make_var_hist(), None) is var_map
@@ -0,0 +1,95 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("ROOT")
+pytest.importorskip("narf")
+pytest.importorskip("XRootD")
+
+from wremnants.datasets import dataset_tools
+from wremnants.datasets.filelist_cache import FileListCache
+
+def make_tree(path):
+    files = ["a.root", "b.ROOT", "sub/c.root", "sub/deeper/d.root", "sub/deeper/e.root", "other/f.root"]
+    for f in files + ["notes.txt", "sub/log.txt"]:
+        fpath = path / f
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fpath.write_text("")
+    (path / "empty").mkdir()
+    return sorted(str(path / f) for f in files)
+
+def walk_baseline(path):
+    outfiles = []
+    for root, dirs, fnames in os.walk(path):
+        for fname in fnames:
+            if fname.lower().endswith(".root"):
+                outfiles.append(f"{root}/{fname}")
+    return sorted(outfiles)
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_posix_listing(tmp_path, num_threads):
+    expected = make_tree(tmp_path)
+    files = dataset_tools.buildFileListPosix(str(tmp_path), num_threads=num_threads)
+    assert files == expected
+    assert files == walk_baseline(str(tmp_path))
+
+def test_posix_listing_missing(tmp_path):
+    assert dataset_tools.buildFileListPosix(str(tmp_path / "missing")) == []
+
+class CountingLister(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, path):
+        self.calls.append(path)
+        return dataset_tools.buildFileListPosix(path)
+
+def test_cache_reuse(tmp_path):
+    expected = make_tree(tmp_path / "data")
+    path = str(tmp_path / "data")
+    cachefile = str(tmp_path / "out" / "filelist_cache.json")
+
+    lister = CountingLister()
+    cache = FileListCache(cachefile)
+    assert dataset_tools.buildFileList(path, cache=cache) == expected
+    assert cache.get(path, lister, dataset_tools.dirModificationTime) == expected
+    assert lister.calls == []
+    cache.save()
+    with open(cachefile) as f:
+        assert json.load(f)[path]["files"] == expected
+
+    # a new job reads the listing from the file
+    cache = FileListCache(cachefile)
+    assert cache.get(path, lister, dataset_tools.dirModificationTime) == expected
+    assert lister.calls == []
+
+    # unless the cache is refreshed
+    cache = FileListCache(cachefile, refresh=True)
+    assert cache.get(path, lister, dataset_tools.dirModificationTime) == expected
+    assert lister.calls == [path]
+
+def test_cache_invalidation(tmp_path):
+    make_tree(tmp_path / "data")
+    path = str(tmp_path / "data")
+    cachefile = str(tmp_path / "filelist_cache.json")
+
+    lister = CountingLister()
+    cache = FileListCache(cachefile)
+    cache.get(path, lister, dataset_tools.dirModificationTime)
+    cache.save()
+    assert len(lister.calls) == 1
+
+    # a file added to the top directory changes its modification time
+    (tmp_path / "data" / "new.root").write_text("")
+    os.utime(tmp_path / "data", (0, 0))
+    cache = FileListCache(cachefile)
+    files = cache.get(path, lister, dataset_tools.dirModificationTime)
+    assert f"{path}/new.root" in files
+    assert len(lister.calls) == 2
+
+    # expired entries are listed again
+    cache.save()
+    cache = FileListCache(cachefile, ttl=0)
+    cache.get(path, lister, dataset_tools.dirModificationTime)
+    assert len(lister.calls) == 3
@@ -0,0 +1,57 @@
+import h5py
+import numpy as np
+import pytest
+
+from utilities import h5pyutils
+
+@pytest.mark.parametrize("compression", h5pyutils.compression_codecs)
+def test_round_trip(tmp_path, rng, compression):
+    # logk-like tensor [nbins, nproc, 2, nsyst] with zeros, written in chunks smaller than the tensor
+    arr = rng.normal(size=(50, 3, 2, 7)).astype(np.float32)
+    arr[rng.random(arr.shape) < 0.5] = 0.
+    with h5py.File(tmp_path / "out.hdf5", "w") as f:
+        nbytes = h5pyutils.writeFlatInChunks(arr, f, "logk", maxChunkBytes=1000, compression=compression)
+        assert nbytes == arr.nbytes
+    with h5py.File(tmp_path / "out.hdf5", "r") as f:
+        dset = f["logk"]
+        nfilters = dset.id.get_create_plist().get_nfilters()
+        assert nfilters == 0 if compression == "none" else nfilters > 0
+        assert np.array_equal(h5pyutils.readFlatInChunks(dset), arr)
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        h5pyutils.compressionArgs("unknown")
+
+@pytest.mark.parametrize("shape, esize, maxChunkBytes, expected", [
+    # whole [nproc, 2, nsyst] rows of 42 elements
+    ((50, 3, 2, 7), 4, 1000, 210),
+    # rows larger than the chunk, aligned to the next dimension
+    ((50, 3, 2, 100), 4, 1000, 200),
+    # no dimension fits, the chunk is the maximum number of elements
+    ((2, 1000), 4, 1000, 250),
+    # smaller than one chunk
+    ((5, 3), 8, 1024**2, 15),
+    ((10,), 4, 8, 2),
+])
+def test_chunk_size(shape, esize, maxChunkBytes, expected):
+    chunksize = h5pyutils.chunkSizeFlat(shape, esize, maxChunkBytes)
+    assert chunksize == expected
+    assert chunksize*esize <= max(maxChunkBytes, esize)
+
+def test_create_in_slices(tmp_path, rng):
+    # sparse tensor filled incrementally as by the streaming writer, against writeSparse
+    dense_shape = (20, 4, 6)
+    indices = np.sort(rng.choice(np.prod(dense_shape), size=100, replace=False))
+    indices = np.stack(np.unravel_index(indices, dense_shape), axis=-1).astype(np.int64)
+    values = rng.normal(size=len(indices)).astype(np.float32)
+    with h5py.File(tmp_path / "out.hdf5", "w") as f:
+        h5pyutils.writeSparse(indices, values, dense_shape, f, "written", maxChunkBytes=256)
+        idx_dset, val_dset = h5pyutils.createSparse(len(values), dense_shape, np.int64, np.float32, f, "created", maxChunkBytes=256)
+        for start in range(0, len(values), 30):
+            idx_dset[start*len(dense_shape):(start+30)*len(dense_shape)] = indices[start:start+30].reshape(-1)
+            val_dset[start:start+30] = values[start:start+30]
+    with h5py.File(tmp_path / "out.hdf5", "r") as f:
+        for name in ["written", "created"]:
+            assert np.array_equal(f[name].attrs["dense_shape"], dense_shape)
+            assert np.array_equal(h5pyutils.readFlatInChunks(f[name]["indices"]), indices)
+            assert np.array_equal(h5pyutils.readFlatInChunks(f[name]["values"]), values)
@@ -0,0 +1,54 @@
+import argparse
+import threading
+
+import pytest
+
+from utilities.hashing import hash_object, UnhashableError
+
+def make_scaler(scale):
+    args = argparse.Namespace(scale=scale)
+    return lambda h: h*args.scale
+
+def test_closure_state():
+    assert hash_object(make_scaler(1.0)) == hash_object(make_scaler(1.0))
+    assert hash_object(make_scaler(1.0)) != hash_object(make_scaler(5.0))
+
+global_args = argparse.Namespace(scale=1.0)
+
+def scale_by_global(h):
+    return h*global_args.scale
+
+def test_function_globals():
+    # functions are identified by their code, the state of the global variables they use is not followed
+    before = hash_object(scale_by_global)
+    global_args.scale = 2.0
+    try:
+        assert hash_object(scale_by_global) == before
+    finally:
+        global_args.scale = 1.0
+    assert hash_object(lambda h: h*2) != hash_object(lambda h: h*3)
+
+class Helper(object):
+    def __init__(self, entries):
+        self.entries = entries
+
+    def select(self):
+        return lambda h: h[{"vars" : self.entries}]
+
+def recursive(n):
+    return recursive(n-1) if n else 0
+
+def test_recursive_function():
+    assert hash_object(recursive) == hash_object(recursive)
+
+def test_unhashable():
+    lock = threading.Lock()
+    with pytest.raises(UnhashableError):
+        hash_object(lambda h: lock)
+
+def test_captured_object():
+    # functions capturing objects other than plain values need an explicit key
+    with pytest.raises(UnhashableError):
+        hash_object(Helper(["a", "b"]).select())
+    with pytest.raises(UnhashableError):
+        hash_object(Helper(["a", "b"]).select)
@@ -0,0 +1,125 @@
+import argparse
+
+import h5py
+import hist
+import numpy as np
+import pytest
+
+pytest.importorskip("ROOT")
+narf = pytest.importorskip("narf")
+
+from wremnants import CardTool, HDF5Writer
+from wremnants.datasets.datagroups import Datagroups
+from utilities.h5pyutils import readFlatInChunks
+
+def make_input(path, rng):
+    axes = [
+        hist.axis.Regular(6, -2.4, 2.4, name="eta"),
+        hist.axis.Regular(4, 26, 56, name="pt"),
+        hist.axis.Regular(2, -2, 2, underflow=False, overflow=False, name="charge"),
+    ]
+    def make_hist(*syst_axes):
+        h = hist.Hist(*axes, *syst_axes, storage=hist.storage.Weight())
+        h.values(flow=True)[...] = rng.uniform(50, 100, size=h.values(flow=True).shape)
+        h.variances(flow=True)[...] = rng.uniform(50, 100, size=h.values(flow=True).shape)
+        return h
+
+    results = {"meta_info" : {"args" : {}}}
+    for name, is_data in [("dataPostVFP", True), ("ZmumuPostVFP", False), ("Ztautau", False), ("WplusmunuPostVFP", False)]:
+        output = {"nominal" : make_hist()}
+        if not is_data:
+            output["nominal_scale"] = make_hist(hist.axis.Integer(0, 3, underflow=False, overflow=False, name="var"),
+                hist.axis.Integer(0, 2, underflow=False, overflow=False, name="downUpVar"))
+            output["nominal_mirrored"] = make_hist(hist.axis.Integer(0, 4, underflow=False, overflow=False, name="var"))
+            output["nominal_flat"] = make_hist(hist.axis.StrCategory(["a", "b"], name="var"))
+        results[name] = {
+            "dataset" : {"name" : name, "is_data" : is_data, "xsec" : None if is_data else 1., "filepaths" : []},
+            "output" : {k : narf.ioutils.H5PickleProxy(v) for k, v in output.items()},
+            "weight_sum" : 1e3, "lumi" : 1. if is_data else 0.,
+        }
+    with h5py.File(path, "w") as f:
+        for k, v in results.items():
+            narf.ioutils.pickle_dump_h5py(k, v, f)
+
+def make_card_tool(infile):
+    datagroups = Datagroups(infile, mode="dilepton", filterGroups=["Data", "Zmumu", "Ztautau", "Other"])
+    card_tool = CardTool.CardTool(real_data=True)
+    card_tool.setDatagroups(datagroups)
+    card_tool.setFitAxes(["eta", "pt", "charge"])
+    card_tool.setHistName("nominal")
+    card_tool.setNominalName("nominal")
+    card_tool.addLnNSystematic("lumi", 1.017, processes=["Zmumu", "Ztautau"])
+    card_tool.addSystematic("scale", processes=["Zmumu", "Other"], systAxes=["var", "downUpVar"], baseName="scale_", symmetrize="quadratic")
+    card_tool.addSystematic("mirrored", processes=["Zmumu"], systAxes=["var"], baseName="mirrored_", mirror=True)
+    card_tool.addSystematic("flat", processes=["Ztautau", "Zmumu"], systAxes=["var"], baseName="flat_", mirror=True, scale=0.5)
+    return card_tool
+
+def write(tmp_path, infile, name, **kwargs):
+    writer = HDF5Writer.HDF5Writer(**kwargs)
+    writer.add_channel(make_card_tool(infile))
+    writer.write(argparse.Namespace(), str(tmp_path), name)
+    return f"{tmp_path}/{name}.hdf5"
+
+def read_tensors(path):
+    # all datasets but the meta information (which includes the time and command)
+    tensors = {}
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and name != "meta":
+            tensors[name] = readFlatInChunks(obj) if "original_shape" in obj.attrs else obj[...]
+    with h5py.File(path, "r") as f:
+        f.visititems(visit)
+        for name in ["hnorm_sparse", "hlogk_sparse"]:
+            if name in f:
+                tensors[f"{name}/dense_shape"] = f[name].attrs["dense_shape"]
+    return tensors
+
+def dense_tensors(tensors):
+    # norm and logk in the dense layout, from the sparse tensors if needed
+    if "hlogk" in tensors:
+        return tensors["hnorm"], tensors["hlogk"]
+    norm = np.zeros(tensors["hnorm_sparse/dense_shape"])
+    norm_indices = tensors["hnorm_sparse/indices"]
+    norm[tuple(norm_indices.T)] = tensors["hnorm_sparse/values"]
+    # the rows of the logk indices are the entries of the sparse norm, the columns are the [2, nsyst] entries
+    logk = np.zeros((*norm.shape, *tensors["hlogk_sparse/dense_shape"][1:]))
+    logk_indices = tensors["hlogk_sparse/indices"]
+    logk[norm_indices[logk_indices[:,0],0], norm_indices[logk_indices[:,0],1], logk_indices[:,1]] = tensors["hlogk_sparse/values"]
+    return norm, logk.reshape(*norm.shape, 2, -1)
+
+@pytest.fixture
+def infile(tmp_path, rng):
+    path = str(tmp_path / "input.hdf5")
+    make_input(path, rng)
+    return path
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_parallel_serial(tmp_path, infile, sparse):
+    serial = read_tensors(write(tmp_path, infile, "serial", sparse=sparse))
+    parallel = read_tensors(write(tmp_path, infile, "parallel", sparse=sparse, nProcesses=3))
+    assert serial.keys() == parallel.keys()
+    for k in serial:
+        if serial[k].dtype == object:
+            # strings and variable length arrays
+            assert all(np.array_equal(a, b) for a, b in zip(serial[k].flat, parallel[k].flat)), k
+        else:
+            assert serial[k].tobytes() == parallel[k].tobytes(), k
+
+def test_sparse_dense(tmp_path, infile):
+    dense = read_tensors(write(tmp_path, infile, "dense"))
+    sparse = read_tensors(write(tmp_path, infile, "sparse", sparse=True))
+    for a, b in zip(dense_tensors(dense), dense_tensors(sparse)):
+        assert np.array_equal(a, b)
+    assert np.array_equal(dense["hdata_obs"], sparse["hdata_obs"])
+
+def test_write_twice(tmp_path, infile):
+    # the logk arrays are released once the sparse tensors are written, they are booked again by each write
+    writer = HDF5Writer.HDF5Writer(sparse=True)
+    writer.add_channel(make_card_tool(infile))
+    writer.write(argparse.Namespace(), str(tmp_path), "first")
+    with pytest.raises(RuntimeError):
+        writer.write_sparse(None, writer.get_signals() + writer.get_backgrounds(), writer.get_systs(), [])
+    writer.write(argparse.Namespace(), str(tmp_path), "second")
+    first = read_tensors(f"{tmp_path}/first.hdf5")
+    second = read_tensors(f"{tmp_path}/second.hdf5")
+    for k in ["hnorm_sparse/values", "hlogk_sparse/indices", "hlogk_sparse/values"]:
+        assert np.array_equal(first[k], second[k]), k
@@ -0,0 +1,80 @@
+import h5py
+import hist
+import numpy as np
+import pytest
+
+from utilities.io_tools import hist_storage
+
+axes = [hist.axis.Regular(6, -2.4, 2.4, name="eta"), hist.axis.Regular(4, 26, 56, name="pt"), hist.axis.Regular(2, -2, 2, underflow=False, overflow=False, name="charge")]
+
+@pytest.fixture
+def hists(make_hist):
+    # a nominal histogram and a variation of it with a systematic axis, values covering several orders of magnitude
+    hists = {
+        "nominal" : make_hist(*axes, storage=hist.storage.Weight(), low=1, high=1e4),
+        "nominal_pdf" : make_hist(*axes, hist.axis.Integer(0, 5, underflow=False, overflow=False, name="pdfVar"), storage=hist.storage.Weight(), low=1, high=1e4),
+        "nominal_yield" : make_hist(*axes[:2], storage=hist.storage.Double()),
+    }
+    return hists
+
+def rounded(h):
+    # the histogram with values and variances rounded to single precision
+    hround = h.copy()
+    view = hround.view(flow=True)
+    view.value = view.value.astype(np.float32)
+    view.variance = view.variance.astype(np.float32)
+    return hround
+
+def test_variation_base(hists):
+    assert hist_storage.variation_base("nominal_pdf", hists["nominal_pdf"], hists) == "nominal"
+    assert hist_storage.variation_base("nominal", hists["nominal"], hists) is None
+    # the name of a variation, but not the axes
+    assert hist_storage.variation_base("nominal_yield", hists["nominal_yield"], hists) is None
+
+@pytest.mark.parametrize("precision", ["double", "float32"])
+def test_round_trip(tmp_path, hists, precision):
+    h = hists["nominal_pdf"]
+    with h5py.File(tmp_path / "out.hdf5", "w") as f:
+        hist_storage.write_hist(h, f, "h", maxChunkBytes=1024, precision=precision)
+    with h5py.File(tmp_path / "out.hdf5", "r") as f:
+        assert f["h"]["values"].dtype == hist_storage.precisions[precision]
+        lazy = hist_storage.LazyHist(f["h"])
+        hread = lazy.get()
+        # read back in double precision
+        assert hread.view(flow=True).value.dtype == np.float64
+        expected = h if precision == "double" else rounded(h)
+        assert np.array_equal(hread.view(flow=True), expected.view(flow=True))
+        assert np.allclose(hread.values(flow=True), h.values(flow=True), rtol=2**-24, atol=0)
+
+        # slices and projections of the stored histogram
+        assert np.array_equal(lazy[{"pdfVar" : 3}].view(flow=True), expected[{"pdfVar" : 3}].view(flow=True))
+        proj = lazy.project("pt", "eta", maxBlockBytes=256)
+        assert proj.view(flow=True).value.dtype == np.float64
+        assert np.allclose(proj.values(flow=True), expected.project("pt", "eta").values(flow=True), rtol=1e-14, atol=0)
+        assert np.allclose(proj.variances(flow=True), expected.project("pt", "eta").variances(flow=True), rtol=1e-14, atol=0)
+
+def test_logk_precision(tmp_path, hists):
+    # the difference of logk = log(variation/nominal) with the variation stored in single precision, as reported by validate_syst_storage
+    hnom, hvar = hists["nominal"], hists["nominal_pdf"]
+    with h5py.File(tmp_path / "out.hdf5", "w") as f:
+        hist_storage.write_hist(hvar, f, "h", precision="float32")
+    with h5py.File(tmp_path / "out.hdf5", "r") as f:
+        hread = hist_storage.LazyHist(f["h"]).get()
+    nom = hnom.values(flow=True)[..., np.newaxis]
+    logk = np.log(hvar.values(flow=True)/nom)
+    logk_read = np.log(hread.values(flow=True)/nom)
+    assert 0 < np.max(np.abs(logk_read - logk)) <= 2**-24
+
+def test_sliceable_variations(tmp_path, hists):
+    # only the variations are written in single precision
+    pytest.importorskip("ROOT")
+    narf = pytest.importorskip("narf")
+    from utilities.io_tools import output_tools
+
+    result = {"output" : {name : narf.ioutils.H5PickleProxy(h) for name, h in hists.items()}}
+    with h5py.File(tmp_path / "out.hdf5", "w") as f:
+        output = output_tools.write_sliceable_hists(f, "proc", result, all_hists=False, systStorage="float32")["output"]
+        assert isinstance(output["nominal_pdf"], hist_storage.HistRef)
+        assert f[output["nominal_pdf"].path]["values"].dtype == np.float32
+        assert output["nominal"] is result["output"]["nominal"]
+        assert output["nominal_yield"] is result["output"]["nominal_yield"]
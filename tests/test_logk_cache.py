@@ -0,0 +1,37 @@
+import pytest
+
+class Helper(object):
+    def __init__(self, entries):
+        self.entries = entries
+
+    def select(self):
+        return lambda h: h[{"vars" : self.entries}]
+
+def make_syst(**kwargs):
+    syst = {"name" : "syst", "systAxes" : ["vars"], "mirror" : True, "scale" : 1.}
+    syst.update(kwargs)
+    return syst
+
+@pytest.fixture
+def cache(tmp_path, load_module):
+    infile = tmp_path / "input.hdf5"
+    infile.write_text("")
+    logk_cache = load_module("logk_cache").LogkCache(str(tmp_path / "cache"))
+    return lambda syst, *args: logk_cache.key(str(infile), syst, ["pt", "eta"], *args)
+
+def test_key(cache):
+    assert cache(make_syst()) == cache(make_syst())
+    assert cache(make_syst()) != cache(make_syst(scale=2.))
+    assert cache(make_syst(), "proc") != cache(make_syst(), "other")
+    # functions are identified by their code and the values they capture
+    select = lambda entries: (lambda h: h[{"vars" : entries}])
+    assert cache(make_syst(action=select(["a"]))) == cache(make_syst(action=select(["a"])))
+    assert cache(make_syst(action=select(["a"]))) != cache(make_syst(action=select(["b"])))
+
+def test_cache_key_override(cache):
+    # functions capturing objects are not hashed, the systematic is only cached with an explicit key
+    assert cache(make_syst(preOpMap={"proc" : Helper(["a"]).select()})) is None
+    key = cache(make_syst(preOpMap={"proc" : Helper(["a"]).select()}, cacheKey={"vars" : ["a"]}))
+    assert key is not None
+    assert key == cache(make_syst(preOpMap={"proc" : Helper(["a"]).select()}, cacheKey={"vars" : ["a"]}))
+    assert key != cache(make_syst(preOpMap={"proc" : Helper(["b"]).select()}, cacheKey={"vars" : ["b"]}))
@@ -0,0 +1,86 @@
+import copy
+import types
+
+import hist
+import numpy as np
+import pytest
+
+pytest.importorskip("ROOT")
+pytest.importorskip("narf")
+
+from narf.ioutils import H5PickleProxy
+from wremnants.histmaker_tools import scale_to_data, aggregate_groups
+
+groups = {"dataPostVFP" : "Data", "ZmumuPostVFP" : "Zmumu", "WWPostVFP" : "Diboson", "WZPostVFP" : "Diboson", "ZZPostVFP" : "Diboson"}
+xsecs = {"ZmumuPostVFP" : 2001.9, "WWPostVFP" : 75.8, "WZPostVFP" : 27.6, "ZZPostVFP" : 12.1}
+
+@pytest.fixture
+def result_dict(make_hist, rng):
+    axes = [hist.axis.Regular(5, -2.4, 2.4, name="eta"), hist.axis.Regular(3, 26, 56, name="pt")]
+    result_dict = {}
+    for name in groups.keys():
+        is_data = name not in xsecs
+        result = {
+            "dataset" : {"name" : name, "xsec" : xsecs.get(name), "filepaths" : [f"{name}.root"], "is_data" : is_data},
+            "weight_sum" : rng.uniform(1e5, 1e6),
+            "event_count" : 1000.,
+            "output" : {hname : H5PickleProxy(make_hist(*axes, storage=hist.storage.Weight())) for hname in ["nominal", "other"]},
+        }
+        if is_data:
+            result["lumi"] = 16.8
+        result_dict[name] = result
+    return result_dict
+
+# baseline: the histograms scaled in place with the sum of weights rescaled accordingly, and the scaled members summed
+def scale_eagerly(result_dict, groups_to_aggregate):
+    lumi = sum(r["lumi"] for r in result_dict.values() if r["dataset"]["is_data"])
+    for result in result_dict.values():
+        if result["dataset"]["is_data"]:
+            continue
+        scale = lumi * 1000 * result["dataset"]["xsec"] / result["weight_sum"]
+        result["weight_sum"] *= scale
+        for h in result["output"].values():
+            histo = h.get()
+            histo *= scale
+
+    for group in groups_to_aggregate:
+        members = [name for name in result_dict.keys() if groups[name] == group]
+        result_dict[group] = {
+            "dataset" : {"name" : group, "xsec" : sum(result_dict[m]["dataset"]["xsec"] for m in members)},
+            "weight_sum" : sum(result_dict[m]["weight_sum"] for m in members),
+            "output" : {hname : H5PickleProxy(sum(result_dict[m]["output"][hname].get() for m in members)) for hname in result_dict[members[0]]["output"].keys()},
+        }
+        for m in members:
+            del result_dict[m]
+
+def read(result_dict, name, hname):
+    # histogram with the normalization applied when reading, as in Datagroups.processScaleFactor
+    result = result_dict[name]
+    h = result["output"][hname].get()
+    if result["dataset"].get("is_data", False):
+        return h
+    lumi = sum(r["lumi"] for r in result_dict.values() if "lumi" in r)
+    return h*(lumi*1000*result["dataset"]["xsec"]/result["weight_sum"])
+
+@pytest.mark.parametrize("groups_to_aggregate", [[], ["Diboson"]])
+def test_lazy_scale(result_dict, groups_to_aggregate):
+    # the histograms read with the scale of the metadata against the histograms scaled when they are made
+    eager = copy.deepcopy(result_dict)
+    scale_eagerly(eager, groups_to_aggregate)
+
+    scales = scale_to_data(result_dict)
+    assert set(scales.keys()) == set(xsecs.keys())
+    nominal = {name : result["output"]["nominal"].get().values(flow=True).copy() for name, result in result_dict.items()}
+    datasets = [types.SimpleNamespace(name=name, group=group) for name, group in groups.items()]
+    aggregate_groups(datasets, result_dict, groups_to_aggregate, scales)
+
+    assert set(result_dict.keys()) == set(eager.keys())
+    for name in result_dict.keys():
+        if name in nominal:
+            # the histograms of the processes that are not aggregated are left untouched
+            assert np.array_equal(result_dict[name]["output"]["nominal"].get().values(flow=True), nominal[name])
+        for hname in ["nominal", "other"]:
+            h = read(result_dict, name, hname)
+            href = read(eager, name, hname)
+            assert np.allclose(h.values(flow=True), href.values(flow=True), rtol=1e-12, atol=0), (name, hname)
+            assert np.allclose(h.variances(flow=True), href.variances(flow=True), rtol=1e-12, atol=0), (name, hname)
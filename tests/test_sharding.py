@@ -0,0 +1,97 @@
+import argparse
+import copy
+import types
+
+import pytest
+
+from utilities import common
+
+@pytest.mark.parametrize("value, expected", [("0/1", (0, 1)), ("2/5", (2, 5))])
+def test_parse_shard(value, expected):
+    assert common.parse_shard(value) == expected
+
+@pytest.mark.parametrize("value", ["1/1", "-1/3", "1/0", "3", "a/b", "1/2/3"])
+def test_parse_shard_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        common.parse_shard(value)
+
+def test_shard_filelist():
+    dataset_tools = pytest.importorskip("wremnants.datasets.dataset_tools")
+    files = [f"/store/file{i}.root" for i in range(11)]
+    shards = [dataset_tools.shardFilelist(files, (i, 3)) for i in range(3)]
+    # a partition of the files, independent of the listing order
+    assert sorted(f for shard in shards for f in shard) == sorted(files)
+    assert shards == [dataset_tools.shardFilelist(files[::-1], (i, 3)) for i in range(3)]
+    assert [len(shard) for shard in shards] == [4, 4, 3]
+
+class Shard(object):
+    # the interface of merge_tools.ResultsFile used by the merge plan
+    def __init__(self, results):
+        self.results = results
+
+    def keys(self):
+        return self.results.keys()
+
+def make_result(name, ishard, xsec=None, lumi=None):
+    result = {
+        "dataset" : {"name" : name, "xsec" : xsec, "filepaths" : [f"{name}_{ishard}.root"], "is_data" : lumi is not None},
+        "weight_sum" : 100.*(ishard+1),
+        "event_count" : 10.*(ishard+1),
+        "output" : {},
+    }
+    if lumi is not None:
+        result["lumi"] = lumi
+    return result
+
+def make_shards(nshards=2):
+    return [Shard({
+        "dataPostVFP" : make_result("dataPostVFP", i, lumi=8.),
+        "ZmumuPostVFP" : make_result("ZmumuPostVFP", i, xsec=2000.),
+        "WWPostVFP" : make_result("WWPostVFP", i, xsec=75.),
+        "WZPostVFP" : make_result("WZPostVFP", i, xsec=27.),
+        "meta_info" : {},
+    }) for i in range(nshards)]
+
+dataset_groups = {"dataPostVFP" : "Data", "ZmumuPostVFP" : "Zmumu", "WWPostVFP" : "Diboson", "WZPostVFP" : "Diboson"}
+
+def test_merge_plan():
+    # the plan for the shards against scale_to_data and aggregate_groups of the unsharded results
+    pytest.importorskip("ROOT")
+    pytest.importorskip("narf")
+    from utilities.io_tools import merge_tools
+    from wremnants.histmaker_tools import make_shard_merge_plan, scale_to_data, aggregate_groups
+
+    shards = make_shards()
+    outputs = make_shard_merge_plan(dataset_groups, groups_to_aggregate=["Diboson"])(shards)
+    assert set(outputs.keys()) == {"dataPostVFP", "ZmumuPostVFP", "Diboson"}
+
+    metadata = {name : merge_tools.merge_metadata([s.results[name] for s in shards]) for name in dataset_groups.keys()}
+    assert metadata["dataPostVFP"]["lumi"] == 16.
+    result_dict = {name : {**m, "output" : {}} for name, m in metadata.items()}
+    scales = scale_to_data(result_dict)
+    datasets = [types.SimpleNamespace(name=name, group=group) for name, group in dataset_groups.items()]
+    unsharded = copy.deepcopy(result_dict)
+    aggregate_groups(datasets, unsharded, ["Diboson"], scales)
+
+    # the processes that are not aggregated are summed without scaling, the scale is applied when reading
+    for name in ["dataPostVFP", "ZmumuPostVFP"]:
+        assert outputs[name]["entries"] == [(s, name, 1) for s in shards]
+        assert outputs[name]["metadata"] == metadata[name]
+
+    group = outputs["Diboson"]
+    assert group["entries"] == [(s, name, scales[name]) for name in ["WWPostVFP", "WZPostVFP"] for s in shards]
+    expected = unsharded["Diboson"]
+    for key in ["n_members", "weight_sum", "event_count"]:
+        assert group["metadata"][key] == pytest.approx(expected[key]), key
+    assert group["metadata"]["dataset"]["xsec"] == pytest.approx(expected["dataset"]["xsec"])
+    assert sorted(group["metadata"]["dataset"]["filepaths"]) == sorted(expected["dataset"]["filepaths"])
+
+def test_merge_plan_no_scale():
+    pytest.importorskip("ROOT")
+    pytest.importorskip("narf")
+    from wremnants.histmaker_tools import make_shard_merge_plan
+
+    shards = make_shards()
+    outputs = make_shard_merge_plan(dataset_groups, scale=False)(shards)
+    assert set(outputs.keys()) == set(dataset_groups.keys())
+    assert all(scale == 1 for output in outputs.values() for f, key, scale in output["entries"])
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import types
+
+import pytest
+
+@pytest.fixture(scope="module")
+def skim_tools(load_module):
+    return load_module("skim_tools")
+
+selection = {"era" : "2016PostVFP", "pt" : [30, 26, 56]}
+
+def make_dataset(name="WplusmunuPostVFP", nfiles=3):
+    return types.SimpleNamespace(name=name, filepaths=[f"/store/{name}/file{i}.root" for i in range(nfiles)])
+
+def test_key(skim_tools, tmp_path):
+    skimmer = skim_tools.Skimmer(str(tmp_path), selection)
+    dataset = make_dataset()
+    key = skimmer.key(dataset)
+    # independent of the order of the files
+    assert skimmer.key(types.SimpleNamespace(name=dataset.name, filepaths=dataset.filepaths[::-1])) == key
+    # but not of the files, the dataset and the selection
+    assert skimmer.key(make_dataset(nfiles=2)) != key
+    assert skimmer.key(make_dataset(name="WminusmunuPostVFP")) != key
+    assert skim_tools.Skimmer(str(tmp_path), {**selection, "pt" : [30, 28, 56]}).key(dataset) != key
+
+def write_skim(skimmer, dataset, key=None, **meta):
+    # skim file and metadata at the path of the dataset, with the key of the dataset unless given
+    path = skimmer.path(dataset, skimmer.key(dataset))
+    with open(path, "w") as f:
+        f.write("")
+    with open(f"{path}.json", "w") as f:
+        json.dump({"key" : skimmer.key(dataset) if key is None else key, **meta}, f)
+    return path
+
+def test_use_skims(skim_tools, tmp_path):
+    skimmer = skim_tools.Skimmer(str(tmp_path), selection)
+    skimmed, missing, stale = make_dataset("ZmumuPostVFP"), make_dataset("WplusmunuPostVFP"), make_dataset("WminusmunuPostVFP")
+    path = write_skim(skimmer, skimmed, weight_sum=10.)
+    # a skim written for other input files
+    write_skim(skimmer, stale, key=skimmer.key(make_dataset("WminusmunuPostVFP", nfiles=2)))
+    missing_files = list(missing.filepaths)
+    stale_files = list(stale.filepaths)
+
+    skimmer.use_skims([skimmed, missing, stale])
+    assert skimmed.filepaths == [path]
+    assert missing.filepaths == missing_files
+    assert stale.filepaths == stale_files
+    assert list(skimmer.skimmed.keys()) == ["ZmumuPostVFP"]
+    assert set(skimmer.keys.keys()) == {"ZmumuPostVFP", "WplusmunuPostVFP", "WminusmunuPostVFP"}
+
+def test_finalize(skim_tools, tmp_path):
+    # the normalization of the full inputs is restored for skims that are read and stored for skims that are written
+    skimmer = skim_tools.Skimmer(str(tmp_path), selection)
+    read, written = make_dataset("ZmumuPostVFP"), make_dataset("WplusmunuPostVFP")
+    write_skim(skimmer, read, weight_sum=1000., event_count=500., lumi=16.8)
+    skimmer.use_skims([read, written])
+
+    key = skimmer.keys[written.name]
+    tmpfile = f"{skimmer.path(written, key)}.tmp{os.getpid()}"
+    with open(tmpfile, "w") as f:
+        f.write("")
+    skimmer.snapshots[written.name] = (key, tmpfile, None)
+
+    resultdict = {
+        read.name : {"dataset" : {"filepaths" : read.filepaths}, "weight_sum" : 10., "event_count" : 5., "lumi" : 1.},
+        written.name : {"dataset" : {"filepaths" : written.filepaths}, "weight_sum" : 300., "event_count" : 200.},
+    }
+    skimmer.finalize(resultdict)
+    assert resultdict[read.name]["weight_sum"] == 1000.
+    assert resultdict[read.name]["event_count"] == 500.
+    assert resultdict[read.name]["lumi"] == 16.8
+    assert resultdict[written.name]["weight_sum"] == 300.
+
+    path = skimmer.path(written, key)
+    assert os.path.isfile(path) and not os.path.isfile(tmpfile)
+    with open(f"{path}.json") as f:
+        meta = json.load(f)
+    assert meta == {"key" : key, "selection" : selection, "filepaths" : written.filepaths, "weight_sum" : 300., "event_count" : 200.}
+
+    # a later run reads the skim with the normalization of the full inputs
+    later = skim_tools.Skimmer(str(tmp_path), selection)
+    dataset = make_dataset("WplusmunuPostVFP")
+    later.use_skims([dataset])
+    assert dataset.filepaths == [path]
+    resultdict = {dataset.name : {"dataset" : {}, "weight_sum" : 3., "event_count" : 2.}}
+    later.finalize(resultdict)
+    assert resultdict[dataset.name]["weight_sum"] == 300.
+    assert resultdict[dataset.name]["event_count"] == 200.
+
+def test_make_skimmer(skim_tools, tmp_path):
+    args = argparse.Namespace(skimDir=None, skimColumns=None, era="2016PostVFP", pt=[30, 26, 56], unrelated=1)
+    assert skim_tools.make_skimmer(args) is None
+    args.skimDir = str(tmp_path)
+    skimmer = skim_tools.make_skimmer(args)
+    assert skimmer.selection == {"era" : "2016PostVFP", "pt" : [30, 26, 56]}
+    assert len(skimmer.columns) == len(skim_tools.default_columns)
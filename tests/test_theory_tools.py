@@ -0,0 +1,92 @@
+import hist
+import numpy as np
+import pytest
+
+from utilities import boostHistHelpers as hh
+
+@pytest.fixture
+def make_var_hist(make_hist):
+    def make_var_hist(var_axis, storage=hist.storage.Double()):
+        return make_hist(hist.axis.Regular(4, 0, 1, name="x"), hist.axis.Regular(3, -2, 2, name="y"), var_axis, storage=storage, low=50, high=100)
+    return make_var_hist
+
+# baseline: differences of each member w.r.t. the nominal from the histogram slices
+def member_diffs(h, members, axis_name, scale=1.):
+    nom = h[{axis_name : 0}].values(flow=True)
+    return nom, [scale*(h[{axis_name : m}].values(flow=True) - nom) for m in members]
+
+def rss(diffs):
+    return np.sqrt(sum(d*d for d in diffs))
+
+@pytest.mark.parametrize("scale", [1., 1/1.645])
+def test_symmetric_hessian(make_var_hist, scale):
+    # the flow bins of the variation axis are not members of the PDF set
+    h = make_var_hist(hist.axis.Integer(0, 9, name="pdfVar"))
+    down, up = hh.variation_shifts(h, "pdfVar", {"pdf" : {"type" : "symHessian", "scale" : scale}})["pdf"]
+    nom, diffs = member_diffs(h, range(1, 9), "pdfVar", scale)
+    assert np.allclose(up, nom + rss(diffs))
+    assert np.allclose(down, nom - rss(diffs))
+
+def test_asymmetric_hessian(make_var_hist):
+    # the error sets are ordered up,down,up,down...
+    h = make_var_hist(hist.axis.Integer(0, 9, underflow=False, overflow=False, name="pdfVar"))
+    down, up = hh.variation_shifts(h, "pdfVar", {"pdf" : {"type" : "asymHessian"}})["pdf"]
+    nom, ups = member_diffs(h, range(1, 9, 2), "pdfVar")
+    nom, downs = member_diffs(h, range(2, 9, 2), "pdfVar")
+    assert np.allclose(up, nom + rss(ups))
+    assert np.allclose(down, nom - rss(downs))
+
+def test_asymmetric_hessian_named(make_var_hist):
+    names = ["pdf0"] + [f"pdf{i}{d}" for i in range(1, 4) for d in ["Down", "Up"]]
+    h = make_var_hist(hist.axis.StrCategory(names, name="pdfVar"))
+    down, up = hh.variation_shifts(h, "pdfVar", {"pdf" : {"type" : "asymHessian", "scale" : 0.5}})["pdf"]
+    nom, ups = member_diffs(h, [n for n in names if n.endswith("Up")], "pdfVar", 0.5)
+    nom, downs = member_diffs(h, [n for n in names if n.endswith("Down")], "pdfVar", 0.5)
+    assert np.allclose(up, nom + rss(ups))
+    assert np.allclose(down, nom - rss(downs))
+
+def test_envelope(make_var_hist):
+    names = ["nominal", "var1", "var2", "var3", "other"]
+    h = make_var_hist(hist.axis.StrCategory(names, name="vars"))
+    entries = ["nominal", "var1", "var2", "var3"]
+    requests = {
+        "env" : {"type" : "envelope", "entries" : entries},
+        "env_sliced" : {"type" : "envelope", "entries" : entries, "slice_axis" : "x", "slice_val" : 0.5},
+        "alphas" : {"type" : "alphas", "entries" : ["var1", "var2"], "scale" : 0.75},
+    }
+    res = hh.variation_shifts(h, "vars", requests)
+
+    # baseline: minimum and maximum of the slices in the inner bins, the flow bins are those of the nominal
+    hnom = h[{"vars" : "nominal"}]
+    hvars = np.stack([h[{"vars" : e}].values() for e in entries])
+    for i, (vals, func) in enumerate(zip(res["env"], [np.min, np.max])):
+        assert np.allclose(vals[1:-1, 1:-1], func(hvars, axis=0))
+        flow = vals.copy()
+        flow[1:-1, 1:-1] = hnom.values()
+        assert np.array_equal(flow, hnom.values(flow=True))
+
+        # nominal below the slice value
+        sliced = res["env_sliced"][i][1:-1, 1:-1]
+        assert np.array_equal(sliced[:2], hnom.values()[:2])
+        assert np.allclose(sliced[2:], func(hvars, axis=0)[2:])
+
+    down, up = res["alphas"]
+    for vals, e in zip([down, up], ["var1", "var2"]):
+        assert np.allclose(vals, hnom.values(flow=True) + 0.75*(h[{"vars" : e}].values(flow=True) - hnom.values(flow=True)))
+
+def test_invalid_type(make_var_hist):
+    h = make_var_hist(hist.axis.Integer(0, 3, name="vars"))
+    with pytest.raises(ValueError):
+        hh.variation_shifts(h, "vars", {"var" : {"type" : "unknown"}})
+
+@pytest.mark.parametrize("storage", [hist.storage.Double(), hist.storage.Weight()])
+def test_hessian_hists(make_var_hist, storage):
+    # the histograms of the shifts, with the variances of the nominal
+    theory_tools = pytest.importorskip("wremnants.theory_tools")
+    h = make_var_hist(hist.axis.Integer(0, 9, name="pdfVar"), storage)
+    hUp, hDown = theory_tools.hessianPdfUnc(h, uncType="symHessian")
+    down, up = hh.variation_shifts(h, "pdfVar", {"pdf" : {"type" : "symHessian"}})["pdf"]
+    assert np.array_equal(hUp.values(flow=True), up)
+    assert np.array_equal(hDown.values(flow=True), down)
+    if storage == hist.storage.Weight():
+        assert np.array_equal(hUp.variances(flow=True), h[{"pdfVar" : 0}].variances(flow=True))
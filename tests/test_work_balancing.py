@@ -0,0 +1,79 @@
+import json
+import types
+
+import pytest
+
+@pytest.fixture
+def work_balancing(load_module):
+    # a new module for each test, the entries of the scanned files are module state
+    return load_module("datasets/work_balancing")
+
+def make_dataset(name, entries):
+    return types.SimpleNamespace(name=name, filepaths=[f"root://eos.cms//store/{name}/file{i}.root" for i in range(len(entries))])
+
+class Cache(object):
+    # the interface of EntryCountCache used by balance
+    def __init__(self, entries):
+        self.entries = entries
+
+    def scan(self, paths):
+        return {p : self.entries[p] for p in paths if p in self.entries}
+
+    def save(self):
+        pass
+
+def test_file_key(work_balancing):
+    assert work_balancing.file_key("root://user_3@eos.cms//store/file.root") == "root://eos.cms//store/file.root"
+    assert work_balancing.file_key("/scratch/file.root") == "/scratch/file.root"
+
+def test_entry_count_cache(work_balancing, tmp_path, monkeypatch):
+    scanned = []
+    def count_entries(path):
+        scanned.append(path)
+        if "broken" in path:
+            raise OSError("can not open file")
+        return [100, 4]
+    monkeypatch.setattr(work_balancing, "count_entries", count_entries)
+
+    filename = str(tmp_path / "cache" / "entries.json")
+    cache = work_balancing.EntryCountCache(filename, nWorkers=2)
+    paths = ["root://user_1@eos.cms//store/a.root", "root://eos.cms//store/b.root", "root://eos.cms//store/broken.root"]
+    # the files opened with different client names are scanned once
+    entries = cache.scan(paths + ["root://user_2@eos.cms//store/a.root"])
+    assert sorted(scanned) == sorted(paths)
+    assert entries == {p : [100, 4] for p in paths[:2] + ["root://user_2@eos.cms//store/a.root"]}
+    cache.save()
+    with open(filename) as f:
+        assert json.load(f) == {"root://eos.cms//store/a.root" : [100, 4], "root://eos.cms//store/b.root" : [100, 4]}
+
+    # a later job only scans the files that are not cached
+    scanned.clear()
+    cache = work_balancing.EntryCountCache(filename)
+    assert cache.scan(paths[:2] + ["root://eos.cms//store/c.root"]) == {p : [100, 4] for p in paths[:2] + ["root://eos.cms//store/c.root"]}
+    assert scanned == ["root://eos.cms//store/c.root"]
+
+def test_simulate_utilisation(work_balancing):
+    small, large = make_dataset("small", [1, 1]), make_dataset("large", [2])
+    work_balancing.file_entries.update({p : [1, 1] for p in small.filepaths})
+    work_balancing.file_entries.update({p : [2, 1] for p in large.filepaths})
+    # the large file is started last on one of the two threads
+    assert work_balancing.simulate_utilisation([small, large], 2) == pytest.approx(4/6)
+    assert work_balancing.simulate_utilisation([large, small], 2) == pytest.approx(1.)
+    # files are split in clusters
+    work_balancing.file_entries.update({p : [2, 2] for p in large.filepaths})
+    assert work_balancing.simulate_utilisation([small, large], 2) == pytest.approx(1.)
+    assert work_balancing.simulate_utilisation([small, large], 1) == pytest.approx(1.)
+    assert work_balancing.simulate_utilisation([], 4) == 1.
+
+def test_balance(work_balancing):
+    datasets = [make_dataset("a", [5, 50, 20]), make_dataset("b", [100]), make_dataset("c", [1, 2])]
+    entries = {p : [n, 1] for d, ns in zip(datasets, [[5, 50, 20], [100], [1, 2]]) for p, n in zip(d.filepaths, ns)}
+    # files without entry count are kept, last
+    unknown = "root://eos.cms//store/c/unknown.root"
+    datasets[2].filepaths.append(unknown)
+
+    balanced = work_balancing.balance(datasets, Cache(entries), 4)
+    assert [d.name for d in balanced] == ["b", "a", "c"]
+    assert [[entries.get(p, [0])[0] for p in d.filepaths] for d in balanced] == [[100], [50, 20, 5], [2, 1, 0]]
+    assert balanced[2].filepaths[-1] == unknown
+    assert work_balancing.simulate_utilisation(balanced, 4) >= work_balancing.simulate_utilisation(datasets[::-1], 4)
@@ -236,6 +236,30 @@ def addHists(h1, h2, allowBroadcast=True, createNew=True, scale1=None, scale2=No
 def sumHists(hists):
     return reduce(addHists, hists)
 
+def accumulateHists(h, targets, clipValue=None, flow=True, maxBlockBytes=16*1024**2):
+    # add scale*h in place to each (hout, scale) in targets, with the values of h clipped from below at clipValue if given,
+    # the targets must have the same axes and storage as h.
+    # This is done in one pass over blocks along the first axis, without intermediate full size histograms
+    hasWeights = h.storage_type == hist.storage.Weight
+    for hout, scale in targets:
+        if hout.storage_type != h.storage_type or hout.axes != h.axes:
+            raise ValueError("Histograms to accumulate must have the same axes and storage")
+
+    vals = h.values(flow=flow)
+    varis = h.variances(flow=flow) if hasWeights else None
+    outs = [(hout.values(flow=flow), hout.variances(flow=flow) if hasWeights else None, scale) for hout, scale in targets]
+
+    nrows = max(1, maxBlockBytes // max(1, vals[0].nbytes))
+    for irow in range(0, len(vals), nrows):
+        sel = np.s_[irow:irow+nrows]
+        block = vals[sel] if clipValue is None else np.maximum(vals[sel], clipValue)
+        for outvals, outvars, scale in outs:
+            outvals[sel] += block if scale == 1 else scale*block
+            if hasWeights:
+                outvars[sel] += varis[sel] if scale == 1 else (scale*scale)*varis[sel]
+
+    return [hout for hout, scale in targets]
+
 def mirrorHist(hvar, hnom, cutoff=1):
     div = divideHists(hnom, hvar, cutoff, createNew=True)
     hnew = multiplyHists(div, hnom, createNew=False)
@@ -713,3 +737,78 @@ def rssHistsMid(h, syst_axis, scale=1.):
     hDown = addHists(hnom, hrss[{"downUpVar" : -1j}], scale2=-1.)
 
     return hUp, hDown
+
+def variation_positions(ax, entries):
+    # positions of the entries (names or bin indices) in the values with flow of the variation axis
+    underflow = ax.traits.underflow
+    return [(ax.index(e) if isinstance(e, str) else e) + underflow for e in entries]
+
+def variation_shifts(h, axis_name, requests):
+    """
+    Envelopes, Hessian uncertainties and alphaS shifts over the variation axis, all computed in one pass on the
+    values (with flow) with the variation axis moved last, without intermediate histograms.
+    requests maps an output name to a dict with
+        "type" : "envelope", "symHessian", "asymHessian" or "alphas"
+        "entries" : envelope: the entries to take the minimum and maximum of, the first one is the nominal,
+            alphas: the down and up entries, Hessian: not used (all entries, the first one is the nominal)
+        "scale" : scaling of the shifts w.r.t. the nominal (Hessian and alphas, default 1)
+        "slice_axis", "slice_val" : envelope only, the nominal is kept in the bins of slice_axis below slice_val
+    Returns a dict of name : (down, up) arrays of values with flow, without the variation axis
+    """
+    ax = h.axes[axis_name]
+    idx = h.axes.name.index(axis_name)
+    vals = np.moveaxis(h.values(flow=True), idx, -1)
+    other_axes = [a for a in h.axes if a.name != axis_name]
+    underflow = ax.traits.underflow
+    # the variations themselves, without the flow bins of the variation axis
+    inner = vals[..., underflow:underflow+ax.size]
+
+    res = {}
+    for name, request in requests.items():
+        utype = request["type"]
+        scale = request.get("scale", 1.)
+        if utype == "envelope":
+            pos = variation_positions(ax, request["entries"])
+            # the envelope is taken in the inner bins, the flow bins are those of the nominal
+            nom = vals[..., pos[0]]
+            down, up = nom.copy(), nom.copy()
+            region = tuple(slice(a.traits.underflow, a.traits.underflow + a.size) for a in other_axes)
+            sel = vals[region][..., pos]
+            down[region] = sel.min(axis=-1)
+            up[region] = sel.max(axis=-1)
+            if request.get("slice_axis") is not None:
+                # nominal in the (inner) bins below the slice value
+                slice_ax = h.axes[request["slice_axis"]]
+                slice_idx = slice_ax.index(request["slice_val"])
+                region = tuple(slice(a.traits.underflow, a.traits.underflow + (slice_idx if a.name == slice_ax.name else a.size)) for a in other_axes)
+                down[region] = nom[region]
+                up[region] = nom[region]
+        elif utype == "alphas":
+            nom = inner[..., 0]
+            pos = variation_positions(ax, request["entries"])
+            down, up = (nom + scale*(vals[..., p] - nom) for p in pos)
+        elif utype in ["symHessian", "asymHessian"]:
+            nom = inner[..., 0]
+            diff = inner - nom[..., np.newaxis]
+            if scale != 1.:
+                diff = diff*scale
+            if utype == "symHessian":
+                rss = np.sqrt(np.sum(diff*diff, axis=-1))
+                down, up = nom - rss, nom + rss
+            else:
+                names = list(ax) if isinstance(ax, hist.axis.StrCategory) else []
+                if names and all("Up" in x or "Down" in x for x in names[1:]):
+                    upvals = diff[..., [i for i, x in enumerate(names) if "Up" in x]]
+                    downvals = diff[..., [i for i, x in enumerate(names) if "Down" in x]]
+                    if upvals.shape != downvals.shape:
+                        raise ValueError("Malformed PDF uncertainty hist! Expect equal number of up and down vars")
+                else:
+                    # the error sets are ordered up,down,up,down...
+                    upvals = diff[..., 1::2]
+                    downvals = diff[..., 2::2]
+                down = nom - np.sqrt(np.sum(downvals*downvals, axis=-1))
+                up = nom + np.sqrt(np.sum(upvals*upvals, axis=-1))
+        else:
+            raise ValueError(f"Invalid type {utype} of the variation {name}")
+        res[name] = (down, up)
+    return res
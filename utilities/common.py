@@ -3,6 +3,7 @@ import pathlib
 import argparse
 import numpy as np
 import os
+import glob
 from utilities import logging
 from enum import Enum
 import re
@@ -10,6 +11,7 @@ import re
 base_dir = f"{pathlib.Path(__file__).parent}/../"
 wremnants_dir = f"{pathlib.Path(__file__).parent}/../wremnants"
 data_dir =  f"{pathlib.Path(__file__).parent}/../wremnants-data/data/"
+theory_corr_cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "wremnants", "theory_corrections")
 
 BR_TAUToMU = 0.1739
 BR_TAUToE = 0.1782
@@ -126,27 +128,86 @@ def set_parser_default(parser, argument, newDefault):
         logger.warning(f" Parser argument {argument} not found!")
     return parser
 
-def base_parser():
-    parser = argparse.ArgumentParser()
+def parse_shard(value):
+    # shard given as 'i/N', with 0 <= i < N
+    try:
+        ishard, nshards = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected 'i/N'")
+    if nshards < 1 or ishard < 0 or ishard >= nshards:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected 0 <= i < N")
+    return (ishard, nshards)
+
+def valid_theory_corrections():
+    corr_files = glob.glob(data_dir+"TheoryCorrections/*Corr*.pkl.lz4")
+    matches = [re.match("(^.*)Corr[W|Z]\.pkl\.lz4", os.path.basename(c)) for c in corr_files]
+    return [m[1] for m in matches if m]+["none"]
+
+def valid_ew_theory_corrections():
+    corr_files = glob.glob(data_dir+"TheoryCorrections/*ew*Corr*.pkl.lz4")
+    matches = [re.match("(^.*)Corr[W|Z]\.pkl\.lz4", os.path.basename(c)) for c in corr_files]
+    return [m[1] for m in matches if m]+["none"]
+
+def pdf_choices():
+    from wremnants import theory_tools
+    return list(theory_tools.pdfMap.keys())
+
+class LazyChoices(object):
+    # choices of an argument computed on first use (checking a value or printing the help),
+    # the argument needs a metavar, otherwise argparse iterates over the choices when adding it
+    def __init__(self, func):
+        self.func = func
+        self.values = None
+
+    def get(self):
+        if self.values is None:
+            self.values = self.func()
+        return self.values
+
+    def __contains__(self, value):
+        return value in self.get()
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __len__(self):
+        return len(self.get())
+
+root_initialized = False
+
+def init_root(nThreads):
+    # implicit multithreading and compilation of the headers used in the column definitions,
+    # only done once the arguments are parsed such that --help or argument errors do not pay for it
+    global root_initialized
+    if root_initialized:
+        return
+    import ROOT
+    ROOT.ROOT.EnableImplicitMT(max(0,nThreads))
+    from wremnants import headers
+    headers.declare_registered()
+    root_initialized = True
+
+class HistmakerParser(argparse.ArgumentParser):
+    def parse_args(self, args=None, namespace=None):
+        args = super().parse_args(args, namespace)
+        init_root(args.nThreads)
+        return args
+
+def base_parser(parser_class=argparse.ArgumentParser):
+    parser = parser_class()
     parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4],
                         help="Set verbosity level with logging, the larger the more verbose")
     parser.add_argument("--noColorLogger", action="store_true", help="Do not use logging with colors")
     return parser
 
 def common_parser(for_reco_highPU=False):
-    parser = base_parser()
+    parser = base_parser(HistmakerParser)
     parser.add_argument("-j", "--nThreads", type=int, default=0, help="number of threads (0 or negative values use all available threads)")
     initargs,_ = parser.parse_known_args()
 
     # initName for this internal logger is needed to avoid conflicts with the main logger named "wremnants" by default,
     # otherwise the logger is apparently propagated back to the root logger causing each following message to be printed twice 
     common_logger = logging.setup_logger(__file__, initargs.verbose, initargs.noColorLogger, initName="common_logger_wremnants")
-    
-    import ROOT
-    ROOT.ROOT.EnableImplicitMT(max(0,initargs.nThreads))
-    import narf
-    import wremnants
-    from wremnants import theory_corrections,theory_tools
 
     class PDFFilterAction(argparse.Action):
         def __call__(self, parser, namespace, values, option_string=None):
@@ -163,7 +224,7 @@ def common_parser(for_reco_highPU=False):
             setattr(namespace, self.dest, filtered_values)
 
     parser.add_argument("--pdfs", type=str, nargs="*", default=["ct18z", "msht20mcrange_renorm", "msht20mbrange_renorm"], 
-        choices=theory_tools.pdfMap.keys(), help="PDF sets to produce error hists for. If empty, use PDF set used in production (weight=1).", action=PDFFilterAction)
+        choices=LazyChoices(pdf_choices), metavar="PDF", help="PDF sets to produce error hists for. If empty, use PDF set used in production (weight=1).", action=PDFFilterAction)
     parser.add_argument("--altPdfOnlyCentral", action='store_true', help="Only store central value for alternate PDF sets")
     parser.add_argument("--maxFiles", type=int, help="Max number of files (per dataset)", default=None)
     parser.add_argument("--filterProcs", type=str, nargs="*", help="Only run over processes matched by group name or (subset) of name", default=[])
@@ -171,12 +232,14 @@ def common_parser(for_reco_highPU=False):
     parser.add_argument("-p", "--postfix", type=str, help="Postfix for output file name", default=None)
     parser.add_argument("--forceDefaultName", action='store_true', help="Don't modify the name of the output file with some default strings")
     parser.add_argument("--theoryCorr", nargs="*", type=str, action=NoneFilterAction,
-        default=["scetlib_dyturbo", ], choices=theory_corrections.valid_theory_corrections(), 
+        default=["scetlib_dyturbo", ], choices=LazyChoices(valid_theory_corrections), metavar="CORR", 
         help="Apply corrections from indicated generator. First will be nominal correction.")
     parser.add_argument("--theoryCorrAltOnly", action='store_true', help="Save hist for correction hists but don't modify central weight")
-    parser.add_argument("--ewTheoryCorr", nargs="*", type=str, action=NoneFilterAction, choices=theory_corrections.valid_ew_theory_corrections(), 
+    parser.add_argument("--ewTheoryCorr", nargs="*", type=str, action=NoneFilterAction, choices=LazyChoices(valid_ew_theory_corrections), metavar="CORR", 
         default=["winhacnloew", "virtual_ew_wlike", "pythiaew_ISR", "horaceqedew_FSR", "horacelophotosmecoffew_FSR", ],
         help="Add EW theory corrections without modifying the default theoryCorr list. Will be appended to args.theoryCorr")
+    parser.add_argument("--theoryCorrCacheDir", type=str, default=theory_corr_cache_dir, help="Directory where the post-processed theory correction histograms are cached "
+        "(invalidated when the correction file changes), empty to disable the cache")
     parser.add_argument("--skipHelicity", action='store_true', help="Skip the qcdScaleByHelicity histogram (it can be huge)")
     parser.add_argument("--eta", nargs=3, type=float, help="Eta binning as 'nbins min max' (only uniform for now)", default=[48,-2.4,2.4])
     parser.add_argument("--pt", nargs=3, type=float, help="Pt binning as 'nbins,min,max' (only uniform for now)", default=[30,26.,56.])
@@ -185,12 +248,28 @@ def common_parser(for_reco_highPU=False):
     parser.add_argument("--recoilUnc", action='store_true', help="Run the recoil calibration with uncertainties (slower)")
     parser.add_argument("--highptscales", action='store_true', help="Apply highptscales option in MiNNLO for better description of data at high pT")
     parser.add_argument("--dataPath", type=str, default=None, help="Access samples from this path (default reads from local machine), for eos use 'root://eoscms.cern.ch//store/cmst3/group/wmass/w-mass-13TeV/NanoAOD/'")
+    parser.add_argument("--refreshFileLists", action='store_true', help="List the files of the datasets again instead of using the file list cache stored in the output folder")
+    parser.add_argument("--fileListTTL", type=float, default=24, help="Time in hours after which cached file lists are listed again (negative for no expiry)")
+    parser.add_argument("--balanceWork", action='store_true', help="Scan the number of entries of the input files (cached in the output folder) and start the largest datasets and files first to balance the work between the threads")
     parser.add_argument("--noVertexWeight", action='store_true', help="Do not apply reweighting of vertex z distribution in MC to match data")
     parser.add_argument("--validationHists", action='store_true', help="make histograms used only for validations")
     parser.add_argument("--onlyMainHistograms", action='store_true', help="Only produce some histograms, skipping (most) systematics to run faster when those are not needed")
     parser.add_argument("--met", type=str, choices=["DeepMETReso", "RawPFMET"], help="MET (DeepMETReso or RawPFMET)", default="DeepMETReso")
     parser.add_argument("-o", "--outfolder", type=str, default="", help="Output folder")
     parser.add_argument("--appendOutputFile", type=str, default="", help="Append analysis output to specified output file")
+    parser.add_argument("--incremental", action="store_true", help="Reuse the results of the existing output file for datasets whose input files, relevant arguments, "
+        "C++ helpers and correction files did not change, and only process the others")
+    parser.add_argument("--memoryBudget", type=float, default=None, help="Abort before the event loop if the estimated memory of the booked histograms (in GB, including one copy per thread) exceeds this value")
+    parser.add_argument("--profileColumns", action="store_true", help="Time each column definition of the graphs (per thread) and store the cumulative time per column and helper in the output metadata")
+    parser.add_argument("--skimDir", type=str, default=None, help="Directory of skims with the events passing the trigger and muon selection; "
+        "datasets with a skim matching the selection arguments and input files are read from it, the others are skimmed in the same run")
+    parser.add_argument("--skimColumns", type=str, nargs="*", default=None, help="Regular expressions of the input columns kept in the skims (default: the collections read by the histmakers)")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Process only the i-th of N deterministic partitions of the files of each dataset, given as 'i/N' (0 <= i < N). "
+        "Scaling to data and aggregation of groups is then done when merging the outputs with scripts/utilities/merge_shards.py")
+    parser.add_argument("--histStorage", type=str, default="pickle", choices=["pickle", "sliceable"], help="Storage format of the histograms in the output file, 'sliceable' stores values and variances in chunked datasets that allow to read single entries or projections without loading the full histogram")
+    parser.add_argument("--systStorage", type=str, default="double", choices=["double", "float32"], help="Precision of the stored variation histograms "
+        "(histograms named <nominal>_<syst> with the axes of the nominal histogram followed by the variation axes), nominal histograms are always stored in double precision. "
+        "Reduced precision implies the sliceable format for these histograms, use scripts/utilities/validate_syst_storage.py to check the effect on the logk")
     parser.add_argument("-e", "--era", type=str, choices=["2016PreVFP","2016PostVFP", "2017", "2018"], help="Data set to process", default="2016PostVFP")
     parser.add_argument("--scale_A", default=1.0, type=float, help="scaling of the uncertainty on the b-field scale parameter A")
     parser.add_argument("--scale_e", default=1.0, type=float, help="scaling of the uncertainty on the material scale parameter e")
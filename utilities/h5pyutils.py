@@ -1,7 +1,40 @@
 import numpy as np
 import math
+import hdf5plugin # registers the blosc/zstd/lz4 filters, needed both for writing and reading
 
-def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2):    
+# available compression codecs for the tensors written with writeFlatInChunks
+compression_codecs = ["gzip", "lzf", "blosc-lz4", "blosc-zstd", "zstd", "lz4", "none"]
+
+def compressionArgs(compression="gzip"):
+    # keyword arguments for h5py create_dataset for the given codec
+    if compression in [None, "none"]:
+        return {}
+    elif compression in ["gzip", "lzf"]:
+        return {"compression" : compression}
+    elif compression == "blosc-lz4":
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    elif compression == "blosc-zstd":
+        return dict(hdf5plugin.Blosc(cname="zstd", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    elif compression == "zstd":
+        return dict(hdf5plugin.Zstd())
+    elif compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    else:
+        raise ValueError(f"Unknown compression codec {compression}, valid choices are {compression_codecs}")
+
+def chunkSizeFlat(shape, esize, maxChunkBytes):
+    # number of elements per chunk of the flattened array,
+    # chunks are aligned to the trailing dimensions of the original shape (e.g. [nproc, 2, nsyst] for logk) if they fit
+    size = int(np.prod(shape))
+    maxelems = max(1,math.floor(maxChunkBytes/esize))
+    for idim in range(1, len(shape)):
+        rowsize = int(np.prod(shape[idim:]))
+        if rowsize > 0 and rowsize <= maxelems:
+            maxelems = (maxelems//rowsize)*rowsize
+            break
+    return int(min(size,maxelems))
+
+def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2, compression = "gzip"):
     arrflat = arr.reshape(-1)
 
     esize = np.dtype(arrflat.dtype).itemsize
@@ -11,13 +44,13 @@ def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2):
     if arrflat.size == 0:
         chunksize = 1
         chunks = None
-        compression = None
+        compression_args = {}
     else:
-        chunksize = int(min(arrflat.size,max(1,math.floor(maxChunkBytes/esize))))
+        chunksize = chunkSizeFlat(arr.shape, esize, maxChunkBytes)
         chunks = (chunksize,)
-        compression = "gzip"
+        compression_args = compressionArgs(compression)
 
-    h5dset = h5group.create_dataset(outname, arrflat.shape, chunks=chunks, dtype=arrflat.dtype, compression=compression)
+    h5dset = h5group.create_dataset(outname, arrflat.shape, chunks=chunks, dtype=arrflat.dtype, **compression_args)
 
     #write in chunks, preserving sparsity if relevant
     for ielem in range(0,arrflat.size,chunksize):
@@ -29,12 +62,50 @@ def writeFlatInChunks(arr, h5group, outname, maxChunkBytes = 1024**2):
 
     return nbytes
 
-def writeSparse(indices, values, dense_shape, h5group, outname, maxChunkBytes = 1024**2):
+def createFlatInChunks(shape, dtype, h5group, outname, maxChunkBytes = 1024**2, compression = "gzip"):
+    # create an empty flat dataset of the final size, to be filled incrementally in slices
+    size = int(np.prod(shape))
+    esize = np.dtype(dtype).itemsize
+
+    #special handling for empty datasets, which should not use chunked storage or compression
+    if size == 0:
+        chunks = None
+        compression_args = {}
+    else:
+        chunks = (chunkSizeFlat(shape, esize, maxChunkBytes),)
+        compression_args = compressionArgs(compression)
+
+    h5dset = h5group.create_dataset(outname, (size,), chunks=chunks, dtype=dtype, **compression_args)
+    h5dset.attrs['original_shape'] = np.array(shape,dtype='int64')
+
+    return h5dset
+
+def readFlatInChunks(h5dset):
+    # read a dataset written with writeFlatInChunks back in its original shape, chunk by chunk
+    arrflat = np.zeros(h5dset.shape, dtype=h5dset.dtype)
+    chunksize = h5dset.chunks[0] if h5dset.chunks else max(1, h5dset.size)
+    for ielem in range(0, h5dset.size, chunksize):
+        h5dset.read_direct(arrflat, np.s_[ielem:ielem+chunksize], np.s_[ielem:ielem+chunksize])
+    shape = h5dset.attrs['original_shape'] if 'original_shape' in h5dset.attrs else h5dset.shape
+    return arrflat.reshape(shape)
+
+def writeSparse(indices, values, dense_shape, h5group, outname, maxChunkBytes = 1024**2, compression = "gzip"):
     outgroup = h5group.create_group(outname)
 
     nbytes = 0
-    nbytes += writeFlatInChunks(indices, outgroup, "indices", maxChunkBytes)
-    nbytes += writeFlatInChunks(values, outgroup, "values", maxChunkBytes)
+    nbytes += writeFlatInChunks(indices, outgroup, "indices", maxChunkBytes, compression)
+    nbytes += writeFlatInChunks(values, outgroup, "values", maxChunkBytes, compression)
+    outgroup.attrs['dense_shape'] = np.array(dense_shape, dtype='int64')
+
+    return nbytes
+
+def createSparse(nvalues, dense_shape, idxdtype, dtype, h5group, outname, maxChunkBytes = 1024**2, compression = "gzip"):
+    # create pre-sized sparse tensor datasets with the same layout as writeSparse,
+    # indices and values are then written in slices in canonical order
+    outgroup = h5group.create_group(outname)
+
+    indices = createFlatInChunks((nvalues, len(dense_shape)), idxdtype, outgroup, "indices", maxChunkBytes, compression)
+    values = createFlatInChunks((nvalues,), dtype, outgroup, "values", maxChunkBytes, compression)
     outgroup.attrs['dense_shape'] = np.array(dense_shape, dtype='int64')
 
-    return nbytes
\ No newline at end of file
+    return indices, values
@@ -0,0 +1,121 @@
+import argparse
+import hashlib
+import functools
+import logging as pylogging
+import types
+import os
+import re
+import numpy as np
+import hist
+
+# helpers to compute stable digests of configuration objects and input files, used as keys for on-disk caches
+
+class UnhashableError(TypeError):
+    # raised for objects whose content can not be hashed, the caller should not cache results depending on them
+    pass
+
+def update_hash(m, obj, seen=None):
+    # feed a (possibly nested) object into the hash object m in a deterministic way
+    if seen is None:
+        seen = set()
+    m.update(type(obj).__name__.encode())
+    if obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        m.update(repr(obj).encode())
+        return
+    elif isinstance(obj, bytes):
+        m.update(obj)
+        return
+    elif isinstance(obj, np.ndarray):
+        m.update(str(obj.dtype).encode())
+        m.update(repr(obj.shape).encode())
+        m.update(np.ascontiguousarray(obj).tobytes() if obj.dtype != object else repr(obj.tolist()).encode())
+        return
+    elif isinstance(obj, np.generic):
+        m.update(repr(obj.item()).encode())
+        return
+    elif isinstance(obj, re.Pattern):
+        m.update(obj.pattern.encode())
+        return
+    elif isinstance(obj, (types.ModuleType, type)):
+        # modules and classes are identified by their name, the code they contain is not followed
+        m.update(getattr(obj, "__qualname__", obj.__name__).encode())
+        m.update(str(getattr(obj, "__module__", "")).encode())
+        return
+    elif isinstance(obj, pylogging.Logger):
+        m.update(obj.name.encode())
+        return
+    elif isinstance(obj, types.BuiltinFunctionType):
+        m.update(f"{obj.__module__}.{obj.__qualname__}".encode())
+        return
+
+    # containers and functions can reference themselves
+    if id(obj) in seen:
+        m.update(b"<cycle>")
+        return
+    seen = seen | {id(obj)}
+
+    if isinstance(obj, dict):
+        for k in sorted(obj.keys(), key=repr):
+            update_hash(m, k, seen)
+            update_hash(m, obj[k], seen)
+    elif isinstance(obj, (list, tuple)):
+        m.update(str(len(obj)).encode())
+        for x in obj:
+            update_hash(m, x, seen)
+    elif isinstance(obj, (set, frozenset)):
+        for x in sorted(obj, key=repr):
+            update_hash(m, x, seen)
+    elif isinstance(obj, functools.partial):
+        update_hash(m, obj.func, seen)
+        update_hash(m, obj.args, seen)
+        update_hash(m, obj.keywords, seen)
+    elif isinstance(obj, types.FunctionType):
+        # functions are identified by their name and code, the values captured in closures are hashed as well
+        # but the state they read from global variables or attributes of other objects is not part of the digest
+        m.update(f"{obj.__module__}.{obj.__qualname__}".encode())
+        update_hash(m, obj.__code__, seen)
+        update_hash(m, obj.__defaults__, seen)
+        update_hash(m, obj.__kwdefaults__, seen)
+        if obj.__closure__:
+            for cell in obj.__closure__:
+                try:
+                    contents = cell.cell_contents
+                except ValueError:
+                    # empty cell
+                    continue
+                update_hash(m, contents, seen)
+    elif isinstance(obj, types.CodeType):
+        m.update(obj.co_code)
+        update_hash(m, obj.co_names, seen)
+        update_hash(m, obj.co_consts, seen)
+    elif isinstance(obj, hist.Hist):
+        update_hash(m, [repr(ax) for ax in obj.axes], seen)
+        update_hash(m, obj.values(flow=True), seen)
+        if obj.storage_type == hist.storage.Weight:
+            update_hash(m, obj.variances(flow=True), seen)
+    elif isinstance(obj, argparse.Namespace):
+        # parsed arguments (e.g. captured in closures) are identified by their values
+        update_hash(m, vars(obj), seen)
+    else:
+        # other objects (e.g. bound methods, or closures capturing them) are not followed,
+        # the configuration they depend on has to be given explicitly
+        raise UnhashableError(f"Can not compute a content hash of object of type {type(obj).__module__}.{type(obj).__qualname__}")
+
+def hash_object(*objs):
+    m = hashlib.sha256()
+    for obj in objs:
+        update_hash(m, obj)
+    return m.hexdigest()
+
+def file_fingerprint(filename):
+    # identify a file by its location, size and modification time, which avoids reading (possibly very large) inputs
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+
+def hash_file(filename, blocksize=16*1024**2):
+    # digest of the full file content
+    m = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(functools.partial(f.read, blocksize), b""):
+            m.update(block)
+    return m.hexdigest()
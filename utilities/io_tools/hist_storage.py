@@ -0,0 +1,226 @@
+import pickle
+import numpy as np
+import hist
+import boost_histogram as bh
+from utilities import logging
+from utilities.h5pyutils import compressionArgs
+
+logger = logging.child_logger(__name__)
+
+# Sliceable on-disk storage of histograms: the axes are stored as metadata next to chunked datasets of the
+# values (and variances) including flow bins, such that single entries or projections can be read without
+# loading the full histogram
+
+supported_storages = [hist.storage.Double, hist.storage.Weight]
+
+# precision of the stored values and variances, histograms are always read back in double precision
+precisions = {"double" : np.float64, "float32" : np.float32}
+
+class HistRef(object):
+    # placeholder for a histogram stored in sliceable format, replaced by a LazyHist when loading the results
+    def __init__(self, path):
+        self.path = path
+
+class PickledRef(object):
+    # placeholder for an object pickled into its own dataset, replaced by a PickledProxy when loading the results
+    def __init__(self, path):
+        self.path = path
+
+class PickledProxy(object):
+    # object pickled into its own dataset (written with write_pickled), with the interface of narf.ioutils.H5PickleProxy
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.obj = None
+
+    def get(self):
+        if self.obj is None:
+            self.obj = pickle.loads(self.dataset[()].tobytes())
+        return self.obj
+
+    def release(self):
+        self.obj = None
+
+    def __reduce__(self):
+        # stored as a regular proxy when the results are pickled again
+        from narf.ioutils import H5PickleProxy
+        return (H5PickleProxy, (self.get(),))
+
+def write_pickled(obj, h5group, name, compression="gzip"):
+    data = np.frombuffer(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+    h5group.create_dataset(name, data=data, **compressionArgs(compression))
+    return data.nbytes
+
+def is_sliceable(h):
+    return isinstance(h, hist.Hist) and h.storage_type in supported_storages
+
+def chunkShape(shape, esize, maxChunkBytes):
+    # chunks cover the full range of the leading axes and single entries of the trailing axes
+    # (usually the systematic axes) as long as needed to respect the maximum chunk size
+    chunks = list(shape)
+    for idim in reversed(range(len(shape))):
+        if np.prod(chunks)*esize <= maxChunkBytes:
+            break
+        chunks[idim] = 1
+    if np.prod(chunks)*esize > maxChunkBytes:
+        chunks[0] = max(1, int(maxChunkBytes // (esize*np.prod(chunks[1:]))))
+    return tuple(max(1, int(c)) for c in chunks)
+
+def variation_base(name, h, hists):
+    # name of the histogram of which h is a variation, i.e. a histogram {base}_{syst} with the axes of the base followed
+    # by the variation axes (as booked with tensor_axes), or None for nominal histograms
+    for base in sorted(hists.keys(), key=len, reverse=True):
+        if base == name or not name.startswith(f"{base}_"):
+            continue
+        base_axes = hists[base].axes
+        if len(h.axes) > len(base_axes) and list(h.axes.name[:len(base_axes)]) == list(base_axes.name):
+            return base
+    return None
+
+def write_hist(h, h5group, name, maxChunkBytes=1024**2, compression="gzip", precision="double"):
+    if not is_sliceable(h):
+        raise ValueError(f"Histogram {name} with storage {h.storage_type} can not be written in sliceable format")
+
+    outgroup = h5group.create_group(name)
+    outgroup.attrs["axes"] = np.void(pickle.dumps(list(h.axes), protocol=pickle.HIGHEST_PROTOCOL))
+    outgroup.attrs["storage"] = h.storage_type.__name__
+    outgroup.attrs["precision"] = precision
+
+    view = h.view(flow=True)
+    arrays = {"values" : view} if h.storage_type == hist.storage.Double else {"values" : view.value, "variances" : view.variance}
+    nbytes = 0
+    for dname, arr in arrays.items():
+        arr = np.ascontiguousarray(arr, dtype=precisions[precision])
+        if arr.size == 0:
+            outgroup.create_dataset(dname, data=arr)
+        else:
+            chunks = chunkShape(arr.shape, arr.dtype.itemsize, maxChunkBytes)
+            outgroup.create_dataset(dname, data=arr, chunks=chunks, **compressionArgs(compression))
+        nbytes += arr.nbytes
+
+    return nbytes
+
+def make_hist(axes, storage_type, values, variances=None):
+    h = hist.Hist(*axes, storage=storage_type())
+    if storage_type == hist.storage.Double:
+        h.view(flow=True)[...] = values
+    else:
+        view = h.view(flow=True)
+        view.value = values
+        view.variance = variances
+    return h
+
+class LazyHist(object):
+    # histogram backed by a group written with write_hist, data is only read when requested
+    def __init__(self, h5group):
+        self.h5group = h5group
+        self.axes = hist.axis.NamedAxesTuple(pickle.loads(h5group.attrs["axes"].tobytes()))
+        self.storage_type = getattr(hist.storage, h5group.attrs["storage"])
+        self.datasets = ["values"] if self.storage_type == hist.storage.Double else ["values", "variances"]
+
+    @property
+    def ndim(self):
+        return len(self.axes)
+
+    def __repr__(self):
+        return f"LazyHist({', '.join(repr(ax) for ax in self.axes)}, storage={self.storage_type.__name__}()) at {self.h5group.name}"
+
+    def read(self, selection=()):
+        return [self.h5group[dname][selection] for dname in self.datasets]
+
+    def get(self):
+        return make_hist(self.axes, self.storage_type, *self.read())
+
+    def release(self):
+        # nothing is kept in memory
+        pass
+
+    def __reduce__(self):
+        # stored as a regular proxy when the results are pickled again
+        from narf.ioutils import H5PickleProxy
+        return (H5PickleProxy, (self.get(),))
+
+    def flow_index(self, axis, idx):
+        # index in the storage including flow bins for an index that removes the axis, or None if not supported
+        if isinstance(idx, bh.tag.Locator):
+            idx = idx(axis)
+        elif isinstance(idx, complex):
+            idx = axis.index(idx.imag)
+        elif isinstance(idx, str):
+            idx = axis.index(idx)
+        elif isinstance(idx, (int, np.integer)) and not isinstance(idx, bool):
+            idx = int(idx)
+            if idx < 0:
+                idx += axis.size
+            if idx < 0 or idx >= axis.size:
+                raise IndexError(f"Index {idx} out of range for axis {axis.name} with {axis.size} bins")
+        else:
+            return None
+
+        underflow = int(axis.traits.underflow)
+        if (idx < 0 and not underflow) or (idx >= axis.size and not axis.traits.overflow):
+            raise IndexError(f"Index {idx} out of range for axis {axis.name} without flow bins")
+        return idx + underflow
+
+    def __getitem__(self, selection):
+        if not isinstance(selection, dict):
+            return self.get()[selection]
+
+        # read only the hyperslab of the axes with fixed entries, remaining selections (slices, rebinning, sums)
+        # are applied afterwards on the reduced histogram in memory
+        slab = [slice(None)]*self.ndim
+        remaining = {}
+        for key, idx in selection.items():
+            iax = self.axes.name.index(key) if isinstance(key, str) else key
+            flow_idx = self.flow_index(self.axes[iax], idx)
+            if flow_idx is None:
+                remaining[self.axes[iax].name] = idx
+            else:
+                slab[iax] = flow_idx
+
+        axes = [ax for ax, s in zip(self.axes, slab) if isinstance(s, slice)]
+        h = make_hist(axes, self.storage_type, *self.read(tuple(slab)))
+        return h[remaining] if remaining else h
+
+    def project(self, *args, maxBlockBytes=256*1024**2):
+        # sum over the axes not in args, reading blocks along the first axis to limit the memory
+        iaxes = [self.axes.name.index(a) if isinstance(a, str) else a for a in args]
+        sum_axes = tuple(i for i in range(self.ndim) if i not in iaxes)
+        kept = sorted(iaxes)
+
+        dsets = [self.h5group[dname] for dname in self.datasets]
+        shape = dsets[0].shape
+        rowbytes = max(1, int(np.prod(shape[1:]))*dsets[0].dtype.itemsize)
+        nrows = max(1, maxBlockBytes // rowbytes)
+        if dsets[0].chunks:
+            nrows = max(dsets[0].chunks[0], (nrows // dsets[0].chunks[0])*dsets[0].chunks[0])
+
+        # sums are done in double precision also for histograms stored with reduced precision
+        outputs = [np.zeros([shape[i] for i in kept], dtype=np.result_type(d.dtype, np.float64)) for d in dsets]
+        for irow in range(0, shape[0], nrows):
+            for dset, out in zip(dsets, outputs):
+                block = dset[irow:irow+nrows].sum(axis=sum_axes, dtype=out.dtype)
+                if 0 in kept:
+                    out[irow:irow+nrows] += block
+                else:
+                    out += block
+
+        # order the output axes as requested
+        order = [kept.index(i) for i in iaxes]
+        outputs = [np.transpose(out, order) for out in outputs]
+        return make_hist([self.axes[i] for i in iaxes], self.storage_type, *outputs)
+
+# objects read from the file on request, in addition to narf.ioutils.H5PickleProxy
+lazy_types = (LazyHist, PickledProxy)
+
+def resolve_refs(results, h5file):
+    # replace the references to histograms in sliceable format and to separately pickled objects
+    # by lazy objects reading from the file
+    for res in results.values():
+        if not isinstance(res, dict) or "output" not in res:
+            continue
+        for name, h in res["output"].items():
+            if isinstance(h, HistRef):
+                res["output"][name] = LazyHist(h5file[h.path])
+            elif isinstance(h, PickledRef):
+                res["output"][name] = PickledProxy(h5file[h.path])
+    return results
@@ -8,6 +8,7 @@ import json
 import hdf5plugin
 import h5py
 from narf import ioutils
+from utilities.io_tools import hist_storage
 import ROOT
 import uproot
 import re
@@ -16,11 +17,26 @@ logger = logging.child_logger(__name__)
 
 scetlib_tnp_match_expr = ["^gamma_.*[+|-]\d+", "^b_.*[+|-]\d+", "^s[+|-]\d+", "^h_.*\d+"]
 
+# name of the json index with the metadata of the results, written next to the pickled results
+results_index_name = "results_index"
+# name of the group with the histograms in sliceable format
+sliceable_hists_name = "sliceable_hists"
+
 def load_results_h5py(h5file):
     if "results" in h5file.keys():
-        return ioutils.pickle_load_h5py(h5file["results"])
+        results = ioutils.pickle_load_h5py(h5file["results"])
     else:
-        return {k: ioutils.pickle_load_h5py(v) for k,v in h5file.items()}
+        results = {k: ioutils.pickle_load_h5py(v) for k,v in h5file.items() if k not in [results_index_name, sliceable_hists_name]}
+    return hist_storage.resolve_refs(results, h5file)
+
+def load_results_index(h5file):
+    # metadata index of the results, None for files written before the index was introduced
+    if results_index_name not in h5file.keys():
+        return None
+    index = h5file[results_index_name][()]
+    if isinstance(index, bytes):
+        index = index.decode()
+    return json.loads(index)
 
 def read_and_scale_pkllz4(fname, proc, histname, calculate_lumi=False, scale=1):
     with lz4.frame.open(fname) as f:
@@ -30,26 +46,39 @@ def read_and_scale_pkllz4(fname, proc, histname, calculate_lumi=False, scale=1):
 
 def read_hist_names(fname, proc):
     with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
+        index = load_results_index(h5file)
+        results = index["processes"] if index is not None else load_results_h5py(h5file)
         if proc not in results:
             raise ValueError(f"Invalid process {proc}! No output found in file {fname}")
-        return results[proc]["output"].keys()
+        return results[proc]["hists"].keys() if index is not None else results[proc]["output"].keys()
 
 def read_keys(fname):
     with h5py.File(fname, "r") as h5file:
+        index = load_results_index(h5file)
+        if index is not None:
+            return list(index["keys"])
         results = load_results_h5py(h5file)
-        return results.keys()
+        return list(results.keys())
 
 def read_xsec(fname, proc):
     with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
+        index = load_results_index(h5file)
+        results = index["processes"] if index is not None else load_results_h5py(h5file)
         return results[proc]["dataset"]["xsec"]
 
 def read_sumw(fname, proc):
     with h5py.File(fname, "r") as h5file:
-        results = load_results_h5py(h5file)
+        index = load_results_index(h5file)
+        results = index["processes"] if index is not None else load_results_h5py(h5file)
         return results[proc]["weight_sum"]
 
+def read_lumi(fname):
+    # integrated luminosity of the data processes in /fb
+    with h5py.File(fname, "r") as h5file:
+        index = load_results_index(h5file)
+        results = index["processes"] if index is not None else load_results_h5py(h5file)
+        return sum([r.get("lumi", 0) for r in results.values() if isinstance(r, dict) and "dataset" in r and r["dataset"].get("is_data", False)])
+
 def read_and_scale(fname, proc, histname, calculate_lumi=False, scale=1, apply_xsec=True):
     with h5py.File(fname, "r") as h5file:
         results = load_results_h5py(h5file)
@@ -58,7 +87,7 @@ def read_and_scale(fname, proc, histname, calculate_lumi=False, scale=1, apply_x
 
 def load_and_scale(res_dict, proc, histname, calculate_lumi=False, scale=1., apply_xsec=True):
     h = res_dict[proc]["output"][histname]
-    if isinstance(h, ioutils.H5PickleProxy):
+    if isinstance(h, (ioutils.H5PickleProxy, *hist_storage.lazy_types)):
         h = h.get()
     if not res_dict[proc]["dataset"]["is_data"]:
         if apply_xsec:
@@ -0,0 +1,197 @@
+import copy
+import json
+import h5py
+import narf
+from utilities import logging
+from utilities.io_tools import input_tools, output_tools, hist_storage
+
+logger = logging.child_logger(__name__)
+
+# Streaming merging of histmaker output files. Results are either copied at the hdf5 level without unpickling,
+# or summed histogram by histogram such that only one histogram per input is held in memory at a time
+
+class ResultsFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.h5file = h5py.File(filename, "r")
+        # the pickled results are loaded lazily, histograms are only read on request
+        self.results = input_tools.load_results_h5py(self.h5file)
+        self.index = input_tools.load_results_index(self.h5file)
+
+    def keys(self):
+        return self.results.keys()
+
+    def has_group(self, key):
+        # results written per process (as in write_analysis_output) can be copied without unpickling
+        return "results" not in self.h5file.keys() and key in self.h5file.keys()
+
+    def process_index(self, key):
+        if self.index is None:
+            return None
+        return self.index["processes"].get(key)
+
+    def close(self):
+        self.h5file.close()
+
+def release(obj):
+    if isinstance(obj, (narf.ioutils.H5PickleProxy, *hist_storage.lazy_types)):
+        obj.release()
+
+def copy_result(infile, key, h5out, outkey=None):
+    # copy the result of a single process to the output file
+    outkey = key if outkey is None else outkey
+    if infile.has_group(key) and outkey == key:
+        logger.debug(f"Copy {key} from {infile.filename}")
+        infile.h5file.copy(infile.h5file[key], h5out, name=key, expand_refs=True)
+        sliceable = infile.h5file.get(f"{input_tools.sliceable_hists_name}/{key}")
+        if sliceable is not None:
+            group = h5out.require_group(input_tools.sliceable_hists_name)
+            infile.h5file.copy(sliceable, group, name=key)
+        return infile.process_index(key)
+
+    # results that are stored in a single object have to be unpickled
+    result = infile.results[key]
+    logger.debug(f"Unpickle and dump {key} from {infile.filename}")
+    narf.ioutils.pickle_dump_h5py(outkey, result, h5out)
+    # the stored index is used if there is one, otherwise it is made from the histograms loaded to write them
+    index = infile.process_index(key)
+    if index is None and isinstance(result, dict) and "dataset" in result:
+        index = output_tools.make_process_index(result)
+    if isinstance(result, dict):
+        for h in result.get("output", {}).values():
+            release(h)
+    return index
+
+def merge_metadata(results):
+    # metadata of the same process from several split jobs
+    merged = {k : copy.deepcopy(v) for k, v in results[0].items() if k != "output"}
+    for result in results[1:]:
+        if result["dataset"].get("xsec") != merged["dataset"].get("xsec"):
+            logger.warning(f"Inconsistent cross sections {result['dataset'].get('xsec')} and {merged['dataset'].get('xsec')} for {merged['dataset'].get('name')}")
+        if "filepaths" in merged["dataset"]:
+            merged["dataset"]["filepaths"] = merged["dataset"]["filepaths"] + result["dataset"].get("filepaths", [])
+        for key in ["weight_sum", "event_count", "lumi"]:
+            if key in merged:
+                if key not in result:
+                    raise ValueError(f"Entry '{key}' of {merged['dataset'].get('name')} is missing in some of the inputs, they can not be summed")
+                merged[key] = merged[key] + result[key]
+    return merged
+
+def sum_outputs(entries, h5out, outkey, metadata, sliceable=False, refs=False):
+    # sum the outputs of (result, scale) entries histogram by histogram and write them with the given metadata,
+    # by default the sums of a process are kept until the result is pickled as usual, with refs (or sliceable)
+    # each sum is written to the file once it is complete (in sliceable format if requested, otherwise pickled)
+    # and only a reference is kept, such that only one summed histogram is held in memory,
+    # files with references can only be read with input_tools.load_results_h5py
+    hist_names = []
+    for result, scale in entries:
+        hist_names += [h_name for h_name in result.get("output", {}).keys() if h_name not in hist_names]
+
+    refs = refs or sliceable
+    if refs:
+        group = h5out.require_group(input_tools.sliceable_hists_name)
+        if outkey in group:
+            del group[outkey]
+        group = group.create_group(outkey)
+
+    output = {}
+    hists_index = {}
+    for h_name in hist_names:
+        logger.debug(f"Sum {h_name} for {outkey}")
+        hsum = None
+        nentries = 0
+        for result, scale in entries:
+            if h_name not in result["output"]:
+                continue
+            h = result["output"][h_name]
+            hread = h.get()
+            release(h)
+            if hsum is None:
+                # the read histogram may still be referenced by its input, the sum is accumulated in a new one
+                hsum = hread.copy() if scale == 1 else hread*scale
+            else:
+                hsum += hread if scale == 1 else scale*hread
+            hread = None
+            nentries += 1
+
+        if nentries != len(entries):
+            logger.warning(f"Histogram {h_name} is only present in {nentries} of {len(entries)} inputs for {outkey}")
+
+        hists_index[h_name] = output_tools.make_hist_index(hsum)
+        if not refs:
+            output[h_name] = narf.ioutils.H5PickleProxy(hsum)
+        elif sliceable and hist_storage.is_sliceable(hsum):
+            hist_storage.write_hist(hsum, group, h_name)
+            output[h_name] = hist_storage.HistRef(group[h_name].name)
+        else:
+            hist_storage.write_pickled(hsum, group, h_name)
+            output[h_name] = hist_storage.PickledRef(group[h_name].name)
+        hsum = None
+
+    result = {**metadata, "output" : output}
+    narf.ioutils.pickle_dump_h5py(outkey, result, h5out)
+    return output_tools.make_process_index(result, hists=hists_index)
+
+def merge_files(infiles, outfile, plan=None, sum_duplicates=False, sliceable=False, refs=False):
+    """
+    Merge the results of histmaker output files.
+    The plan maps the output keys to {"entries" : [(ResultsFile, key, scale), ...], "metadata" : dict or None}
+    and is a function of the opened files, by default each key of the inputs is copied, keys present in
+    several files are summed if sum_duplicates is set (e.g. for split jobs of the same process),
+    with refs or sliceable the summed histograms are written as they are complete (see sum_outputs)
+    """
+    files = [ResultsFile(f) for f in infiles]
+
+    meta_infos = {}
+    for i, infile in enumerate(files):
+        if "meta_info" in infile.keys():
+            meta_infos["meta_info" if not meta_infos else f"meta_info_{i}"] = (infile, "meta_info")
+
+    if plan is None:
+        outputs = {}
+        for infile in files:
+            for key in infile.keys():
+                if not key.startswith("meta_info"):
+                    outputs.setdefault(key, {"entries" : [], "metadata" : None})["entries"].append((infile, key, 1))
+        for key, output in outputs.items():
+            if len(output["entries"]) > 1 and not sum_duplicates:
+                raise NotImplementedError(f"The object with key {key} is present in several input files; use the option to sum them if they come from split jobs")
+    else:
+        outputs = plan(files)
+
+    index = {"keys" : [], "processes" : {}}
+    complete_index = True
+    with h5py.File(outfile, "w") as h5out:
+        for outkey, output in outputs.items():
+            logger.info(f"Now at {outkey}")
+            entries = output["entries"]
+            if len(entries) == 1 and entries[0][2] == 1 and output["metadata"] is None:
+                infile, key, scale = entries[0]
+                proc_index = copy_result(infile, key, h5out, outkey)
+            else:
+                results = [infile.results[key] for infile, key, scale in entries]
+                metadata = merge_metadata(results) if output["metadata"] is None else output["metadata"]
+                proc_index = sum_outputs([(result, scale) for result, (infile, key, scale) in zip(results, entries)], h5out, outkey, metadata, sliceable=sliceable, refs=refs)
+
+            index["keys"].append(outkey)
+            if proc_index is not None:
+                index["processes"][outkey] = proc_index
+            else:
+                complete_index = False
+
+        for outkey, (infile, key) in meta_infos.items():
+            if infile.has_group(key):
+                infile.h5file.copy(infile.h5file[key], h5out, name=outkey)
+            else:
+                narf.ioutils.pickle_dump_h5py(outkey, infile.results[key], h5out)
+            index["keys"].append(outkey)
+
+        if complete_index:
+            h5out.create_dataset(input_tools.results_index_name, data=json.dumps(index))
+        else:
+            logger.warning("Not all inputs have a results index, the output is written without it")
+
+    for f in files:
+        f.close()
+
+    logger.info(f"Merged results written into {outfile}")
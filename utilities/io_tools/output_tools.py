@@ -7,7 +7,9 @@ import hdf5plugin
 import h5py
 import narf
 import numpy as np
+import json
 from utilities import common, logging
+from utilities.io_tools import input_tools, hist_storage
 import glob
 import shutil
 import lz4.frame
@@ -49,9 +51,100 @@ def writeMetaInfoToRootFile(rtfile, exclude_diff='notebooks', args=None):
         out = ROOT.TNamed(str(key), str(value))
         out.Write()
 
-def write_analysis_output(results, outfile, args):
-    analysis_debug_output(results)
+def _to_json(x):
+    if isinstance(x, np.generic):
+        return x.item()
+    return str(x)
+
+def make_hist_index(h):
+    # metadata of a single histogram for the results index, from its axes without reading it,
+    # objects behind proxies are only described if they are loaded already
+    if isinstance(h, (narf.ioutils.H5PickleProxy, hist_storage.PickledProxy)):
+        if getattr(h, "obj", None) is None:
+            return {"type" : type(h).__name__}
+        h = h.obj
+    if not hasattr(h, "axes") or not hasattr(h, "storage_type"):
+        return {"type" : type(h).__name__}
+    if isinstance(h, hist_storage.LazyHist):
+        # read back in double precision
+        nbytes = int(np.prod([ax.extent for ax in h.axes]))*8*len(h.datasets)
+    else:
+        nbytes = h.view(flow=True).nbytes
+    return json.loads(json.dumps({
+        "type" : type(h).__name__,
+        "axes" : [{"name" : ax.name, "type" : type(ax).__name__, "size" : ax.size} for ax in h.axes],
+        "storage" : h.storage_type.__name__,
+        "nbytes" : nbytes,
+    }, default=_to_json))
+
+def make_process_index(result, hists=None):
+    # metadata of a process for the results index, the index of the histograms can be given if they are not in the result
+    if hists is None:
+        hists = {h_name : make_hist_index(h) for h_name, h in result.get("output", {}).items()}
+
+    dataset = result["dataset"]
+    index = {
+        "dataset" : {key : dataset.get(key) for key in ["name", "xsec", "is_data"] if key in dataset},
+        "weight_sum" : result.get("weight_sum"),
+        "event_count" : result.get("event_count"),
+        "hists" : hists,
+    }
+    if "lumi" in result:
+        index["lumi"] = result["lumi"]
+
+    return json.loads(json.dumps(index, default=_to_json))
+
+def make_results_index(results):
+    # lightweight metadata of the results that can be read without unpickling
+    processes = {k : make_process_index(v) for k, v in results.items() if isinstance(v, dict) and "dataset" in v}
+    return {"keys" : list(results.keys()), "processes" : processes}
+
+def write_results_index(h5file, new_index, processes=None):
+    # create or update the metadata index of the results in the file from the index made with make_results_index
+    # (before the results are written, while their histograms are in memory), the index of processes that are not
+    # in the results (e.g. copied from another file) can be given
+    index = input_tools.load_results_index(h5file)
+    if processes:
+        new_index["keys"] += [k for k in processes.keys() if k not in new_index["keys"]]
+        new_index["processes"].update(processes)
+    if index is None:
+        index = new_index
+    else:
+        index["keys"] += [k for k in new_index["keys"] if k not in index["keys"]]
+        index["processes"].update(new_index["processes"])
+        del h5file[input_tools.results_index_name]
 
+    if "meta_info" in h5file.keys() and "meta_info" not in index["keys"]:
+        index["keys"].append("meta_info")
+
+    h5file.create_dataset(input_tools.results_index_name, data=json.dumps(index))
+
+def write_sliceable_hists(h5file, proc, result, all_hists=True, systStorage="double"):
+    # write the histograms of a process in sliceable format and return a copy of the result with references to them,
+    # variations are written with the precision given by systStorage, if not all_hists only those are written
+    group = h5file.require_group(input_tools.sliceable_hists_name)
+    if proc in group:
+        del group[proc]
+    group = group.create_group(proc)
+
+    hists = {h_name : h.get() if isinstance(h, (narf.ioutils.H5PickleProxy, hist_storage.PickledProxy)) else h for h_name, h in result["output"].items()}
+    output = {}
+    for h_name, h in result["output"].items():
+        obj = hists[h_name]
+        precision = "double"
+        if systStorage != "double" and hist_storage.is_sliceable(obj) and hist_storage.variation_base(h_name, obj, hists) is not None:
+            precision = systStorage
+        if hist_storage.is_sliceable(obj) and (all_hists or precision != "double"):
+            logger.debug(f"Write {h_name} in sliceable format with {precision} precision")
+            hist_storage.write_hist(obj, group, h_name, precision=precision)
+            output[h_name] = hist_storage.HistRef(group[h_name].name)
+        else:
+            output[h_name] = h
+
+    return {**result, "output" : output}
+
+def analysis_output_path(outfile, args):
+    # full path of the analysis output, including the postfixes from the arguments
     to_append = []
     if args.theoryCorr and not args.theoryCorrAltOnly:
         to_append.append(args.theoryCorr[0]+"Corr")
@@ -68,6 +161,9 @@ def write_analysis_output(results, outfile, args):
     if args.postfix:
         outfile = outfile.replace(".hdf5", f"_{args.postfix}.hdf5")
 
+    if getattr(args, "shard", None):
+        outfile = outfile.replace(".hdf5", f"_shard{args.shard[0]}of{args.shard[1]}.hdf5")
+
     if args.outfolder:
         if not os.path.exists(args.outfolder):
             logger.info(f"Creating output folder {args.outfolder}")
@@ -76,6 +172,21 @@ def write_analysis_output(results, outfile, args):
 
     if args.appendOutputFile:
         outfile = args.appendOutputFile
+
+    return outfile
+
+def write_analysis_output(results, outfile, args, incremental=None):
+    analysis_debug_output(results)
+
+    outfile = analysis_output_path(outfile, args)
+
+    if incremental is not None:
+        incremental.set_fingerprints(results)
+    if incremental is not None and incremental.infile is not None:
+        write_incremental_output(results, outfile, args, incremental)
+        return
+
+    if args.appendOutputFile:
         if os.path.isfile(outfile):
             logger.info(f"Analysis output will be appended to file {outfile}")
             open_as="a"
@@ -88,17 +199,65 @@ def write_analysis_output(results, outfile, args):
         open_as="w"
 
     time0 = time.time()
+    index = make_results_index(results)
     with h5py.File(outfile, open_as) as f:
-        for k, v in results.items():
-            logger.debug(f"Pickle and dump {k}")
-            narf.ioutils.pickle_dump_h5py(k, v, f)
+        write_pickled_results(f, results, args)
 
         if "meta_info" not in f.keys():
-            narf.ioutils.pickle_dump_h5py("meta_info", narf.ioutils.make_meta_info_dict(args=args, wd=common.base_dir), f)
+            write_meta_info(f, args)
+
+        write_results_index(f, index)
 
     logger.info(f"Writing output: {time.time()-time0}")
     logger.info(f"Output saved in {outfile}")
 
+def write_meta_info(h5file, args):
+    meta_info = narf.ioutils.make_meta_info_dict(args=args, wd=common.base_dir)
+    if getattr(args, "profileColumns", False):
+        from wremnants.column_profiling import column_profiling
+        meta_info["column_profile"] = column_profiling.table()
+    narf.ioutils.pickle_dump_h5py("meta_info", meta_info, h5file)
+
+def write_pickled_results(h5file, results, args):
+    sliceable = getattr(args, "histStorage", "pickle") == "sliceable"
+    systStorage = getattr(args, "systStorage", "double")
+    for k, v in results.items():
+        if (sliceable or systStorage != "double") and isinstance(v, dict) and "output" in v:
+            # histograms with reduced precision are stored in sliceable format
+            v = write_sliceable_hists(h5file, k, v, all_hists=sliceable, systStorage=systStorage)
+        logger.debug(f"Pickle and dump {k}")
+        narf.ioutils.pickle_dump_h5py(k, v, h5file)
+
+def write_incremental_output(results, outfile, args, incremental):
+    # rewrite the previous output with the new results, the reused results and other results of the previous output
+    # are copied without unpickling them
+    from utilities.io_tools import merge_tools
+
+    new_results = {k : v for k, v in results.items() if not (isinstance(v, dict) and v.get("reused", False))}
+    tmpfile = f"{outfile}.tmp{os.getpid()}"
+
+    time0 = time.time()
+    index = make_results_index(new_results)
+    with h5py.File(tmpfile, "w") as f:
+        write_pickled_results(f, new_results, args)
+        write_meta_info(f, args)
+
+        processes = {}
+        for key in incremental.infile.keys():
+            if key in new_results or key.startswith("meta_info"):
+                continue
+            logger.debug(f"Copy {key} from the previous output")
+            index = merge_tools.copy_result(incremental.infile, key, f)
+            if index is not None:
+                processes[key] = index
+
+        write_results_index(f, index, processes)
+
+    incremental.close()
+    os.replace(tmpfile, outfile)
+    logger.info(f"Writing output: {time.time()-time0}")
+    logger.info(f"Output saved in {outfile}, reusing the results of {', '.join(incremental.reused) if incremental.reused else 'no datasets'}")
+
 def is_eosuser_path(path):
     if not path:
         return False
@@ -1,5 +1,6 @@
 from collections import OrderedDict
-from wremnants import histselections as sel
+from wremnants import histselections as sel, syst_tools
+from wremnants.combine_helpers import symmetrize_logk
 from utilities import boostHistHelpers as hh, common, logging
 from utilities.io_tools import output_tools
 import narf
@@ -300,13 +301,17 @@ class CardTool(object):
     # preOp is a function to apply per process, preOpMap can be used with a dict for a speratate function for each process, 
     #   it is executed before summing the processes. Arguments can be specified with preOpArgs 
     # action will be applied to the sum of all the individual samples contributing, arguments can be specified with actionArgs
+    # decorrelation splits the variations by ranges of a fit axis, with the arguments of syst_tools.decorrelateByAxis,
+    #   it is applied after the action, directly on the flat arrays when writing the HDF5 output if possible
+    # cacheKey describes what the preOp and action functions do (e.g. the entries they select), it replaces them in the key of the logk cache
+    #   and is needed for functions capturing objects (e.g. self) which can not be hashed
     def addSystematic(self, name, systAxes=[], systAxesFlow=[], outNames=None, skipEntries=None, labelsByAxis=None, 
                       baseName="", mirror=False, mirrorDownVarEqualToUp=False, mirrorDownVarEqualToNomi=False, symmetrize = "average",
                       scale=1, processes=None, group=None, noi=False, noConstraint=False, noProfile=False,
                       preOp=None, preOpMap=None, preOpArgs={}, action=None, actionArgs={}, actionRequiresNomi=False,
                       systNameReplace=[], systNamePrepend=None, groupFilter=None, passToFakes=False,
                       rename=None, splitGroup={}, formatWithValue=None,
-                      customizeNuisanceAttributes={},
+                      customizeNuisanceAttributes={}, decorrelation=None, cacheKey=None,
                       ):
         # note: setting Up=Down seems to be pathological for the moment, it might be due to the interpolation in the fit
         # for now better not to use the options, although it might be useful to keep it implemented
@@ -370,6 +375,7 @@ class CardTool(object):
                 "action" : action,
                 "actionArgs" : actionArgs,
                 "actionRequiresNomi" : actionRequiresNomi,
+                "decorrelation" : decorrelation,
                 "systNameReplace" : systNameReplace,
                 "noConstraint" : noConstraint,
                 "noProfile" : noProfile,
@@ -377,6 +383,7 @@ class CardTool(object):
                 "name" : name,
                 "systNamePrepend" : systNamePrepend,
                 "formatWithValue" : formatWithValue,
+                "cacheKey" : cacheKey,
             }
         })
 
@@ -514,10 +521,92 @@ class CardTool(object):
         if syst == self.nominalName:
             return {self.nominalName : hvar}
 
-        systInfo = self.systematics[syst] 
-        systAxes = systInfo["systAxes"]
-        systAxesLabels = systInfo.get("labelsByAxis", systAxes)
+        hvar = self.systAction(hvar, syst, hnom)
+        if self.systematics[syst].get("decorrelation"):
+            hvar = syst_tools.decorrelateByAxis(hvar, hnom, **self.systematics[syst]["decorrelation"])
+        axNames, entries, names = self.systEntries(hvar, syst)
+        variations = [hvar[{ax : binnum for ax,binnum in zip(axNames, entry)}] for entry in entries]
+
+        return {name : var for name,var in zip(names, variations) if name}
+
+    def systArray(self, hvar, syst, hnom, axes):
+        # bulk version of systHists, returns the names and the values of the variations of a systematic
+        # as one array of shape [nvariations, nbins] with the bins flattened in the order of the given axes,
+        # and for decorrelated systematics the list of (row in the array, fit bins) of each variation (None otherwise)
+        systInfo = self.systematics[syst]
+        hvar = self.systAction(hvar, syst, hnom)
+
+        decorr = systInfo.get("decorrelation")
+        if decorr and not self.implicitDecorrelation(hvar, syst, axes):
+            hvar = syst_tools.decorrelateByAxis(hvar, hnom, **decorr)
+            decorr = None
+
+        if not decorr:
+            axNames, entries, names = self.systEntries(hvar, syst)
+            values = self.systValues(hvar, syst, axNames, axes)
+            if not all(names):
+                values = values[np.array([bool(n) for n in names])]
+            return [n for n in names if n], values, None
+
+        # the variations of each decorrelation bin are the ones of the original histogram restricted to the bins in its range,
+        # the entries and names are derived from a histogram with the systematic axes only (including the decorrelation axis)
+        axisToDecorr = hvar.axes[decorr["axisToDecorrName"]]
+        axisDecorr, ranges = syst_tools.decorrelation_axis(axisToDecorr, decorr.get("decorrEdges", []), decorr.get("newDecorrAxisName"))
+        otherAxes = [ax for ax in hvar.axes if ax.name not in axes and ax.name != "mirror"]
+        mirrorAxes = [ax for ax in hvar.axes if ax.name == "mirror"]
+        hsyst = hist.Hist(*otherAxes, axisDecorr, *mirrorAxes)
+        axNames, entries, names = self.systEntries(hsyst, syst)
+
+        idecorr = axNames.index(axisDecorr.name)
+        baseAxNames = [n for i,n in enumerate(axNames) if i != idecorr]
+        values = self.systValues(hvar, syst, baseAxNames, axes)
+
+        # row in the array of the original variations and decorrelation bin of each entry
+        shape = [len(self.systIndexForAxis(hsyst.axes[n], flow=n in systInfo["systAxesFlow"])) for n in axNames]
+        indices = np.unravel_index(np.arange(len(entries)), shape)
+        if baseAxNames:
+            rows = np.ravel_multi_index([idx for i,idx in enumerate(indices) if i != idecorr], [n for i,n in enumerate(shape) if i != idecorr])
+        else:
+            rows = np.zeros(len(entries), dtype=int)
+
+        # fit bins in the range of each decorrelation bin
+        fitIndex = np.unravel_index(np.arange(values.shape[-1]), [hvar.axes[n].size for n in axes])[axes.index(axisToDecorr.name)]
+        bins = [np.flatnonzero((fitIndex >= low) & (fitIndex < high)) for low, high in ranges]
 
+        decorrelation = [(rows[i], bins[indices[idecorr][i]]) for i,n in enumerate(names) if n]
+        return [n for n in names if n], values, decorrelation
+
+    def implicitDecorrelation(self, hvar, syst, axes):
+        # the decorrelation can be applied on the flat arrays if the histogram has no other axes than the fit and systematic axes,
+        # the decorrelated axis is a fit axis and no flow bins of the systematic axes are used
+        # otherwise the decorrelated histogram is created explicitly
+        systInfo = self.systematics[syst]
+        decorrName = systInfo["decorrelation"]["axisToDecorrName"]
+        otherAxes = [n for n in hvar.axes.name if n not in axes]
+        return decorrName in axes and all(n in axes or n in systInfo["systAxes"] or n == "mirror" for n in hvar.axes.name) \
+            and not any(n in systInfo["systAxesFlow"] for n in otherAxes)
+
+    def systValues(self, hvar, syst, axNames, axes):
+        # values of all entries of the systematic axes axNames as an array of shape [nentries, nbins]
+        systAxesFlow = self.systematics[syst]["systAxesFlow"]
+
+        if hvar.axes.name != (*axes, *axNames):
+            hvar = hvar.project(*axes, *axNames)
+
+        # the systematic axes are the trailing ones, only the entries of their flow bins are kept if requested
+        def inner(ax):
+            start = 1 if ax.traits.underflow else 0
+            return slice(start, start+ax.size)
+        slices = [inner(hvar.axes[ax]) for ax in axes]
+        slices += [slice(None) if ax in systAxesFlow else inner(hvar.axes[ax]) for ax in axNames]
+        values = hvar.values(flow=True)[tuple(slices)]
+
+        nsyst = len(axNames)
+        nentries = int(np.prod(values.shape[values.ndim-nsyst:]))
+        return np.moveaxis(values, range(values.ndim-nsyst, values.ndim), range(nsyst)).reshape(nentries, -1)
+
+    def systAction(self, hvar, syst, hnom):
+        systInfo = self.systematics[syst] 
         # Jan: moved above the mirror action, as this action can cause mirroring
         if systInfo["action"]:
             if systInfo["actionRequiresNomi"]:
@@ -526,6 +615,13 @@ class CardTool(object):
                 hvar = systInfo["action"](hvar, **systInfo["actionArgs"])
         if self.outfile:
             self.outfile.cd() # needed to restore the current directory in case the action opens a new root file
+        return hvar
+
+    def systEntries(self, hvar, syst):
+        # returns the systematic axes, the entries along them and the corresponding output names ("" for skipped entries)
+        systInfo = self.systematics[syst] 
+        systAxes = systInfo["systAxes"]
+        systAxesLabels = systInfo.get("labelsByAxis", systAxes)
 
         axNames = systAxes[:]
         axLabels = systAxesLabels[:]
@@ -566,106 +662,63 @@ class CardTool(object):
             if not len(systInfo["outNames"]):
                 raise RuntimeError(f"Did not find any valid variations for syst {syst}")
 
-        variations = [hvar[{ax : binnum for ax,binnum in zip(axNames, entry)}] for entry in entries]
-        if hvar.axes[-1].name == "mirror" and len(variations) == 2*len(systInfo["outNames"]):
+        if hvar.axes[-1].name == "mirror" and len(entries) == 2*len(systInfo["outNames"]):
             systInfo["outNames"] = [n + d for n in systInfo["outNames"] for d in ["Up", "Down"]]
-        elif len(variations) != len(systInfo["outNames"]):
+        elif len(entries) != len(systInfo["outNames"]):
             logger.warning(f"The number of variations doesn't match the number of names for "
-                f"syst {syst}. Found {len(systInfo['outNames'])} names and {len(variations)} variations.")
-
-        return {name : var for name,var in zip(systInfo["outNames"], variations) if name}
-
-    def getLogk(self, hvar, hnom, kfac=1., logkepsilon=math.log(1e-3)):
+                f"syst {syst}. Found {len(systInfo['outNames'])} names and {len(entries)} variations.")
+
+        names = systInfo["outNames"][:len(entries)]
+        names += [""]*(len(entries)-len(names))
+        return axNames, entries, names
+
+    def getLogk(self, var, nom, kfac=1., logkepsilon=math.log(1e-3)):
+        # var and nom are histograms or arrays of values, arrays of variations are broadcast against the nominal
+        if isinstance(var, hist.Hist):
+            var = var.values()
+        if isinstance(nom, hist.Hist):
+            nom = nom.values()
         # check if there is a sign flip between systematic and nominal
-        _logk = kfac*np.log(hvar.values()/hnom.values())
-        _logk_view = np.where(np.equal(np.sign(hnom.values()*hvar.values()),1), _logk, logkepsilon*np.ones_like(_logk))
-        return _logk_view
+        with np.errstate(divide="ignore", invalid="ignore"):
+            _logk = kfac*np.log(var/nom)
+        return np.where(np.equal(np.sign(nom*var),1), _logk, logkepsilon)
 
     def symmetrize(self, var_map, hnom, symmetrize=None):
         if symmetrize is None:
             # nothing to do
             return var_map
 
-        var_map_out = {}
-
         for var, hvar in var_map.items():
             if not np.all(np.isfinite(hvar.values())):
                 raise RuntimeError(f"{len(hvar.values())-sum(np.isfinite(hvar.values()))} NaN or Inf values encountered in systematic {var}!")
 
-            if symmetrize is not None and var.endswith("Up"):
-                varbase = var.removesuffix("Up")
-
-                varup = var
-                vardown = varbase + "Down"
-
-                hvarup = hvar
-                hvardown = var_map[vardown]
-
-                logkup = self.getLogk(hvarup, hnom)
-                logkdown = -self.getLogk(hvardown, hnom)
-
-                if symmetrize in ["conservative", "average"]:
-                    if symmetrize=="conservative":
-                        # symmetrize by largest magnitude of up and down variations
-                        logk = np.where(np.abs(logkup) > np.abs(logkdown), logkup, logkdown)
-                    elif symmetrize=="average":
-                        # symmetrize by average of up and down variations
-                        logk = 0.5*(logkup + logkdown)
-
-                    # reuse histograms to avoid copies
-                    # up and down variations are explicitly produced in this case
-                    hvarup.values()[...] = hnom.values()*np.exp(logk)
-                    hvardown.values()[...] = hnom.values()*np.exp(-logk)
-
-                    var_map_out[varup] = hvarup
-                    var_map_out[vardown] = hvardown
-
-                elif symmetrize in ["linear", "quadratic"]:
-                    # "linear" corresponds to a piecewise linear dependence of logk on theta
-                    # while "quadratic" corresponds to a quadratic dependence and leads
-                    # to a large variance
-                    diff_fact = np.sqrt(3.) if symmetrize=="quadratic" else 1.
-
-                    # split asymmetric variation into two symmetric variations
-                    logkavg = 0.5*(logkup + logkdown)
-                    logkdiff =  0.5*diff_fact*(logkup - logkdown)
-
-                    varavg = varbase + "SymAvg"
-                    vardiff = varbase + "SymDiff"
-
-                    # reuse histograms to minimize copies
-                    hvaravgup = hvarup
-                    hvaravgdown = hvardown
-
-                    hvardiffup = hvarup.copy()
-                    hvardiffdown = hvardown.copy()
-
-                    hvaravgup.values()[...] = hnom.values()*np.exp(logkavg)
-                    hvaravgdown.values()[...] = hnom.values()*np.exp(-logkavg)
-
-                    hvardiffup.values()[...] = hnom.values()*np.exp(logkdiff)
-                    hvardiffdown.values()[...] = hnom.values()*np.exp(-logkdiff)
+        varbases = [var.removesuffix("Up") for var in var_map.keys() if var.endswith("Up")]
+        if not varbases:
+            return var_map
 
-                    varavgup = varavg + "Up"
-                    varavgdown = varavg + "Down"
+        # symmetrize all variations at once in logk space
+        nom = hnom.values()
+        logkup = self.getLogk(np.stack([var_map[v+"Up"].values() for v in varbases]), nom)
+        logkdown = -self.getLogk(np.stack([var_map[v+"Down"].values() for v in varbases]), nom)
+        logks = symmetrize_logk(logkup, logkdown, symmetrize)
+        logkup = None
+        logkdown = None
 
-                    var_map_out[varavgup] = hvaravgup
-                    var_map_out[varavgdown] = hvaravgdown
+        var_map_out = {var : hvar for var, hvar in var_map.items() if not var.endswith("Up") and not var.endswith("Down")}
+        for i, varbase in enumerate(varbases):
+            for j, (suffix, logk, _) in enumerate(logks):
+                # reuse histograms to minimize copies, up and down variations are explicitly produced
+                hvarup = var_map[varbase+"Up"] if j == 0 else var_map[varbase+"Up"].copy()
+                hvardown = var_map[varbase+"Down"] if j == 0 else var_map[varbase+"Down"].copy()
 
-                    vardiffup = vardiff + "Up"
-                    vardiffdown = vardiff + "Down"
+                hvarup.values()[...] = nom*np.exp(logk[i])
+                hvardown.values()[...] = nom*np.exp(-logk[i])
 
-                    var_map_out[vardiffup] = hvardiffup
-                    var_map_out[vardiffdown] = hvardiffdown
-            elif symmetrize is not None and var.endswith("Down"):
-                # this is already handled above
-                pass
-            else:
-                var_map_out[var] = hvar
+                var_map_out[varbase+suffix+"Up"] = hvarup
+                var_map_out[varbase+suffix+"Down"] = hvardown
 
         return var_map_out
 
-
     def variationName(self, proc, name):
         if name == self.nominalName:
             return f"{self.histName}_{proc}"
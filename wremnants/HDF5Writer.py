@@ -1,4 +1,6 @@
-from wremnants.combine_helpers import projectABCD
+from wremnants.combine_helpers import projectABCD, symmetrize_logk
+from wremnants.logk_cache import LogkCache
+from wremnants.datasets.proxy_cache import proxy_cache
 from utilities import boostHistHelpers as hh, common, logging
 from utilities.io_tools import output_tools, combinetf_input
 
@@ -6,24 +8,49 @@ import time
 import numpy as np
 import hist
 import h5py
-from utilities.h5pyutils import writeFlatInChunks, writeSparse
+from utilities.h5pyutils import writeFlatInChunks, createSparse
 import math
 import pandas as pd
 import os
 import narf
 import re
+import multiprocessing
 from collections import defaultdict
 
 logger = logging.child_logger(__name__)
 
+# state shared with the forked worker processes computing the shape systematics
+_shape_syst_state = None
+
+def _init_shape_syst_worker(nWorkers):
+    writer, kwargs = _shape_syst_state
+    # each worker reads the inputs through its own file handle and keeps its share of the histogram cache,
+    # the objects cached by the parent before the fork are dropped
+    proxy_cache.clear()
+    if proxy_cache.budget is not None:
+        proxy_cache.set_budget(proxy_cache.budget // nWorkers)
+    for dg in {id(c.datagroups) : c.datagroups for c in writer.get_channels().values()}.values():
+        dg.reopen()
+
+def _get_shape_systematic(systKey):
+    writer, kwargs = _shape_syst_state
+    # the hits and misses of the logk cache in the worker are returned to be counted in the main process
+    cache = writer.logkCache
+    counts = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    logks = writer.get_shape_systematic(systKey, **kwargs)
+    if cache is not None:
+        counts = (cache.hits - counts[0], cache.misses - counts[1])
+    return logks, counts
+
 class HDF5Writer(object):
     # keeps multiple card tools and writes them out in a single file to fit (appending the histograms)
-    def __init__(self, card_name="card", sparse=False):
+    def __init__(self, card_name="card", sparse=False, nProcesses=1, logkCache=None, compression="gzip"):
         self.cardName = card_name
         self.cardTools = []
         # settings for writing out hdf5 files
         self.dtype="float64"
         self.chunkSize=4*1024**2
+        self.compression=compression # compression codec for the tensors, see h5pyutils.compression_codecs
         self.logkepsilon=math.log(1e-3) #numerical cutoff in case of zeros in systematic variations
 
         self.theoryFit = False
@@ -49,6 +76,8 @@ class HDF5Writer(object):
             self.clipSig = np.abs(np.log(clipSystVariationsSignal))
 
         self.sparse = sparse
+        self.nProcesses = nProcesses # number of parallel processes for the shape systematics
+        self.logkCache = LogkCache(logkCache) if logkCache else None # on-disk cache of the logk arrays of shape systematics
 
 
     def init_data_dicts(self):
@@ -58,6 +87,8 @@ class HDF5Writer(object):
         self.dict_pseudodata = {c : [] for c in channels}
         self.dict_sumw2 = {c : {} for c in channels}
         self.dict_norm = {c : {} for c in channels}
+        # the booked logk arrays are released by write_sparse once they are written, they can only be written once
+        self.logk_released = False
 
         if self.sparse:
             self.dict_logkavg_indices = {c : {} for c in channels}
@@ -295,11 +326,6 @@ class HDF5Writer(object):
             if dg.dataName in dg.groups:
                 del dg.groups[dg.dataName].hists[chanInfo.nominalName]
 
-            # release original histograms in the proxy objects
-            if chanInfo.pseudoData:
-                for pseudoData in chanInfo.pseudoData:
-                    dg.release_results(f"{chanInfo.nominalName}_{pseudoData}")
-
             # initialize dictionaties for systematics
             self.init_data_dicts_channel(chan, procs_chan)
 
@@ -346,124 +372,32 @@ class HDF5Writer(object):
                 self.book_systematic(syst, var_name)
 
             # shape systematics
+            systKeys = []
             for systKey, syst in chanInfo.systematics.items():
-                logger.info(f"Now in channel {chan} at shape systematic group {systKey}")
-
                 if chanInfo.isExcludedNuisance(systKey): 
                     continue
 
                 # some channels (e.g. xnorm) don't have all processes affected by the systematic
-                procs_syst = [p for p in syst["processes"] if p in procs_chan]
-                if len(procs_syst) == 0:
+                if not any(p in procs_chan for p in syst["processes"]):
                     continue
 
-                systName = systKey if not syst["name"] else syst["name"]
-
-                # Needed to avoid always reading the variation for the fakes, even for procs not specified
-                forceToNominal=[x for x in dg.getProcNames() if x not in 
-                    dg.getProcNames([p for g in procs_syst for p in chanInfo.expandProcesses(g) if p != dg.fakeName])]
-
-                dg.loadHistsForDatagroups(
-                    chanInfo.nominalName, systName, label="syst",
-                    procsToRead=procs_syst, 
-                    forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
-                    preOpMap=syst["preOpMap"], preOpArgs=syst["preOpArgs"], 
-                    # Needed to avoid always reading the variation for the fakes, even for procs not specified
-                    forceToNominal=forceToNominal,
-                    scaleToNewLumi=chanInfo.lumiScale,
-                    nominalIfMissing=not chanInfo.xnorm, # for masked channels not all systematics exist (we can skip loading nominal since Fake does not exist)
-                    sumFakesPartial=not chanInfo.ABCD
-                )
-
-                for proc in procs_syst:
-                    logger.debug(f"Now at proc {proc}!")
-
-                    hvar = dg.groups[proc].hists["syst"]
-                    hnom = dg.groups[proc].hists[chanInfo.nominalName]
-
-                    var_map = chanInfo.systHists(hvar, systKey, hnom)
-
-                    var_names = [x[:-2] if "Up" in x[-2:] else (x[:-4] if "Down" in x[-4:] else x) 
-                        for x in filter(lambda x: x != "", var_map.keys())]
-                    # Deduplicate while keeping order
-                    var_names = list(dict.fromkeys(var_names))
-                    norm_proc = self.dict_norm[chan][proc]
-
-                    for var_name in var_names:
-                        kfac=syst["scale"]
-
-                        def get_logk(histname, var_type=""):
-                            _hist = var_map[histname+var_type]
-
-                            _syst = self.get_flat_values(_hist, chanInfo, axes, return_variances=False)
-
-                            if not np.all(np.isfinite(_syst)):
-                                raise RuntimeError(f"{len(_syst)-sum(np.isfinite(_syst))} NaN or Inf values encountered in systematic {var_name}!")
-
-                            # check if there is a sign flip between systematic and nominal
-                            _logk = kfac*np.log(_syst/norm_proc)
-                            _logk_view = np.where(np.equal(np.sign(norm_proc*_syst),1), _logk, self.logkepsilon*np.ones_like(_logk))
-                            _syst = None
-
-                            if self.clipSystVariations>0.:
-                                _logk = np.clip(_logk,-self.clip,self.clip)
-                            if self.clipSystVariationsSignal>0. and proc in signals:
-                                _logk = np.clip(_logk,-self.clipSig,self.clipSig)
-
-                            return _logk_view
-
-                        var_name_out = var_name
-
-                        if syst["mirror"]:
-                            logkavg_proc = get_logk(var_name)
-                        elif syst["symmetrize"] is not None:
-                            logkup_proc = get_logk(var_name, "Up")
-                            logkdown_proc = -get_logk(var_name, "Down")
+                systKeys.append(systKey)
 
-                            if syst["symmetrize"] == "conservative":
-                                # symmetrize by largest magnitude of up and down variations
-                                logkavg_proc = np.where(np.abs(logkup_proc) > np.abs(logkdown_proc), logkup_proc, logkdown_proc)
-                            elif syst["symmetrize"] == "average":
-                                # symmetrize by average of up and down variations
-                                logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
-                            elif syst["symmetrize"] in ["linear", "quadratic"]:
-                                # "linear" corresponds to a piecewise linear dependence of logk on theta
-                                # while "quadratic" corresponds to a quadratic dependence and leads
-                                # to a large variance
-                                diff_fact = np.sqrt(3.) if syst["symmetrize"]=="quadratic" else 1.
-
-                                # split asymmetric variation into two symmetric variations
-                                logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
-                                logkdiffavg_proc = 0.5*diff_fact*(logkup_proc - logkdown_proc)
-
-                                var_name_out = var_name + "SymAvg"
-                                var_name_out_diff = var_name + "SymDiff"
-
-                                #special case, book the extra systematic
-                                self.book_logk_avg(logkdiffavg_proc, chan, proc, var_name_out_diff)
-                                self.book_systematic(syst, var_name_out_diff)
-                        else:
-                            logkup_proc = get_logk(var_name, "Up")
-                            logkdown_proc = -get_logk(var_name, "Down")
-
-                            logkavg_proc = 0.5*(logkup_proc + logkdown_proc)
-                            logkhalfdiff_proc = 0.5*(logkup_proc - logkdown_proc)
-
-                            logkup_proc = None
-                            logkdown_proc = None
-
-                            self.book_logk_halfdiff(logkhalfdiff_proc, chan, proc, var_name_out)
-
-                        self.book_logk_avg(logkavg_proc, chan, proc, var_name_out)
-                        self.book_systematic(syst, var_name_out)
-
-                    # free memory
-                    for var in var_map.keys():
-                        var_map[var] = None
-                    del dg.groups[proc].hists["syst"]
+            shape_args = dict(chan=chan, chanInfo=chanInfo, procs_chan=procs_chan, axes=axes, forceNonzero=forceNonzero, signals=signals)
+            if self.nProcesses > 1 and len(systKeys) > 1:
+                logger.info(f"Process {len(systKeys)} shape systematic groups in channel {chan} with {self.nProcesses} parallel processes")
+                shape_systs = self.map_shape_systematics(systKeys, shape_args)
+            else:
+                shape_systs = (self.get_shape_systematic(systKey, **shape_args) for systKey in systKeys)
 
-                # release original histograms in the proxy objects
-                dg.release_results(f"{chanInfo.nominalName}_{systName}")
+            # book in the order of the systematic groups, independently of how they were computed
+            for systKey, logks in zip(systKeys, shape_systs):
+                syst = chanInfo.systematics[systKey]
+                for proc, var_name, logkavg_proc, logkhalfdiff_proc, bins in logks:
+                    if logkhalfdiff_proc is not None:
+                        self.book_logk_halfdiff(logkhalfdiff_proc, chan, proc, var_name, bins)
+                    self.book_logk_avg(logkavg_proc, chan, proc, var_name, bins)
+                    self.book_systematic(syst, var_name)
 
         procs = signals + bkgs
         nproc = len(procs)
@@ -498,157 +432,8 @@ class HDF5Writer(object):
         nbinsfull = sum(ibins)
 
         ibin = 0
-        if self.sparse:
-            logger.info(f"Write out sparse array")
-
-            idxdtype = 'int32'
-            maxsparseidx = max(nbinsfull*nproc,2*nsyst)
-            if maxsparseidx > np.iinfo(idxdtype).max:
-                logger.info("sparse array shapes are too large for index datatype, switching to int64")
-                idxdtype = 'int64'
-
-            norm_sparse_size = 0
-            norm_sparse_indices = np.zeros([norm_sparse_size,2],idxdtype)
-            norm_sparse_values = np.zeros([norm_sparse_size],self.dtype)
-
-            logk_sparse_size = 0
-            logk_sparse_normindices = np.zeros([logk_sparse_size,1],idxdtype)
-            logk_sparse_systindices = np.zeros([logk_sparse_size,1],idxdtype)
-            logk_sparse_values = np.zeros([logk_sparse_size],self.dtype)
-
-            for nbinschan, chan in zip(ibins, self.get_channels()):
-                dict_norm_chan = self.dict_norm[chan]
-                dict_logkavg_chan_indices = self.dict_logkavg_indices[chan]
-                dict_logkavg_chan_values = self.dict_logkavg_values[chan]
-                dict_logkhalfdiff_chan_indices = self.dict_logkhalfdiff_indices[chan]
-                dict_logkhalfdiff_chan_values = self.dict_logkhalfdiff_values[chan]
-
-                for iproc, proc in enumerate(procs):
-                    if proc not in dict_norm_chan:
-                        continue
-                    norm_proc = dict_norm_chan[proc]
-
-                    norm_indices = np.transpose(np.nonzero(norm_proc))
-                    norm_values = np.reshape(norm_proc[norm_indices],[-1])
-                        
-                    nvals = len(norm_values)
-                    oldlength = norm_sparse_size
-                    norm_sparse_size = oldlength + nvals
-                    norm_sparse_indices.resize([norm_sparse_size,2])
-                    norm_sparse_values.resize([norm_sparse_size])
-                    
-                    out_indices = np.array([[ibin,iproc]]) + np.pad(norm_indices,((0,0),(0,1)),'constant')
-                    norm_indices = None
-                    
-                    norm_sparse_indices[oldlength:norm_sparse_size] = out_indices
-                    out_indices = None
-                    
-                    norm_sparse_values[oldlength:norm_sparse_size] = norm_values
-                    norm_values = None
-                    
-                    norm_idx_map = np.cumsum(np.not_equal(norm_proc, 0.)) - 1 + oldlength
-
-                    dict_logkavg_proc_indices = dict_logkavg_chan_indices[proc]
-                    dict_logkavg_proc_values = dict_logkavg_chan_values[proc]
-                    dict_logkhalfdiff_proc_indices = dict_logkhalfdiff_chan_indices[proc]
-                    dict_logkhalfdiff_proc_values = dict_logkhalfdiff_chan_values[proc]
-                    for isyst, syst in enumerate(systs):
-                        if syst not in dict_logkavg_proc_indices.keys():
-                            continue
-
-                        logkavg_proc_indices = dict_logkavg_proc_indices[syst]
-                        logkavg_proc_values = dict_logkavg_proc_values[syst]
-
-                        nvals_proc = len(logkavg_proc_values)
-                        oldlength = logk_sparse_size
-                        logk_sparse_size = oldlength + nvals_proc
-                        logk_sparse_normindices.resize([logk_sparse_size,1])
-                        logk_sparse_systindices.resize([logk_sparse_size,1])
-                        logk_sparse_values.resize([logk_sparse_size])
-
-                        #first dimension of output indices are NOT in the dense [nbin,nproc] space, but rather refer to indices in the norm_sparse vectors
-                        #second dimension is flattened in the [2,nsyst] space, where logkavg corresponds to [0,isyst] flattened to isyst
-                        #two dimensions are kept in separate arrays for now to reduce the number of copies needed later
-                        out_normindices = norm_idx_map[logkavg_proc_indices]
-                        logkavg_proc_indices = None
-                        
-                        logk_sparse_normindices[oldlength:logk_sparse_size] = out_normindices
-                        logk_sparse_systindices[oldlength:logk_sparse_size] = isyst
-                        out_normindices = None
-                        
-                        logk_sparse_values[oldlength:logk_sparse_size] = logkavg_proc_values
-                        logkavg_proc_values = None
-
-                        if syst in dict_logkhalfdiff_proc_indices:
-                            logkhalfdiff_proc_indices = dict_logkhalfdiff_proc_indices[syst]
-                            logkhalfdiff_proc_values = dict_logkhalfdiff_proc_values[syst]
-                            
-                            nvals_proc = len(logkhalfdiff_proc_values)
-                            oldlength = logk_sparse_size
-                            logk_sparse_size = oldlength + nvals_proc
-                            logk_sparse_normindices.resize([logk_sparse_size,1])
-                            logk_sparse_systindices.resize([logk_sparse_size,1])
-                            logk_sparse_values.resize([logk_sparse_size])
-                                    
-                            #out_indices = np.array([[ibin,iproc,isyst,1]]) + np.pad(logkhalfdiff_proc_indices,((0,0),(0,3)),'constant')
-                            #first dimension of output indices are NOT in the dense [nbin,nproc] space, but rather refer to indices in the norm_sparse vectors
-                            #second dimension is flattened in the [2,nsyst] space, where logkhalfdiff corresponds to [1,isyst] flattened to nsyst + isyst
-                            #two dimensions are kept in separate arrays for now to reduce the number of copies needed later
-                            out_normindices = norm_idx_map[logkhalfdiff_proc_indices]
-                            logkhalfdiff_proc_indices = None
-                            
-                            logk_sparse_normindices[oldlength:logk_sparse_size] = out_normindices
-                            logk_sparse_systindices[oldlength:logk_sparse_size] = nsyst + isyst
-                            out_normindices = None
-                            
-                            logk_sparse_values[oldlength:logk_sparse_size] = logkhalfdiff_proc_values
-                            logkhalfdiff_proc_values = None
-
-                    # free memory
-                    dict_logkavg_proc_indices = None
-                    dict_logkavg_proc_values = None
-                    dict_logkhalfdiff_proc_indices = None
-                    dict_logkhalfdiff_proc_values = None
-
-                # free memory
-                norm_proc = None
-                norm_idx_map = None
-
-                ibin += nbinschan
-            
-            logger.info(f"Resize and sort sparse arrays into canonical order")
-            #resize sparse arrays to actual length
-            norm_sparse_indices.resize([norm_sparse_size,2])
-            norm_sparse_values.resize([norm_sparse_size])
-            logk_sparse_normindices.resize([logk_sparse_size,1])
-            logk_sparse_systindices.resize([logk_sparse_size,1])
-            logk_sparse_values.resize([logk_sparse_size])
-            
-            #straightforward sorting of norm_sparse into canonical order
-            norm_sparse_dense_shape = (nbinsfull, nproc)
-            norm_sort_indices = np.argsort(np.ravel_multi_index(np.transpose(norm_sparse_indices),norm_sparse_dense_shape))
-            norm_sparse_indices = norm_sparse_indices[norm_sort_indices]
-            norm_sparse_values = norm_sparse_values[norm_sort_indices]
-                
-            #now permute the indices of the first dimension of logk_sparse corresponding to the resorting of norm_sparse
-            
-            #compute the inverse permutation from the sorting of norm_sparse
-            #since the final indices are filled from here, need to ensure it has the correct data type
-            logk_permute_indices = np.argsort(norm_sort_indices).astype(idxdtype)
-            norm_sort_indices = None
-            logk_sparse_normindices = logk_permute_indices[logk_sparse_normindices]
-            logk_permute_indices = None
-            logk_sparse_indices = np.concatenate([logk_sparse_normindices, logk_sparse_systindices],axis=-1)
-            logk_normindices = None
-
-            #now straightforward sorting of logk_sparse into canonical order
-            logk_sparse_dense_shape = (norm_sparse_indices.shape[0], 2*nsyst)
-            logk_sort_indices = np.argsort(np.ravel_multi_index(np.transpose(logk_sparse_indices),logk_sparse_dense_shape))
-            logk_sparse_indices = logk_sparse_indices[logk_sort_indices]
-            logk_sparse_values = logk_sparse_values[logk_sort_indices]
-            logk_sort_indices = None
-
-        else:
+        # sparse tensors are streamed directly into the output file further below
+        if not self.sparse:
             logger.info(f"Write out dense array")
             #initialize with zeros, i.e. no variation
             norm = np.zeros([nbinsfull,nproc], self.dtype)
@@ -724,7 +509,9 @@ class HDF5Writer(object):
         def create_dataset(name, content, length=None, dtype=h5py.special_dtype(vlen=str), compression="gzip"):
             dimension=[len(content), length] if length else [len(content)]
             ds = f.create_dataset(f"h{name}", dimension, dtype=dtype, compression=compression)
-            ds[...] = content
+            # empty lists can not be broadcast to datasets with more than one dimension
+            if len(content):
+                ds[...] = content
 
         create_dataset("procs", procs)
         create_dataset("signals", signals)
@@ -771,13 +558,13 @@ class HDF5Writer(object):
         nbytes = 0
 
         constraintweights = self.get_constraintweights(self.dtype)
-        nbytes += writeFlatInChunks(constraintweights, f, "hconstraintweights", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(constraintweights, f, "hconstraintweights", maxChunkBytes = self.chunkSize, compression = self.compression)
         constraintweights = None
 
-        nbytes += writeFlatInChunks(data_obs, f, "hdata_obs", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(data_obs, f, "hdata_obs", maxChunkBytes = self.chunkSize, compression = self.compression)
         data_obs = None
 
-        nbytes += writeFlatInChunks(pseudodata, f, "hpseudodata", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(pseudodata, f, "hpseudodata", maxChunkBytes = self.chunkSize, compression = self.compression)
         pseudodata = None
 
         if self.theoryFit:
@@ -785,27 +572,287 @@ class HDF5Writer(object):
             if data_cov.shape != (nbins,nbins):
                 raise RuntimeError(f"covariance matrix has incompatible shape of {data_cov.shape}, expected is {(nbins,nbins)}!")
             full_cov = np.add(data_cov,np.diag(sumw2)) if self.theoryFitMCStat else data_cov
-            nbytes += writeFlatInChunks(np.linalg.inv(full_cov), f, "hdata_cov_inv", maxChunkBytes = self.chunkSize)
+            nbytes += writeFlatInChunks(np.linalg.inv(full_cov), f, "hdata_cov_inv", maxChunkBytes = self.chunkSize, compression = self.compression)
             data_cov = None
             full_cov = None
 
-        nbytes += writeFlatInChunks(kstat, f, "hkstat", maxChunkBytes = self.chunkSize)
+        nbytes += writeFlatInChunks(kstat, f, "hkstat", maxChunkBytes = self.chunkSize, compression = self.compression)
         kstat = None
 
         if self.sparse:
-            nbytes += writeSparse(norm_sparse_indices, norm_sparse_values, norm_sparse_dense_shape, f, "hnorm_sparse", maxChunkBytes = self.chunkSize)
-            norm_sparse_indices = None
-            norm_sparse_values = None
-            nbytes += writeSparse(logk_sparse_indices, logk_sparse_values, logk_sparse_dense_shape, f, "hlogk_sparse", maxChunkBytes = self.chunkSize)
-            logk_sparse_indices = None
-            logk_sparse_values = None
+            nbytes += self.write_sparse(f, procs, systs, ibins)
         else:
-            nbytes += writeFlatInChunks(norm, f, "hnorm", maxChunkBytes = self.chunkSize)
+            nbytes += writeFlatInChunks(norm, f, "hnorm", maxChunkBytes = self.chunkSize, compression = self.compression)
             norm = None
-            nbytes += writeFlatInChunks(logk, f, "hlogk", maxChunkBytes = self.chunkSize)
+            nbytes += writeFlatInChunks(logk, f, "hlogk", maxChunkBytes = self.chunkSize, compression = self.compression)
             logk = None
 
         logger.info(f"Total raw bytes in arrays = {nbytes}")
+        if self.logkCache is not None:
+            logger.info(self.logkCache.summary())
+
+    def map_shape_systematics(self, systKeys, kwargs):
+        # compute the shape systematic groups in forked worker processes, which inherit the loaded inputs,
+        # results are returned in the order of systKeys such that the output is identical to the serial processing
+        global _shape_syst_state
+        _shape_syst_state = (self, kwargs)
+        nWorkers = min(self.nProcesses, len(systKeys))
+        try:
+            with multiprocessing.get_context("fork").Pool(nWorkers, initializer=_init_shape_syst_worker, initargs=(nWorkers,)) as pool:
+                for logks, (hits, misses) in pool.imap(_get_shape_systematic, systKeys):
+                    if self.logkCache is not None:
+                        self.logkCache.hits += hits
+                        self.logkCache.misses += misses
+                    yield logks
+        finally:
+            _shape_syst_state = None
+
+    def get_shape_systematic(self, systKey, chan, chanInfo, procs_chan, axes, forceNonzero, signals):
+        # returns the list of (process, nuisance name, logkavg, logkhalfdiff) to be booked for a systematic group
+        logger.info(f"Now in channel {chan} at shape systematic group {systKey}")
+
+        dg = chanInfo.datagroups
+        syst = chanInfo.systematics[systKey]
+
+        procs_syst = [p for p in syst["processes"] if p in procs_chan]
+
+        systName = systKey if not syst["name"] else syst["name"]
+
+        # Needed to avoid always reading the variation for the fakes, even for procs not specified
+        forceToNominal=[x for x in dg.getProcNames() if x not in 
+            dg.getProcNames([p for g in procs_syst for p in chanInfo.expandProcesses(g) if p != dg.fakeName])]
+
+        cache_keys = None
+        if self.logkCache is not None:
+            # the nominal prediction enters the key, it captures the rebinning, selection and scaling of the inputs
+            cache_keys = {}
+            for proc in procs_syst:
+                cache_keys[proc] = self.logkCache.key(dg.infile, syst, axes, chan, proc, self.dict_norm[chan][proc], procs_syst, forceToNominal, 
+                    forceNonzero, chanInfo.lumiScale, chanInfo.xnorm, chanInfo.ABCD, dg.fakerate_axes, dg.fakerate_integration_axes,
+                    self.dtype, self.logkepsilon, self.clipSystVariations, self.clipSystVariationsSignal, proc in signals)
+                if cache_keys[proc] is None:
+                    # the systematic can not be cached
+                    cache_keys = None
+                    break
+
+        if cache_keys is not None:
+            cached = [self.logkCache.get(cache_keys[proc]) for proc in procs_syst]
+            if all(logks_proc is not None for logks_proc in cached):
+                logger.info(f"Take logk of shape systematic group {systKey} in channel {chan} from cache")
+                return [x for logks_proc in cached for x in logks_proc]
+
+        dg.loadHistsForDatagroups(
+            chanInfo.nominalName, systName, label="syst",
+            procsToRead=procs_syst, 
+            forceNonzero=forceNonzero and systName != "qcdScaleByHelicity",
+            preOpMap=syst["preOpMap"], preOpArgs=syst["preOpArgs"], 
+            # Needed to avoid always reading the variation for the fakes, even for procs not specified
+            forceToNominal=forceToNominal,
+            scaleToNewLumi=chanInfo.lumiScale,
+            nominalIfMissing=not chanInfo.xnorm, # for masked channels not all systematics exist (we can skip loading nominal since Fake does not exist)
+            sumFakesPartial=not chanInfo.ABCD
+        )
+
+        logks = []
+        for proc in procs_syst:
+            logger.debug(f"Now at proc {proc}!")
+
+            hvar = dg.groups[proc].hists["syst"]
+            hnom = dg.groups[proc].hists[chanInfo.nominalName]
+
+            if chanInfo.ABCD and set(chanInfo.getFakerateAxes()) != set(chanInfo.fit_axes[:len(chanInfo.getFakerateAxes())]):
+                # the ABCD projection is done per variation
+                var_map = chanInfo.systHists(hvar, systKey, hnom)
+                var_keys = list(var_map.keys())
+                var_values = np.empty((len(var_keys), len(self.dict_norm[chan][proc])), dtype=self.dtype)
+                for i, k in enumerate(var_keys):
+                    var_values[i] = self.get_flat_values(var_map[k], chanInfo, axes, return_variances=False)
+                var_map = None
+                decorrelation = None
+            else:
+                var_keys, var_values, decorrelation = chanInfo.systArray(hvar, systKey, hnom, axes)
+            # row in the array of values and fit bins (None for all) of each variation
+            if decorrelation is None:
+                var_rows = {k : (i, None) for i,k in enumerate(var_keys)}
+            else:
+                var_rows = dict(zip(var_keys, decorrelation))
+
+            var_names = [x[:-2] if "Up" in x[-2:] else (x[:-4] if "Down" in x[-4:] else x) for x in var_keys]
+            # Deduplicate while keeping order
+            var_names = list(dict.fromkeys(var_names))
+            norm_proc = self.dict_norm[chan][proc]
+
+            # logk of all variations of the systematic at once
+            var_values = var_values.astype(self.dtype, copy=False)
+            finite = np.isfinite(var_values)
+            if not np.all(finite):
+                ivar = np.argmin(finite.all(axis=-1))
+                raise RuntimeError(f"{finite.size-np.count_nonzero(finite)} NaN or Inf values encountered in systematic {var_keys[ivar] if decorrelation is None else systKey}!")
+            finite = None
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                logk = syst["scale"]*np.log(var_values/norm_proc)
+            # check if there is a sign flip between systematic and nominal
+            logk = np.where(np.equal(np.sign(norm_proc*var_values),1), logk, self.logkepsilon)
+            var_values = None
+
+            if self.clipSystVariations>0.:
+                logk = np.clip(logk,-self.clip,self.clip)
+            if self.clipSystVariationsSignal>0. and proc in signals:
+                logk = np.clip(logk,-self.clipSig,self.clipSig)
+
+            if syst["mirror"]:
+                for var_name in var_names:
+                    row, bins = var_rows[var_name]
+                    logks.append((proc, var_name, logk[row] if bins is None else logk[row, bins], None, bins))
+            else:
+                # symmetrize all pairs of up and down variations at once, decorrelated variations share the rows of the pairs
+                pairs = [(var_rows[var_name+"Up"][0], var_rows[var_name+"Down"][0]) for var_name in var_names]
+                ipairs = {p : i for i,p in enumerate(dict.fromkeys(pairs))}
+                logkup = logk[[p[0] for p in ipairs]]
+                logkdown = -logk[[p[1] for p in ipairs]]
+                for suffix, logkavg, logkhalfdiff in symmetrize_logk(logkup, logkdown, syst["symmetrize"]):
+                    for var_name, pair in zip(var_names, pairs):
+                        bins = var_rows[var_name+"Up"][1]
+                        idx = ipairs[pair] if bins is None else (ipairs[pair], bins)
+                        logks.append((proc, var_name+suffix, logkavg[idx], logkhalfdiff[idx] if logkhalfdiff is not None else None, bins))
+                logkup = None
+                logkdown = None
+
+            # free memory
+            logk = None
+            del dg.groups[proc].hists["syst"]
+
+        if cache_keys is not None:
+            for proc in procs_syst:
+                self.logkCache.put(cache_keys[proc], [x for x in logks if x[0] == proc])
+
+        return logks
+
+    def write_sparse(self, f, procs, systs, ibins):
+        # stream the sparse norm and logk tensors into pre-sized datasets,
+        # entries are produced one channel at a time directly in canonical order
+        logger.info(f"Write out sparse array")
+        if self.logk_released:
+            raise RuntimeError("The booked logk arrays were already written and released, they have to be booked again with write")
+        self.logk_released = True
+
+        nproc = len(procs)
+        nsyst = len(systs)
+        nbinsfull = sum(ibins)
+        channels = list(self.get_channels())
+
+        idxdtype = 'int32'
+        maxsparseidx = max(nbinsfull*nproc,2*nsyst)
+        if maxsparseidx > np.iinfo(idxdtype).max:
+            logger.info("sparse array shapes are too large for index datatype, switching to int64")
+            idxdtype = 'int64'
+
+        # first pass: count the non-zero entries to know the final sizes
+        norm_sparse_size = 0
+        logk_sparse_sizes = []
+        for chan in channels:
+            norm_sparse_size += sum(np.count_nonzero(norm_proc) for norm_proc in self.dict_norm[chan].values())
+            logk_sparse_size_chan = 0
+            for proc in procs:
+                if proc not in self.dict_norm[chan]:
+                    continue
+                logk_sparse_size_chan += sum(len(v) for v in self.dict_logkavg_values[chan][proc].values())
+                logk_sparse_size_chan += sum(len(v) for v in self.dict_logkhalfdiff_values[chan][proc].values())
+            logk_sparse_sizes.append(logk_sparse_size_chan)
+        logk_sparse_size = sum(logk_sparse_sizes)
+
+        norm_sparse_dense_shape = (nbinsfull, nproc)
+        logk_sparse_dense_shape = (norm_sparse_size, 2*nsyst)
+
+        logger.debug(f"Sparse tensors have {norm_sparse_size} norm and {logk_sparse_size} logk entries")
+
+        norm_sparse_indices, norm_sparse_values = createSparse(norm_sparse_size, norm_sparse_dense_shape, idxdtype, self.dtype,
+            f, "hnorm_sparse", maxChunkBytes = self.chunkSize, compression = self.compression)
+        logk_sparse_indices, logk_sparse_values = createSparse(logk_sparse_size, logk_sparse_dense_shape, idxdtype, self.dtype,
+            f, "hlogk_sparse", maxChunkBytes = self.chunkSize, compression = self.compression)
+
+        isyst_map = {syst: isyst for isyst, syst in enumerate(systs)}
+
+        # second pass: fill the tensors channel by channel
+        ibin = 0
+        norm_offset = 0
+        logk_offset = 0
+        for nbinschan, chan, logk_size_chan in zip(ibins, channels, logk_sparse_sizes):
+            dict_norm_chan = self.dict_norm[chan]
+
+            # dense [nbinschan, nproc] norm of this channel, its non-zero entries are in canonical (bin, proc) order
+            norm_chan = np.zeros([nbinschan, nproc], self.dtype)
+            for iproc, proc in enumerate(procs):
+                if proc in dict_norm_chan:
+                    norm_chan[:, iproc] = dict_norm_chan[proc]
+
+            norm_chan_nonzero = np.not_equal(norm_chan, 0.)
+            norm_indices = np.transpose(np.nonzero(norm_chan_nonzero)).astype(idxdtype)
+            nvals = norm_indices.shape[0]
+            norm_indices[:,0] += ibin
+
+            norm_sparse_indices[2*norm_offset:2*(norm_offset+nvals)] = np.reshape(norm_indices, [-1])
+            norm_sparse_values[norm_offset:norm_offset+nvals] = norm_chan[norm_chan_nonzero]
+            norm_indices = None
+
+            # map from flattened (bin, proc) in this channel to the global index in the norm_sparse vectors
+            norm_idx_map = np.cumsum(np.reshape(norm_chan_nonzero, [-1])) - 1 + norm_offset
+            norm_chan = None
+            norm_chan_nonzero = None
+
+            #first dimension of logk indices refers to indices in the norm_sparse vectors
+            #second dimension is flattened in the [2,nsyst] space, where logkavg corresponds to [0,isyst] and logkhalfdiff to [1,isyst]
+            logk_normindices = np.zeros([logk_size_chan], idxdtype)
+            logk_systindices = np.zeros([logk_size_chan], idxdtype)
+            logk_values = np.zeros([logk_size_chan], self.dtype)
+
+            ientry = 0
+            for iproc, proc in enumerate(procs):
+                if proc not in dict_norm_chan:
+                    continue
+                for dict_indices, dict_values, isystoffset in (
+                    (self.dict_logkavg_indices[chan][proc], self.dict_logkavg_values[chan][proc], 0),
+                    (self.dict_logkhalfdiff_indices[chan][proc], self.dict_logkhalfdiff_values[chan][proc], nsyst),
+                ):
+                    for syst, indices in dict_indices.items():
+                        values = dict_values[syst]
+                        nvals_proc = len(values)
+                        logk_normindices[ientry:ientry+nvals_proc] = norm_idx_map[np.reshape(indices, [-1])*nproc + iproc]
+                        logk_systindices[ientry:ientry+nvals_proc] = isystoffset + isyst_map[syst]
+                        logk_values[ientry:ientry+nvals_proc] = values
+                        ientry += nvals_proc
+
+            # release the booked arrays of this channel, see logk_released
+            self.dict_logkavg_indices[chan] = None
+            self.dict_logkavg_values[chan] = None
+            self.dict_logkhalfdiff_indices[chan] = None
+            self.dict_logkhalfdiff_values[chan] = None
+            norm_idx_map = None
+
+            if logk_size_chan > 0:
+                # sort the entries of this channel into canonical order,
+                # since channels occupy consecutive ranges of the norm indices this is also the global canonical order
+                logk_sort_indices = np.argsort(np.ravel_multi_index((logk_normindices - norm_offset, logk_systindices), (nvals, 2*nsyst)))
+                logk_indices = np.stack([logk_normindices[logk_sort_indices], logk_systindices[logk_sort_indices]], axis=-1)
+                logk_normindices = None
+                logk_systindices = None
+
+                logk_sparse_indices[2*logk_offset:2*(logk_offset+logk_size_chan)] = np.reshape(logk_indices, [-1])
+                logk_sparse_values[logk_offset:logk_offset+logk_size_chan] = logk_values[logk_sort_indices]
+                logk_indices = None
+                logk_sort_indices = None
+            logk_values = None
+
+            ibin += nbinschan
+            norm_offset += nvals
+            logk_offset += logk_size_chan
+
+        itemsize = np.dtype(self.dtype).itemsize
+        idxsize = np.dtype(idxdtype).itemsize
+        nbytes = norm_sparse_size*(2*idxsize + itemsize) + logk_sparse_size*(2*idxsize + itemsize)
+
+        return nbytes
 
 
     def book_logk_avg(self, *args):
@@ -814,14 +861,23 @@ class HDF5Writer(object):
     def book_logk_halfdiff(self, *args):
         self.book_logk(self.dict_logkhalfdiff, self.dict_logkhalfdiff_indices, self.dict_logkhalfdiff_values, *args)
 
-    def book_logk(self, dict_logk, dict_logk_indices, dict_logk_values, logk, chan, proc, syst_name):
+    def book_logk(self, dict_logk, dict_logk_indices, dict_logk_values, logk, chan, proc, syst_name, bins=None):
+        # bins are the (sorted) indices of the bins covered by logk if it doesn't cover the full channel, logk is zero elsewhere
+        if self.logk_released:
+            raise RuntimeError("The booked logk arrays were already written and released, they have to be booked again with write")
         norm_proc = self.dict_norm[chan][proc]
+        if bins is not None and not self.sparse:
+            logk_full = np.zeros(norm_proc.shape, dtype=logk.dtype)
+            logk_full[bins] = logk
+            logk = logk_full
+            bins = None
         #ensure that systematic tensor is sparse where normalization matrix is sparse
-        logk = np.where(np.equal(norm_proc,0.), 0., logk)
+        logk = np.where(np.equal(norm_proc if bins is None else norm_proc[bins],0.), 0., logk)
         if self.sparse:
             indices = np.transpose(np.nonzero(logk))
-            dict_logk_indices[chan][proc][syst_name] = indices
-            dict_logk_values[chan][proc][syst_name] = np.reshape(logk[indices],[-1])
+            values = np.reshape(logk[indices],[-1])
+            dict_logk_indices[chan][proc][syst_name] = indices if bins is None else bins[indices]
+            dict_logk_values[chan][proc][syst_name] = values
         else:
             dict_logk[chan][proc][syst_name] = logk
 
@@ -1,17 +1,17 @@
-import ROOT
-import narf
 import pathlib
+from . import headers
 
-ROOT.gInterpreter.AddIncludePath(f"{pathlib.Path(__file__).parent}/include/")
-
-narf.clingutils.Declare('#include "muonCorr.h"')
-narf.clingutils.Declare('#include "histoScaling.h"')
-narf.clingutils.Declare('#include "histHelpers.h"')
-narf.clingutils.Declare('#include "utils.h"')
-narf.clingutils.Declare('#include "csVariables.h"')
-narf.clingutils.Declare('#include "EtaPtCorrelatedEfficiency.h"')
-narf.clingutils.Declare('#include "theoryTools.h"')
-narf.clingutils.Declare('#include "syst_helicity_utils_polvar.h"')
+# the headers are compiled by headers.declare_registered (called when the arguments of the histmakers are parsed)
+headers.register(
+    "muonCorr.h",
+    "histoScaling.h",
+    "histHelpers.h",
+    "utils.h",
+    "csVariables.h",
+    "EtaPtCorrelatedEfficiency.h",
+    "theoryTools.h",
+    "syst_helicity_utils_polvar.h",
+)
 
 from .muon_prefiring import make_muon_prefiring_helpers
 from .muon_efficiencies_smooth import make_muon_efficiency_helpers_smooth
@@ -0,0 +1,111 @@
+import re
+import ROOT
+from utilities import logging
+from wremnants import headers
+
+headers.register("column_profiler.h")
+
+logger = logging.child_logger(__name__)
+
+class ColumnProfiling(object):
+    # opt-in timing of the column definitions of the RDataFrame graphs,
+    # each Define, Redefine and Filter is wrapped by a timer accumulating the time and number of calls per thread
+    # (DefineSlot and callables other than helper objects with a C++ type, e.g. python functions, are not timed)
+    def __init__(self):
+        self.enabled = False
+        self.dataset = None
+        self.columns = [] # (dataset, column, helper) for each profiled definition
+        self.helpers = [] # keep the helpers alive as long as they are referenced in the jitted code
+
+    def register(self, name, helper=None):
+        self.columns.append((self.dataset, name, helper))
+        return len(self.columns) - 1
+
+    def timed(self, idx, body):
+        # evaluate the original expression (possibly multi-statement) in a lambda between two clock reads
+        return (f"[&]() {{ const auto wrem_profile_t0 = std::chrono::steady_clock::now(); "
+            f"auto wrem_profile_res = [&]() {{ {body} }}(); "
+            f"wrem::profile_column({idx}, wrem_profile_t0); return wrem_profile_res; }}()")
+
+    def wrap_expression(self, name, expression):
+        idx = self.register(name)
+        # multi-statement expressions have their own return statement
+        body = expression if re.search(r"\breturn\b", expression) else f"return {expression};"
+        return self.timed(idx, body)
+
+    def wrap_helper(self, name, helper, columns):
+        # callable helper objects are called through their address in the jitted expression
+        cpp_name = type(helper).__cpp_name__
+        idx = self.register(name, cpp_name)
+        self.helpers.append(helper)
+        call = f"(*reinterpret_cast<{cpp_name}*>({ROOT.addressof(helper)}))({', '.join(columns)})"
+        return self.timed(idx, f"return {call};")
+
+    def table(self):
+        profiler = ROOT.wrem.ColumnProfiler.instance()
+        times = profiler.times(len(self.columns))
+        calls = profiler.calls(len(self.columns))
+        rows = [{"dataset" : dataset, "column" : name, "helper" : helper, "time" : float(times[i]), "calls" : int(calls[i])}
+            for i, (dataset, name, helper) in enumerate(self.columns)]
+
+        columns = {}
+        helpers = {}
+        for row in rows:
+            for summary, key in [(columns, row["column"]), (helpers, row["helper"])]:
+                if key is None:
+                    continue
+                if key not in summary:
+                    summary[key] = {"time" : 0., "calls" : 0}
+                summary[key]["time"] += row["time"]
+                summary[key]["calls"] += row["calls"]
+
+        return {
+            "columns" : dict(sorted(columns.items(), key=lambda x: x[1]["time"], reverse=True)),
+            "helpers" : dict(sorted(helpers.items(), key=lambda x: x[1]["time"], reverse=True)),
+            "by_dataset" : sorted(rows, key=lambda x: x["time"], reverse=True),
+        }
+
+    def report(self, nmax=30):
+        table = self.table()
+        logger.info("Cumulative time of the column definitions (summed over threads)")
+        logger.info(f"{'column':<50} {'time [s]':>10} {'calls':>12}")
+        for i, (name, stat) in enumerate(table["columns"].items()):
+            (logger.info if i < nmax else logger.debug)(f"{name:<50} {stat['time']:>10.2f} {stat['calls']:>12}")
+        if table["helpers"]:
+            logger.info(f"{'helper':<80} {'time [s]':>10} {'calls':>12}")
+            for name, stat in table["helpers"].items():
+                logger.info(f"{name:<80} {stat['time']:>10.2f} {stat['calls']:>12}")
+        return table
+
+column_profiling = ColumnProfiling()
+
+def profile_define(define):
+    def Define(df, name, expression, *args):
+        if column_profiling.enabled:
+            if isinstance(expression, str) and not args:
+                return define(df, name, column_profiling.wrap_expression(name, expression))
+            elif hasattr(type(expression), "__cpp_name__") and len(args) == 1 and not isinstance(args[0], str):
+                return define(df, name, column_profiling.wrap_helper(name, expression, [str(c) for c in args[0]]))
+        return define(df, name, expression, *args)
+
+    Define._profiled = True
+    return Define
+
+def profile_filter(filter_):
+    def Filter(df, expression, *args):
+        # the filters are listed by their name if given, or by their expression
+        if column_profiling.enabled and isinstance(expression, str) and all(isinstance(a, str) for a in args):
+            name = args[0] if args and args[0] else expression
+            return filter_(df, column_profiling.wrap_expression(f"Filter {name}", expression), *args)
+        return filter_(df, expression, *args)
+
+    Filter._profiled = True
+    return Filter
+
+@ROOT.pythonization("RInterface<", ns="ROOT::RDF", is_prefix=True)
+def pythonize_rdataframe_profiling(klass):
+    for method, profile in [("Define", profile_define), ("Redefine", profile_define), ("Filter", profile_filter)]:
+        func = getattr(klass, method, None)
+        if func is None or getattr(func, "_profiled", False):
+            continue
+        setattr(klass, method, profile(func))
@@ -1,11 +1,12 @@
 from utilities import common, logging
-from utilities.io_tools import input_tools
 
 import numpy as np
 
 logger = logging.child_logger(__name__)
 
 def add_recoil_uncertainty(card_tool, samples, passSystToFakes=False, pu_type="highPU", flavor="", group_compact=True):
+    # imported here such that the array helpers below can be used without ROOT and narf
+    from utilities.io_tools import input_tools
     met = input_tools.args_from_metadata(card_tool, "met")
     if flavor == "":
         flavor = input_tools.args_from_metadata(card_tool, "flavor")
@@ -126,3 +127,25 @@ def projectABCD(cardTool, h, return_variances=False, dtype="float64"):
     return flat, flat_variances
 
 
+
+def symmetrize_logk(logkup, logkdown, symmetrize=None):
+    # logkup = log(up/nominal) and logkdown = -log(down/nominal), arrays of any shape, e.g. [nvariations, nbins]
+    # returns a list of (name suffix, logkavg, logkhalfdiff) with logkhalfdiff None for symmetric variations
+    if symmetrize is None:
+        return [("", 0.5*(logkup + logkdown), 0.5*(logkup - logkdown))]
+    elif symmetrize == "conservative":
+        # symmetrize by largest magnitude of up and down variations
+        return [("", np.where(np.abs(logkup) > np.abs(logkdown), logkup, logkdown), None)]
+    elif symmetrize == "average":
+        # symmetrize by average of up and down variations
+        return [("", 0.5*(logkup + logkdown), None)]
+    elif symmetrize in ["linear", "quadratic"]:
+        # "linear" corresponds to a piecewise linear dependence of logk on theta
+        # while "quadratic" corresponds to a quadratic dependence and leads
+        # to a large variance
+        diff_fact = np.sqrt(3.) if symmetrize=="quadratic" else 1.
+
+        # split asymmetric variation into two symmetric variations
+        return [("SymAvg", 0.5*(logkup + logkdown), None), ("SymDiff", 0.5*diff_fact*(logkup - logkdown), None)]
+    else:
+        raise ValueError(f"Invalid option {symmetrize} for 'symmetrize'")
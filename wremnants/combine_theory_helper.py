@@ -280,6 +280,7 @@ class TheoryHelper(object):
                 passToFakes=self.propagate_to_fakes,
                 preOp = preop_func,
                 preOpArgs = preop_args,
+                cacheKey = {"vars" : ["pdf0"] + sel_vars, "hist_to_variations" : preop_args},
                 skipEntries = skip_entries,
                 labelsByAxis=syst_ax_labels,
                 baseName=name_append+"_",
@@ -329,6 +330,7 @@ class TheoryHelper(object):
             passToFakes=self.propagate_to_fakes,
             systNameReplace=name_replace,
             preOp=lambda h: h[{self.syst_ax : [central_var, *selected_tnp_nuisances]}],
+            cacheKey={self.syst_ax : [central_var, *selected_tnp_nuisances]},
             mirror=mirror,
             scale=scale,
             skipEntries=[{self.syst_ax : central_var},],
@@ -394,6 +396,7 @@ class TheoryHelper(object):
             passToFakes=self.propagate_to_fakes,
             systAxes=[self.syst_ax],
             preOp=lambda h: h[{self.syst_ax : var_vals}],
+            cacheKey={self.syst_ax : var_vals},
             outNames=var_names,
             group="resumNonpert",
             splitGroup={"resum": ".*"},
@@ -482,6 +485,7 @@ class TheoryHelper(object):
                     passToFakes=self.propagate_to_fakes,
                     preOp=operation,
                     preOpArgs={"entries": entries},
+                    cacheKey={self.syst_ax : [central_var], "hist_to_variations" : {"gen_axes" : gen_axes, "sum_axes" : sum_axes}},
                     # outNames=[f"{rename}Down", f"{rename}Up"] if not binned else None,
                     systNameReplace=[(entries[1], f"{rename}Up"), (entries[0], f"{rename}Down"), ],
                     skipEntries=[{self.syst_ax : central_var}],
@@ -597,6 +601,7 @@ class TheoryHelper(object):
                 symmetrize = "quadratic",
                 passToFakes=self.propagate_to_fakes,
                 preOp = lambda h: h[{"vars" : sel_vars}],
+                cacheKey = {"vars" : sel_vars},
                 outNames=outNames,
                 rename=f"resumTransitionFOScale{name_append}",
             )
@@ -1,8 +1,8 @@
 import narf
 import ROOT
+from wremnants import headers
 
-narf.clingutils.Declare('#include "theory_corrections.h"')
-
+@headers.requires("theory_corrections.h")
 def makeCorrectionsTensor(corrh, tensor=None, tensor_rank=1, weighted_corr=False):
     hist_dims = len(corrh.axes)-tensor_rank 
 
@@ -1,10 +1,10 @@
 from utilities import boostHistHelpers as hh,common,logging
 from utilities.io_tools import input_tools
+from utilities.io_tools.hist_storage import LazyHist
 from utilities.styles import styles
 import lz4.frame
 import pickle
 import h5py
-import narf
 import ROOT
 import re
 import os
@@ -17,14 +17,18 @@ import numpy as np
 
 from wremnants.datasets.datagroup import Datagroup
 from wremnants.datasets.dataset_tools import getDatasets
+from wremnants.datasets.proxy_cache import proxy_cache, proxy_types
+from wremnants.datasets.prefetcher import HistPrefetcher
 
 logger = logging.child_logger(__name__)
 
 class Datagroups(object):
 
     def __init__(self, infile, mode=None, **kwargs):
+        self.infile = infile
         self.h5file = None
         self.rtfile = None
+        self.prefetcher = None
         if infile.endswith(".pkl.lz4"):
             with lz4.frame.open(infile) as f:
                 self.results = pickle.load(f)
@@ -108,11 +112,44 @@ class Datagroups(object):
         return dsets
 
     def __del__(self):
+        if self.prefetcher:
+            self.prefetcher.close()
         if self.h5file:
             self.h5file.close()
         if self.rtfile:
             self.rtfile.Close()
 
+    def reopen(self):
+        # open the input file again, for forked processes that should not read through the handle inherited from the parent
+        if self.h5file:
+            self.h5file.close()
+            self.h5file = h5py.File(self.infile, "r")
+            self.results = input_tools.load_results_h5py(self.h5file)
+
+    def setPrefetch(self, nWorkers, depth=None):
+        # read the histograms of the next group members in parallel threads while the current one is summed
+        if self.prefetcher:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if nWorkers > 0 and self.h5file:
+            self.prefetcher = HistPrefetcher(self.results, nWorkers, depth)
+
+    def prefetchKeys(self, baseName, syst, procsToRead, forceToNominal=[], fakesMembers=[]):
+        # (process, histogram name) in the order they are read in loadHistsForDatagroups
+        keys = []
+        fakesMembersRead = set()
+        for procName in procsToRead:
+            for member in self.groups[procName].members:
+                if procName == self.fakeName and member.name in fakesMembersRead:
+                    continue
+                if procName != self.fakeName and member.name in fakesMembers:
+                    fakesMembersRead.add(member.name)
+                histname = self.histName(baseName, member.name, "" if member.name in forceToNominal else syst)
+                h = self.results[member.name]["output"].get(histname)
+                if isinstance(h, proxy_types) and h not in proxy_cache:
+                    keys.append((member.name, histname))
+        return keys
+
     def addGroup(self, name, **kwargs):
         group = Datagroup(name, **kwargs)
         self.groups[name] = group
@@ -239,14 +276,15 @@ class Datagroups(object):
             meta_info = self.getMetaInfo()
             return meta_info["command"]
 
-    # remove a histogram that is loaded into memory from a proxy object 
+    # remove a histogram that is loaded into memory from a proxy object,
+    # usually not needed since the proxy cache releases the least recently used histograms when exceeding its memory budget
     def release_results(self, histname):
         for result in self.results.values():
             if "output" not in result:
                 continue
             res = result["output"]
             if histname in res:
-                res[histname].release()
+                proxy_cache.release(res[histname])
 
     # for reading pickle files
     # as a reminder, the ND hists with tensor axes in the pickle files are organized as
@@ -291,6 +329,10 @@ class Datagroups(object):
             hasFake = False
             procsToReadSort = [x for x in procsToRead]
         # Note: if 'hasFake' is kept as False (but Fake exists), the original behaviour for which Fake reads everything again is restored
+
+        if self.prefetcher:
+            self.prefetcher.schedule(self.prefetchKeys(baseName, syst, procsToReadSort, forceToNominal, fakesMembers if hasFake else []))
+
         for procName in procsToReadSort:
             logger.debug(f"Reading group {procName}")
 
@@ -322,6 +364,18 @@ class Datagroups(object):
 
                 h_id = id(h)
 
+                if isinstance(h, LazyHist):
+                    # the members are summed over all entries of the systematic axes, so the full histogram (or its
+                    # projection) is read here, partial reads of single entries are only used by direct h[{axis : idx}] access
+                    sum_axes = [x for x in self.sum_gen_axes if x in h.axes.name]
+                    has_ops = (group.memberOp and group.memberOp[i] is not None) or (preOpMap and member.name in preOpMap)
+                    if len(sum_axes) > 0 and not has_ops:
+                        # only read the projection from the file
+                        logger.debug(f"Read projection of lazy hist summing over axes {sum_axes}")
+                        h = h.project(*[x for x in h.axes.name if x not in sum_axes])
+                    else:
+                        h = h.get()
+
                 logger.debug(f"Hist axes are {h.axes.name}")
 
                 if group.memberOp:
@@ -342,26 +396,25 @@ class Datagroups(object):
                     h = h.project(*[x for x in h.axes.name if x not in sum_axes])
                     logger.debug(f"Hist axes are now {h.axes.name}")
 
-                if h_id == id(h):
-                    logger.debug(f"Make explicit copy")
-                    h = h.copy()
-
                 if self.globalAction:
+                    if h_id == id(h):
+                        logger.debug(f"Make explicit copy")
+                        h = h.copy()
                     logger.debug("Applying global action")
                     h = self.globalAction(h)
 
-                if forceNonzero:
-                    logger.debug("force non zero")
-                    h = hh.clipNegativeVals(h, createNew=False)
-
                 scale = self.processScaleFactor(member)
                 scale *= scaleToNewLumi
                 if group.scale:
                     scale *= group.scale(member)
 
-                if not np.isclose(scale, 1, rtol=0, atol=1e-10):
+                if np.isclose(scale, 1, rtol=0, atol=1e-10):
+                    scale = 1
+                else:
                     logger.debug(f"Scale hist with {scale}")
-                    h = hh.scaleHist(h, scale, createNew=False)
+
+                # histograms to which the member is added, with the corresponding scales
+                targets = []
 
                 hasPartialSumForFake = False
                 if hasFake and procName != self.fakeName:
@@ -373,8 +426,7 @@ class Datagroups(object):
                         # apply the correct scale for fakes
                         scaleProcForFake = self.groups[self.fakeName].scale(member)
                         logger.debug(f"Summing hist {read_syst} for {member.name} to {self.fakeName} with scale = {scaleProcForFake}")
-                        hProcForFake = scaleProcForFake * h
-                        histForFake = hh.addHists(histForFake, hProcForFake, createNew=False) if histForFake else hProcForFake
+                        targets.append(("fake", scale*scaleProcForFake))
                                 
                 # The following must be done when the group is not Fake, or when the previous part for fakes was not done
                 # For fake this essentially happens when the process doesn't have the syst, so that the nominal is used
@@ -383,8 +435,30 @@ class Datagroups(object):
                         logger.debug(f"Summing nominal hist instead of {syst} to {self.fakeName} for {member.name}")
                     else:
                         logger.debug(f"Summing {read_syst} to {procName} for {member.name}")
+                    targets.append(("group", scale))
+
+                # add the clipped and scaled member in one pass to the sums with the same axes,
+                # sums with different axes (e.g. members without the syst axis) are broadcasted
+                sums = {"fake" : histForFake, "group" : group.hists[label]}
+                fused = []
+                for target, target_scale in targets:
+                    hsum = sums[target]
+                    if hsum is None:
+                        hsum = hist.Hist(*h.axes, storage=h.storage_type())
+                    elif hsum.storage_type != h.storage_type or hsum.axes != h.axes:
+                        hmember = hh.clipNegativeVals(h, createNew=True) if forceNonzero else h
+                        hmember = hh.scaleHist(hmember, target_scale, createNew=True)
+                        sums[target] = hh.addHists(hsum, hmember, createNew=False)
+                        continue
+                    sums[target] = hsum
+                    fused.append((hsum, target_scale))
 
-                    group.hists[label] = hh.addHists(group.hists[label], h, createNew=False) if group.hists[label] else h
+                if fused:
+                    hh.accumulateHists(h, fused, clipValue=0 if forceNonzero else None)
+
+                histForFake = sums["fake"]
+                group.hists[label] = sums["group"]
+                h = None
 
             if not nominalIfMissing and group.hists[label] is None:
                 continue
@@ -411,6 +485,9 @@ class Datagroups(object):
                 logger.debug(f"Apply rebin operation for process {procName}")
                 group.hists[label] = self.rebinOp(group.hists[label])
 
+        if self.prefetcher:
+            self.prefetcher.clear()
+
         # Avoid situation where the nominal is read for all processes for this syst
         if nominalIfMissing and not foundExact:
             raise ValueError(f"Did not find systematic {syst} for any processes!")
@@ -557,7 +634,7 @@ class Datagroups(object):
 
         if histToReadAxes not in self.results[base_members[0].name]["output"]:
             raise ValueError(f"Results for member {base_members[0].name} does not include xnorm. Found {self.results[base_members[0].name]['output'].keys()}")
-        nominal_hist = self.results[base_members[0].name]["output"][histToReadAxes].get()
+        nominal_hist = proxy_cache.get(self.results[base_members[0].name]["output"][histToReadAxes])
 
         self.gen_axes[new_name] = [ax for ax in nominal_hist.axes if ax.name in axesToRead]
         logger.debug(f"New gen axes are: {self.gen_axes}")
@@ -661,10 +738,13 @@ class Datagroups(object):
             raise ValueError(f"Histogram {histname} not found for process {proc.name}")
 
         h = output[histname]
-        if isinstance(h, narf.ioutils.H5PickleProxy):
-            h = h.get()
+        if self.prefetcher and h not in proxy_cache:
+            hprefetched = self.prefetcher.get((proc.name, histname))
+            if hprefetched is not None:
+                # counted in the cache budget as if it was read through the proxy
+                return proxy_cache.put(h, hprefetched)
 
-        return h
+        return proxy_cache.get(h)
 
     def histName(self, baseName, procName="", syst=""):
         return Datagroups.histName(baseName, procName, syst, nominalName=self.nominalName)
@@ -1,5 +1,6 @@
 import narf
 from utilities import logging
+import concurrent.futures
 import subprocess
 import sys
 import os
@@ -14,6 +15,8 @@ from wremnants.datasets.datasetDict_lowPU import dataDictLowPU
 import ROOT
 import XRootD.client
 from wremnants.datasets.datasetDict2018_v9 import dataDictV9_2018
+from wremnants.datasets.filelist_cache import FileListCache
+from wremnants.datasets.work_balancing import EntryCountCache
 
 logger = logging.child_logger(__name__)
 
@@ -26,16 +29,38 @@ default_nfiles = {
     'ZtautauPostVFP' : 1200,
 }
 
-def buildFileListPosix(path):
+def listDirPosix(path):
+    # files and subdirectories of a single directory
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif entry.name.lower().endswith(".root"):
+                    files.append(entry.path)
+    except FileNotFoundError:
+        pass
+    return files, dirs
+
+def walkConcurrently(path, list_dir, num_threads=16):
+    # breadth-first listing of the directory tree, the directories of each level are listed in a pool of threads
     outfiles = []
-    for root, dirs, fnames in os.walk(path):
-        for fname in fnames:
-            if fname.lower().endswith(".root"):
-                outfiles.append(f"{root}/{fname}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        level = [path]
+        while level:
+            nextlevel = []
+            for files, dirs in pool.map(list_dir, level):
+                outfiles.extend(files)
+                nextlevel.extend(dirs)
+            level = nextlevel
 
-    return outfiles
+    return sorted(outfiles)
 
-def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False, num_clients = 16):
+def buildFileListPosix(path, num_threads=16):
+    return walkConcurrently(path, listDirPosix, num_threads=num_threads)
+
+def listDirXrd(xrdfs, path, suffixes = [".root"], num_clients = 16):
     status, dirlist = xrdfs.dirlist(path, flags = XRootD.client.flags.DirListFlags.STAT)
 
     if not status.ok:
@@ -44,16 +69,16 @@ def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False,
         else:
             raise RuntimeError(f"Error in XRootD.client.FileSystem.dirlist: {status.message}, {status.code}, {status.errno}")
 
-        return
+        return [], []
 
+    files, dirs = [], []
     for diritem in dirlist:
         is_dir = diritem.statinfo.flags & XRootD.client.flags.StatInfoFlags.IS_DIR
         is_other = diritem.statinfo.flags & XRootD.client.flags.StatInfoFlags.OTHER
         is_file = not (is_dir or is_other)
 
-        if is_dir and recurse:
-            childpath = f"{path}/{diritem.name}"
-            appendFilesXrd(filelist, xrdfs, childpath, suffixes=suffixes, recurse=recurse, num_clients=num_clients)
+        if is_dir:
+            dirs.append(f"{path}/{diritem.name}")
         elif is_file:
             lowername = diritem.name.lower()
             matchsuffix = False
@@ -71,28 +96,60 @@ def appendFilesXrd(filelist, xrdfs, path, suffixes = [".root"], recurse = False,
                 else:
                     outname = f"{xrdfs.url.protocol}://{xrdfs.url.hostid}/{path}/{diritem.name}"
 
-                filelist.append(outname)
+                files.append(outname)
+
+    return files, dirs
 
-def buildFileListXrd(path, num_clients = 16):
+def buildFileListXrd(path, num_clients = 16, num_threads = 16):
     xrdurl =  XRootD.client.URL(path)
 
     if not xrdurl.is_valid():
         raise ValueError(f"Invalid xrootd path {path}")
 
+    # the synchronous calls of the XRootD bindings release the GIL, such that directories are listed concurrently
     xrdfs = XRootD.client.FileSystem(xrdurl.hostid)
-    xrdpath = xrdurl.path
-
-    outfiles = []
-    appendFilesXrd(outfiles, xrdfs, xrdpath, recurse=True, num_clients=num_clients)
+    return walkConcurrently(xrdurl.path, lambda p: listDirXrd(xrdfs, p, num_clients=num_clients), num_threads=num_threads)
 
-    return outfiles
+def dirModificationTime(path):
+    # modification time of the directory, used to invalidate cached file lists, or None if not available
+    xrdprefix = "root://"
+    if path.startswith(xrdprefix):
+        xrdurl = XRootD.client.URL(path)
+        if not xrdurl.is_valid():
+            return None
+        status, statinfo = XRootD.client.FileSystem(xrdurl.hostid).stat(xrdurl.path)
+        return statinfo.modtime if status.ok else None
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def buildFileList(path, cache=None):
+    xrdprefix = "root://"
+    build = lambda p: buildFileListXrd(p) if p.startswith(xrdprefix) else buildFileListPosix(p)
+    if cache is None:
+        return build(path)
+    return cache.get(path, build, dirModificationTime)
 
-def buildFileList(path):
+def prefetchFileLists(paths, cache):
+    # list the paths concurrently and store them in the cache
     xrdprefix = "root://"
-    return buildFileListXrd(path) if path.startswith(xrdprefix) else buildFileListPosix(path)
+    build = lambda p: buildFileListXrd(p) if p.startswith(xrdprefix) else buildFileListPosix(p)
+    cache.get_many(paths, build, dirModificationTime)
+
+def makeFileListCache(args):
+    # file list cache stored next to the output of the histmakers
+    filename = os.path.join(args.outfolder if args.outfolder else ".", "filelist_cache.json")
+    return FileListCache(filename, ttl=args.fileListTTL*3600 if args.fileListTTL >= 0 else None, refresh=args.refreshFileLists)
+
+def makeEntryCountCache(args):
+    # cache of the number of entries of the input files for the balancing of the work between the threads
+    if not getattr(args, "balanceWork", False):
+        return None
+    return EntryCountCache(os.path.join(args.outfolder if args.outfolder else ".", "entry_cache.json"))
 
 #TODO add the rest of the samples!
-def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_data=False, oneMCfileEveryN=None):
+def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_data=False, oneMCfileEveryN=None, cache=None):
     filelist = []
     expandedPaths = []
     for orig_path in paths:
@@ -107,7 +164,7 @@ def makeFilelist(paths, maxFiles=-1, base_path=None, nano_prod_tags=None, is_dat
             expandedPaths.append(path)
             logger.debug(f"Reading files from path {path}")
 
-            files = buildFileList(path)
+            files = buildFileList(path, cache=cache)
             if maxFiles > 0 and len(files) >= maxFiles:
                 break
 
@@ -211,9 +268,22 @@ def is_zombie(file_path):
     file.Close()
     return False
 
+def shardFilelist(filelist, shard):
+    # deterministic partition of the files, independent of the order in which they were listed
+    ishard, nshards = shard
+    return sorted(filelist)[ishard::nshards]
+
+def getDatasetGroups():
+    # group of each known dataset (from all eras and modes)
+    groups = {}
+    for dataDict in [dataDictV9extended, dataDictV9, dataDictV9_2018, genDataDict, dataDictLowPU]:
+        groups.update({name : info.get("group") for name, info in dataDict.items()})
+    return groups
+
 def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_path=None, nanoVersion="v9",
                 data_tags=["TrackFitV722_NanoProdv3", "TrackFitV722_NanoProdv2"],
-                mc_tags=["TrackFitV722_NanoProdv3", "TrackFitV718_NanoProdv1"], oneMCfileEveryN=None, checkFileForZombie=False, era="2016PostVFP", extended=True):
+                mc_tags=["TrackFitV722_NanoProdv3", "TrackFitV718_NanoProdv1"], oneMCfileEveryN=None, checkFileForZombie=False, era="2016PostVFP", extended=True,
+                shard=None, filelist_cache=None):
 
     if maxFiles is None or (isinstance(maxFiles, int) and maxFiles < -1):
         maxFiles=default_nfiles
@@ -242,6 +312,17 @@ def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_p
     elif mode and "lowpu" in mode:
         dataDict = dataDictLowPU
 
+    def sample_base_path(sample):
+        return base_path.replace("NanoAOD", "NanoGen") if sample in genDataDict else base_path
+
+    if filelist_cache is not None:
+        # list the paths with the first production tag of all samples concurrently, the fallbacks are listed on demand
+        first_paths = []
+        for sample, info in dataDict.items():
+            prod_tags = data_tags if info.get("group","") == "Data" else mc_tags
+            first_paths += [p.format(BASE_PATH=sample_base_path(sample), NANO_PROD_TAG=prod_tags[0]) for p in info["filepaths"]]
+        prefetchFileLists(first_paths, filelist_cache)
+
     narf_datasets = []
     for sample,info in dataDict.items():
         if sample in genDataDict:
@@ -253,11 +334,16 @@ def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_p
         nfiles = maxFiles
         if type(maxFiles) == dict:
             nfiles = maxFiles[sample] if sample in maxFiles else -1
-        paths = makeFilelist(info["filepaths"], nfiles, base_path=base_path, nano_prod_tags=prod_tags, is_data=is_data, oneMCfileEveryN=oneMCfileEveryN)
+        paths = makeFilelist(info["filepaths"], nfiles, base_path=base_path, nano_prod_tags=prod_tags, is_data=is_data, oneMCfileEveryN=oneMCfileEveryN, cache=filelist_cache)
 
         if checkFileForZombie:
             paths = [p for p in paths if not is_zombie(p)]
 
+        if shard is not None:
+            nfiles_all = len(paths)
+            paths = shardFilelist(paths, shard)
+            logger.debug(f"Using {len(paths)} of {nfiles_all} files for shard {shard[0]}/{shard[1]} of {sample}")
+
         #paths = list(filter(lambda x: not ("WminusJetsToMuNu" in x and os.path.basename(x) in ["NanoV9MCPostVFP_4316.root","NanoV9MCPostVFP_4372.root","NanoV9MCPostVFP_4310.root","NanoV9MCPostVFP_4377.root","NanoV9MCPostVFP_4306.root"]), paths))
 
         if not paths:
@@ -286,6 +372,9 @@ def getDatasets(maxFiles=default_nfiles, filt=None, excl=None, mode=None, base_p
             )
         narf_datasets.append(narf.Dataset(**narf_info))
 
+    if filelist_cache is not None:
+        filelist_cache.save()
+
     narf_datasets = filterProcs(filt, narf_datasets)
     narf_datasets = excludeProcs(excl, narf_datasets)
 
@@ -0,0 +1,74 @@
+import concurrent.futures
+import json
+import os
+import time
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+class FileListCache(object):
+    """
+    Persistent cache of the files found under the dataset paths, stored as json.
+    Entries are invalidated after ttl seconds or when the modification time of the listed directory changed
+    (only the top directory is checked, files added in subdirectories are found once the entry expired).
+    The listings of several paths are done concurrently in a pool of threads.
+    """
+    def __init__(self, filename, ttl=24*3600, refresh=False, nWorkers=16):
+        self.filename = filename
+        self.ttl = ttl
+        self.nWorkers = nWorkers
+        self.entries = {}
+        self.checked = set() # paths validated or listed in this job
+        self.modified = False
+        if refresh:
+            logger.info("Refresh the cached file lists")
+        elif filename and os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read the file list cache {filename}: {e}")
+
+    def valid(self, path, mtime):
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        if self.ttl is not None and time.time() - entry["time"] > self.ttl:
+            logger.debug(f"Cached file list of {path} expired")
+            return False
+        if mtime is not None and entry["mtime"] != mtime:
+            logger.debug(f"Directory {path} was modified since it was listed")
+            return False
+        return True
+
+    def get_many(self, paths, list_files, dir_mtime):
+        # file lists of the paths, list_files(path) is only called for paths without valid cache entries
+        paths = list(dict.fromkeys(paths))
+        unchecked = [p for p in paths if p not in self.checked]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.nWorkers)) as pool:
+            mtimes = dict(zip(unchecked, pool.map(dir_mtime, unchecked)))
+            missing = [p for p in unchecked if not self.valid(p, mtimes[p])]
+            if missing:
+                logger.info(f"List the files of {len(missing)} paths ({len(paths)-len(missing)} cached)")
+            for path, files in zip(missing, pool.map(list_files, missing)):
+                self.entries[path] = {"time" : time.time(), "mtime" : mtimes[path], "files" : files}
+                self.modified = True
+        self.checked.update(unchecked)
+
+        return {p : self.entries[p]["files"] for p in paths}
+
+    def get(self, path, list_files, dir_mtime):
+        return self.get_many([path], list_files, dir_mtime)[path]
+
+    def save(self):
+        if not self.filename or not self.modified:
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmpfile = f"{self.filename}.tmp{os.getpid()}"
+        with open(tmpfile, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmpfile, self.filename)
+        self.modified = False
+        logger.debug(f"File list cache written to {self.filename}")
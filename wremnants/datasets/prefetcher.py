@@ -0,0 +1,67 @@
+import collections
+import concurrent.futures
+import os
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+class HistPrefetcher(object):
+    # reads and unpickles histograms of the input file in a pool of threads ahead of their use
+    # (h5py and lz4 release the GIL while reading and decompressing), the histograms are returned
+    # in the order they are requested so that sums are reproducible
+    def __init__(self, results, nWorkers, depth=None):
+        self.results = results
+        self.pid = os.getpid()
+        self.depth = depth if depth else 2*nWorkers # maximum number of histograms read ahead
+        self.pending = collections.deque()
+        self.futures = {}
+        logger.info(f"Start {nWorkers} threads to prefetch histograms")
+        self.pool = concurrent.futures.ThreadPoolExecutor(nWorkers)
+
+    @property
+    def active(self):
+        # the pool can only be used from the process that created it (not e.g. from forked workers)
+        return self.pool is not None and os.getpid() == self.pid
+
+    def read(self, proc, histname):
+        h = self.results[proc]["output"][histname]
+        obj = h.get()
+        # the proxy does not keep the object, it is held by the proxy cache once it is used
+        h.release()
+        return obj
+
+    def schedule(self, keys):
+        # keys are (process, histogram name) tuples in the order they will be read
+        if not self.active:
+            return
+        self.pending.extend(keys)
+        self.fill()
+
+    def fill(self):
+        while self.pending and len(self.futures) < self.depth:
+            key = self.pending.popleft()
+            if key not in self.futures:
+                self.futures[key] = self.pool.submit(self.read, *key)
+
+    def get(self, key):
+        # returns the prefetched histogram, or None if it was not scheduled
+        if not self.active or key not in self.futures:
+            return None
+        h = self.futures.pop(key).result()
+        self.fill()
+        return h
+
+    def clear(self):
+        # drop histograms that were scheduled but not used, the reads that did not start yet are cancelled
+        # and the results of the running ones are discarded
+        if not self.active:
+            return
+        self.pending.clear()
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+
+    def close(self):
+        if self.active:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = None
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+import narf
+import os
+import sys
+from utilities import logging
+from utilities.io_tools.hist_storage import PickledProxy
+
+logger = logging.child_logger(__name__)
+
+# objects that keep what they loaded until they are released
+proxy_types = (narf.ioutils.H5PickleProxy, PickledProxy)
+
+class ProxyCache(object):
+    # size-aware least-recently-used cache of the objects loaded through H5PickleProxy,
+    # the least recently used objects are released from their proxies when the total size exceeds the budget.
+    # The budget only covers these input histograms: histograms in sliceable format (LazyHist) are read on each
+    # access and not kept, the sums of the group members (one per group and label in Datagroup.hists)
+    # and the arrays of the writers are not counted
+    def __init__(self, budget=None):
+        self.budget = budget # in bytes, None for no limit
+        self.entries = OrderedDict() # id(proxy) -> (proxy, obj, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.evict()
+
+    @staticmethod
+    def size(obj):
+        if hasattr(obj, "view"):
+            try:
+                return obj.view(flow=True).nbytes
+            except TypeError:
+                return obj.view().nbytes
+        return sys.getsizeof(obj)
+
+    def __contains__(self, proxy):
+        return id(proxy) in self.entries
+
+    def get(self, proxy):
+        if not isinstance(proxy, proxy_types):
+            return proxy
+
+        key = id(proxy)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][1]
+
+        self.misses += 1
+        return self.put(proxy, proxy.get())
+
+    def put(self, proxy, obj):
+        # add an object loaded for the proxy elsewhere (e.g. read ahead by the prefetcher)
+        key = id(proxy)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        nbytes = self.size(obj)
+        self.entries[key] = (proxy, obj, nbytes)
+        self.nbytes += nbytes
+        self.evict()
+        return obj
+
+    def evict(self):
+        # always keep the most recently used object, even if it alone exceeds the budget
+        while self.budget is not None and self.nbytes > self.budget and len(self.entries) > 1:
+            key, (proxy, obj, nbytes) = self.entries.popitem(last=False)
+            logger.debug(f"Release object of {nbytes/1024**2:.1f} MB from cache")
+            proxy.release()
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def release(self, proxy):
+        key = id(proxy)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        proxy.release()
+
+    def clear(self):
+        for proxy, obj, nbytes in self.entries.values():
+            proxy.release()
+        self.entries.clear()
+        self.nbytes = 0
+
+    def summary(self):
+        return (f"Histogram cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+            f"{len(self.entries)} objects with {self.nbytes/1024**3:.2f} GB in memory (budget {'none' if self.budget is None else f'{self.budget/1024**3:.2f} GB'})")
+
+def default_budget(fraction=0.5):
+    # a fraction of the physical memory of the machine, 4 GB if it can not be determined
+    try:
+        return int(fraction*os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES"))
+    except (ValueError, OSError, AttributeError):
+        return 4*1024**3
+
+# process wide cache used by Datagroups, the budget is set by the scripts (e.g. --histCacheBudget of setupCombine)
+proxy_cache = ProxyCache(budget=default_budget())
@@ -0,0 +1,108 @@
+import concurrent.futures
+import heapq
+import json
+import os
+import re
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+# entries and number of clusters of the scanned files, used to estimate the utilisation of the threads
+file_entries = {}
+
+def file_key(path):
+    # the client names added to xrootd urls to force multiple connections are not part of the identity of the file
+    return re.sub(r"://user_\d+@", "://", path)
+
+def count_entries(path, treename="Events"):
+    # number of entries and clusters from the metadata of the tree, without reading any baskets
+    import uproot
+    with uproot.open(path) as f:
+        tree = f[treename]
+        offsets = tree.common_entry_offsets()
+        return [int(tree.num_entries), max(1, len(offsets) - 1)]
+
+class EntryCountCache(object):
+    # persistent cache of the entry counts of the input files, which do not change for a given file
+    def __init__(self, filename, nWorkers=16):
+        self.filename = filename
+        self.nWorkers = nWorkers
+        self.entries = {}
+        self.modified = False
+        if filename and os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read the entry count cache {filename}: {e}")
+
+    def scan(self, paths):
+        # one path per file, the same file can be listed with different client names
+        missing = {}
+        for p in paths:
+            if file_key(p) not in self.entries:
+                missing.setdefault(file_key(p), p)
+        missing = list(missing.values())
+        if missing:
+            logger.info(f"Scan the entries of {len(missing)} files ({len(paths)-len(missing)} cached)")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.nWorkers)) as pool:
+                futures = {pool.submit(count_entries, p) : p for p in missing}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        self.entries[file_key(futures[future])] = future.result()
+                        self.modified = True
+                    except Exception as e:
+                        logger.warning(f"Could not scan the entries of {futures[future]}: {e}")
+        return {p : self.entries[file_key(p)] for p in paths if file_key(p) in self.entries}
+
+    def save(self):
+        if not self.filename or not self.modified:
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmpfile = f"{self.filename}.tmp{os.getpid()}"
+        with open(tmpfile, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmpfile, self.filename)
+        self.modified = False
+
+def dataset_entries(dataset):
+    return sum(file_entries[p][0] for p in dataset.filepaths if p in file_entries)
+
+def simulate_utilisation(datasets, nThreads):
+    # fraction of the thread time spent processing with a greedy assignment of the clusters, in the order
+    # of the datasets and files, to the next free thread (as with the task based parallelism of the event loop)
+    nThreads = max(1, nThreads)
+    threads = [0.]*nThreads
+    total = 0.
+    for dataset in datasets:
+        for path in dataset.filepaths:
+            if path not in file_entries:
+                continue
+            entries, nclusters = file_entries[path]
+            size = entries/nclusters
+            for i in range(nclusters):
+                heapq.heappush(threads, heapq.heappop(threads) + size)
+            total += entries
+    makespan = max(threads)
+    return total/(nThreads*makespan) if makespan > 0 else 1.
+
+def balance(datasets, cache, nThreads):
+    """
+    Scan the entries of the input files and order the work such that the largest units are started first
+    (longest processing time first): datasets by decreasing number of entries and files within each dataset
+    by decreasing number of entries. The event loop splits the files in clusters, so no further splitting is needed.
+    """
+    file_entries.update(cache.scan([p for d in datasets for p in d.filepaths]))
+    cache.save()
+
+    before = simulate_utilisation(datasets, nThreads)
+
+    for dataset in datasets:
+        dataset.filepaths = sorted(dataset.filepaths, key=lambda p: file_entries.get(p, [0])[0], reverse=True)
+    datasets = sorted(datasets, key=dataset_entries, reverse=True)
+
+    after = simulate_utilisation(datasets, nThreads)
+    logger.info(f"Expected utilisation of {nThreads} threads: {before:.1%} with the original order, {after:.1%} after balancing")
+    return datasets
@@ -0,0 +1,48 @@
+import functools
+import pathlib
+from utilities import logging
+
+logger = logging.child_logger(__name__)
+
+include_dir = f"{pathlib.Path(__file__).parent}/include/"
+
+# headers of the functions used in the column definitions, declared together once the arguments are parsed
+registered = []
+declared = set()
+eager = False
+
+def declare(*headers):
+    # include the headers in the interpreter, each header is only compiled once
+    headers = [h for h in headers if h not in declared]
+    if not headers:
+        return
+    import ROOT
+    import narf.clingutils
+    if not declared:
+        ROOT.gInterpreter.AddIncludePath(include_dir)
+    for header in headers:
+        logger.debug(f"Declare {header}")
+        narf.clingutils.Declare(f'#include "{header}"')
+        declared.add(header)
+
+def register(*headers):
+    # headers needed by the column definitions of a module, they are declared by declare_registered
+    # (or immediately if that already happened, e.g. for modules imported after the argument parsing)
+    registered.extend(h for h in headers if h not in registered)
+    if eager:
+        declare(*headers)
+
+def declare_registered():
+    global eager
+    eager = True
+    declare(*registered)
+
+def requires(*headers):
+    # decorator for the functions constructing the helpers, the headers are declared on the first call
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            declare(*headers)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,7 +1,6 @@
 import ROOT
 import pathlib
 import hist
-import narf.clingutils
 import uproot
 import pathlib
 import hist
@@ -9,17 +8,17 @@ import pickle
 import lz4.frame
 from .correctionsTensor_helper import makeCorrectionsTensor
 from .theory_tools import moments_to_angular_coeffs
+from . import headers
 from utilities import common, logging
 from utilities import boostHistHelpers as hh
 from utilities.io_tools import input_tools
 import numpy as np
 import h5py
 import hdf5plugin
-import narf
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "syst_helicity_utils.h"')
+headers.register("syst_helicity_utils.h")
 
 data_dir = f"{pathlib.Path(__file__).parent}/data/"
 
@@ -1,11 +1,175 @@
-from narf.ioutils import H5PickleProxy
+import hist
+import numpy as np
 import time
 from utilities import logging
+from utilities import boostHistHelpers as hh
+from wremnants import headers
 
 logger = logging.child_logger(__name__)
 
+# bytes per bin for the storage types of the booked histograms
+storage_bytes = {
+    "Double" : 8,
+    "Int64" : 8,
+    "AtomicInt64" : 8,
+    "Unlimited" : 8,
+    "Weight" : 16,
+    "Mean" : 24,
+    "WeightedMean" : 32,
+}
+
+class BookingInventory(object):
+    # sizes of the histograms booked with HistoBoost, to estimate the memory before the event loop
+    def __init__(self):
+        self.entries = []
+        self.dataset = None
+        # set once HistoBoost is wrapped to record the booked histograms
+        self.wrapped = False
+
+    def record(self, name, axes, storage=hist.storage.Weight(), force_atomic=None, var_axis_names=None, tensor_axes=None, **kwargs):
+        import ROOT
+        nbins = int(np.prod([ax.extent for ax in axes]))
+        ntensor = int(np.prod([ax.extent for ax in tensor_axes])) if tensor_axes else 1
+        nbytes = storage_bytes.get(type(storage).__name__, 8)
+        # one copy per thread slot is filled and merged into the result, unless filled atomically
+        # (the default of narf with implicit multithreading)
+        if force_atomic is None:
+            force_atomic = ROOT.ROOT.IsImplicitMTEnabled()
+        ncopies = 1 if force_atomic else max(1, ROOT.ROOT.GetThreadPoolSize()) + 1
+        self.entries.append({
+            "dataset" : self.dataset,
+            "name" : name,
+            "nbins" : nbins,
+            "ntensor" : ntensor,
+            "storage" : type(storage).__name__,
+            "ncopies" : ncopies,
+            "size" : nbins*ntensor*nbytes*ncopies,
+        })
+
+    def total(self):
+        return sum(e["size"] for e in self.entries)
+
+    def report(self, nmax=20):
+        if not self.wrapped:
+            logger.warning("HistoBoost was not wrapped, the memory of the booked histograms is not estimated")
+            return
+        entries = sorted(self.entries, key=lambda e: e["size"], reverse=True)
+        logger.info(f"Estimated memory of {len(entries)} booked histograms: {self.total()/1024**3:.2f} GB")
+        logger.info(f"{'dataset':<30} {'histogram':<40} {'bins':>10} {'tensor':>8} {'storage':>8} {'copies':>6} {'size [MB]':>10}")
+        for i, e in enumerate(entries):
+            line = f"{str(e['dataset']):<30} {e['name']:<40} {e['nbins']:>10} {e['ntensor']:>8} {e['storage']:>8} {e['ncopies']:>6} {e['size']/1024**2:>10.1f}"
+            if i < nmax:
+                logger.info(line)
+            else:
+                logger.debug(line)
+
+    def check(self, budget):
+        # budget in GB
+        if budget is not None and not self.wrapped:
+            raise RuntimeError("HistoBoost was not wrapped, the booked histograms can not be checked against the memory budget")
+        if budget is not None and self.total() > budget*1024**3:
+            raise RuntimeError(f"Estimated memory of the booked histograms of {self.total()/1024**3:.2f} GB exceeds the budget of {budget} GB "
+                "(reduce the number of threads or the booked systematics, or increase --memoryBudget)")
+
+booking_inventory = BookingInventory()
+
+def record_bookings():
+    # record the histograms booked with HistoBoost in the booking inventory, the pythonization is registered
+    # after the one of narf that adds HistoBoost (when narf is imported) and is applied to the classes in use
+    if record_bookings.registered:
+        return
+    import ROOT
+
+    @ROOT.pythonization("RInterface<", ns="ROOT::RDF", is_prefix=True)
+    def pythonize_rdataframe_booking(klass):
+        histo_boost = getattr(klass, "HistoBoost", None)
+        if histo_boost is None:
+            logger.debug(f"No HistoBoost to wrap in {klass.__name__}")
+            return
+        booking_inventory.wrapped = True
+        if getattr(histo_boost, "_recorded", False):
+            return
+
+        def HistoBoost(df, name, axes, cols, *args, **kwargs):
+            try:
+                booking_inventory.record(name, axes, *args, **kwargs)
+            except Exception as e:
+                logger.debug(f"Could not estimate the size of histogram {name}: {e}")
+            return histo_boost(df, name, axes, cols, *args, **kwargs)
+
+        HistoBoost._recorded = True
+        klass.HistoBoost = HistoBoost
+
+    record_bookings.registered = True
+
+record_bookings.registered = False
+
+def build_and_run(datasets, build_graph, memoryBudget=None, profileColumns=False, skimmer=None, incremental=None, entry_cache=None):
+    # run narf.build_and_run, reporting the estimated memory of the booked histograms before the event loop
+    # and aborting if it exceeds the memory budget (in GB), optionally timing each column definition,
+    # reading from or writing skims of the selected events, skipping datasets with reusable results
+    # and ordering the datasets and files by their number of entries, the achieved utilisation of the threads is reported
+    import narf
+    import ROOT
+    record_bookings()
+    booking_inventory.entries = []
+    # normally done when parsing the arguments of the histmakers
+    headers.declare_registered()
+
+    if incremental is not None:
+        datasets = incremental.datasets_to_run(datasets)
+        if not datasets:
+            logger.info("All results are reused, nothing to run")
+            return {}
+
+    if skimmer is not None:
+        datasets = skimmer.use_skims(datasets)
+
+    nThreads = max(1, ROOT.ROOT.GetThreadPoolSize())
+    if entry_cache is not None:
+        from wremnants.datasets import work_balancing
+        datasets = work_balancing.balance(datasets, entry_cache, nThreads)
+
+    ngraphs = [0]
+    loop_start = [time.time(), time.process_time()]
+
+    if profileColumns:
+        from wremnants.column_profiling import column_profiling
+        column_profiling.enabled = True
+
+    def build_graph_with_inventory(df, dataset):
+        booking_inventory.dataset = dataset.name
+        if profileColumns:
+            column_profiling.dataset = dataset.name
+        result = build_graph(df, dataset)
+        ngraphs[0] += 1
+        if ngraphs[0] == len(datasets):
+            booking_inventory.report()
+            booking_inventory.check(memoryBudget)
+            loop_start[:] = [time.time(), time.process_time()]
+        return result
+
+    resultdict = narf.build_and_run(datasets, build_graph_with_inventory)
+
+    # the process time includes the threads of the event loop
+    wall = time.time() - loop_start[0]
+    cpu = time.process_time() - loop_start[1]
+    if wall > 0:
+        logger.info(f"Event loop took {wall:.1f} s wall time and {cpu:.1f} s CPU time, "
+            f"achieved utilisation of {nThreads} threads: {cpu/(wall*nThreads):.1%}")
+
+    if skimmer is not None:
+        skimmer.finalize(resultdict)
+
+    if profileColumns:
+        column_profiling.report()
+
+    return resultdict
+
 def scale_to_data(result_dict):
-    # scale histograms by lumi*xsec/sum(gen weights)
+    # normalization of the simulation to lumi*xsec/sum(gen weights), the histograms are left untouched since the factor
+    # is applied when reading them (Datagroups.processScaleFactor and input_tools.load_and_scale compute it from the
+    # luminosity, cross section and sum of weights), the factors are returned for aggregate_groups
     time0 = time.time()
 
     lumi = [result["lumi"] for result in result_dict.values() if result["dataset"]["is_data"]]
@@ -15,88 +179,144 @@ def scale_to_data(result_dict):
         lumi = sum(lumi)
 
     logger.warning(f"Scale histograms with luminosity = {lumi} /fb")
+    scales = {}
     for d_name, result in result_dict.items():
-        if result["dataset"]["is_data"]:
+        if result["dataset"]["is_data"] or result.get("reused", False):
             continue
 
         xsec = result["dataset"]["xsec"]
 
         logger.debug(f"For dataset {d_name} with xsec={xsec}")
 
-        scale = lumi * 1000 * xsec / result["weight_sum"]
-
-        result["weight_sum"] = result["weight_sum"]*scale
-
-        for h_name, histogram in result["output"].items():
-
-            histo = histogram.get()
-
-            histo *= scale
+        scales[d_name] = lumi * 1000 * xsec / result["weight_sum"]
 
     logger.info(f"Scale to data: {time.time() - time0}")
+    return scales
 
 
-def aggregate_groups(datasets, result_dict, groups_to_aggregate):
-    # add members of groups together
+def aggregate_groups(datasets, result_dict, groups_to_aggregate, scales={}):
+    # add members of groups together, applying the scale of each member (from scale_to_data), one histogram at a time
+    from narf.ioutils import H5PickleProxy
     time0 = time.time()
 
     for group in groups_to_aggregate:
 
         dataset_names = [d.name for d in datasets if d.group == group]
-        if len(dataset_names) == 0:
+        members = [name for name, result in result_dict.items() if result["dataset"]["name"] in dataset_names]
+        if len(members) == 0:
             continue
 
-        logger.debug(f"Aggregate group {group}")
+        logger.debug(f"Aggregate group {group} with members {members}")
 
-        resdict = None
-        members = {}
-        to_del = []
-        for name, result in result_dict.items():
-            if result["dataset"]["name"] not in dataset_names:
-                continue
+        # the sum of weights of the group is such that the aggregated histograms are not scaled again
+        resdict = {
+            "n_members": len(members),
+            "dataset": {
+                "name": group,
+                "xsec": sum(result_dict[name]["dataset"]["xsec"] for name in members),
+                "filepaths": [f for name in members for f in result_dict[name]["dataset"]["filepaths"]],
+            },
+            "weight_sum": sum(float(result_dict[name]["weight_sum"])*scales.get(name, 1) for name in members),
+            "event_count": sum(float(result_dict[name]["event_count"]) for name in members),
+        }
 
-            logger.debug(f"Add {name}")
-
-            for h_name, histogram in result["output"].items():
-                if h_name in members.keys():
-                    members[h_name].append(histogram.get())
-                else:
-                    members[h_name] = [histogram.get()]
-
-            if resdict is None:
-                resdict = {
-                    "n_members": 1,
-                    "dataset": {
-                        "name": group,
-                        "xsec": result["dataset"]["xsec"],
-                        "filepaths": result["dataset"]["filepaths"],
-                    },
-                    "weight_sum": float(result["weight_sum"]),
-                    "event_count": float(result["event_count"])
-                }
-            else:
-                resdict["dataset"]["xsec"] += result["dataset"]["xsec"]
-                resdict["dataset"]["filepaths"] += result["dataset"]["filepaths"]
-                resdict["n_members"] += 1
-                resdict["weight_sum"] += float(result["weight_sum"])
-                resdict["event_count"] += float(result["event_count"])
-
-            to_del.append(name)
+        hist_names = []
+        for name in members:
+            hist_names += [h_name for h_name in result_dict[name]["output"].keys() if h_name not in hist_names]
 
         output = {}
-        for h_name, histograms in members.items():
+        for h_name in hist_names:
+            hsum = None
+            nmembers = 0
+            for name in members:
+                member_output = result_dict[name]["output"]
+                if h_name not in member_output:
+                    continue
+                scale = scales.get(name, 1)
+                # drop the reference of the member such that its histogram can be freed once it is added
+                histo = member_output.pop(h_name).get()
+                if hsum is None:
+                    hsum = histo
+                    if scale != 1:
+                        hsum *= scale
+                else:
+                    hh.accumulateHists(histo, [(hsum, scale)])
+                histo = None
+                nmembers += 1
 
-            if len(histograms) != resdict["n_members"]:
-                logger.warning(f"There is a different number of histograms ({len(histograms)}) than original members {resdict['n_members']} for {h_name} from group {group}")
+            if nmembers != len(members):
+                logger.warning(f"There is a different number of histograms ({nmembers}) than original members {len(members)} for {h_name} from group {group}")
                 logger.warning("Summing them up probably leads to wrong behaviour")
 
-            output[h_name] = H5PickleProxy(sum(histograms))
-
-        result_dict[group] = resdict
-        result_dict[group]["output"] = output
+            output[h_name] = H5PickleProxy(hsum)
 
         # delete individual datasets
-        for name in to_del:
+        for name in members:
             del result_dict[name]
 
+        result_dict[group] = resdict
+        result_dict[group]["output"] = output
+
     logger.info(f"Aggregate groups: {time.time() - time0}")
+
+def make_shard_merge_plan(dataset_groups, groups_to_aggregate=[], scale=True):
+    # plan for merge_tools.merge_files to sum the outputs of histmaker shards, including the scaling to data
+    # and the aggregation of groups as done by scale_to_data and aggregate_groups for unsharded outputs
+    from utilities.io_tools import merge_tools
+
+    def plan(files):
+        shards = {}
+        for f in files:
+            for key in f.keys():
+                if not key.startswith("meta_info"):
+                    shards.setdefault(key, []).append(f)
+
+        metadata = {key : merge_tools.merge_metadata([f.results[key] for f in fs]) for key, fs in shards.items()}
+
+        scales = {key : 1 for key in shards.keys()}
+        if scale:
+            lumi = [m["lumi"] for m in metadata.values() if m["dataset"]["is_data"]]
+            lumi = sum(lumi) if len(lumi) else 1
+            logger.warning(f"Scale histograms with luminosity = {lumi} /fb")
+            for key, m in metadata.items():
+                if m["dataset"]["is_data"]:
+                    continue
+                scales[key] = lumi * 1000 * m["dataset"]["xsec"] / m["weight_sum"]
+
+        outputs = {}
+        for key, fs in shards.items():
+            m = metadata[key]
+            name = m["dataset"]["name"]
+            # datasets with out-of-acceptance splitting are renamed in the histmakers
+            group = dataset_groups.get(name, dataset_groups.get(name.replace("OOA", "")))
+            if group not in groups_to_aggregate:
+                # the scale is applied when reading, as for scale_to_data
+                outputs[key] = {"entries" : [(f, key, 1) for f in fs], "metadata" : m}
+                continue
+
+            logger.debug(f"Add {name} to group {group}")
+            if group not in outputs:
+                outputs[group] = {
+                    "entries" : [],
+                    "metadata" : {
+                        "n_members": 0,
+                        "dataset": {
+                            "name": group,
+                            "xsec": 0,
+                            "filepaths": [],
+                        },
+                        "weight_sum": 0.,
+                        "event_count": 0.,
+                    }
+                }
+            resdict = outputs[group]["metadata"]
+            resdict["dataset"]["xsec"] += m["dataset"]["xsec"]
+            resdict["dataset"]["filepaths"] += m["dataset"]["filepaths"]
+            resdict["n_members"] += 1
+            resdict["weight_sum"] += float(m["weight_sum"])*scales[key]
+            resdict["event_count"] += float(m["event_count"])
+            outputs[group]["entries"] += [(f, key, scales[key]) for f in fs]
+
+        return outputs
+
+    return plan
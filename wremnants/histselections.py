@@ -6,6 +6,7 @@ from utilities import common, logging
 import narf
 import ROOT
 from wremnants import plot_tools
+from wremnants import headers
 
 logger = logging.child_logger(__name__)
 
@@ -148,6 +149,7 @@ def unrolledHist(h, obs=None, binwnorm=None, add_flow_bins=False):
         newh.view(flow=False)[...] = np.stack([np.ravel(hproj.values(flow=add_flow_bins))*scale, np.ravel(hproj.variances(flow=add_flow_bins))*scale**2], axis=-1)
     return newh
 
+@headers.requires("histHelpers.h")
 def applyCorrection(h, scale=1.0, offsetCorr=0.0, corrFile=None, corrHist=None, createNew=False):
     # originally intended to apply a correction differential in eta-pt
     # corrHist is a TH3 with eta-pt-charge
@@ -0,0 +1,83 @@
+#ifndef WREMNANTS_COLUMN_PROFILER_H
+#define WREMNANTS_COLUMN_PROFILER_H
+
+#include <algorithm>
+#include <chrono>
+#include <memory>
+#include <mutex>
+#include <vector>
+
+namespace wrem {
+
+// cumulative time and number of calls of profiled column definitions,
+// accumulated per thread without locking and summed when reading them
+class ColumnProfiler {
+public:
+
+  struct Stat {
+    double time = 0.;
+    unsigned long long calls = 0;
+  };
+
+  static ColumnProfiler &instance() {
+    static ColumnProfiler profiler;
+    return profiler;
+  }
+
+  void add(std::size_t id, const std::chrono::steady_clock::time_point &t0) {
+    const double dt = std::chrono::duration<double>(std::chrono::steady_clock::now() - t0).count();
+    std::vector<Stat> &stats = local();
+    if (stats.size() <= id) {
+      stats.resize(id + 1);
+    }
+    stats[id].time += dt;
+    stats[id].calls += 1;
+  }
+
+  std::vector<double> times(std::size_t n) {
+    std::vector<double> res(n, 0.);
+    std::lock_guard<std::mutex> lock(mutex_);
+    for (auto const &stats : threadStats_) {
+      for (std::size_t i = 0; i < std::min(n, stats->size()); ++i) {
+        res[i] += (*stats)[i].time;
+      }
+    }
+    return res;
+  }
+
+  std::vector<unsigned long long> calls(std::size_t n) {
+    std::vector<unsigned long long> res(n, 0);
+    std::lock_guard<std::mutex> lock(mutex_);
+    for (auto const &stats : threadStats_) {
+      for (std::size_t i = 0; i < std::min(n, stats->size()); ++i) {
+        res[i] += (*stats)[i].calls;
+      }
+    }
+    return res;
+  }
+
+private:
+
+  std::vector<Stat> &local() {
+    thread_local std::shared_ptr<std::vector<Stat>> stats = registerThread();
+    return *stats;
+  }
+
+  std::shared_ptr<std::vector<Stat>> registerThread() {
+    auto stats = std::make_shared<std::vector<Stat>>();
+    std::lock_guard<std::mutex> lock(mutex_);
+    threadStats_.push_back(stats);
+    return stats;
+  }
+
+  std::mutex mutex_;
+  std::vector<std::shared_ptr<std::vector<Stat>>> threadStats_;
+};
+
+inline void profile_column(std::size_t id, const std::chrono::steady_clock::time_point &t0) {
+  ColumnProfiler::instance().add(id, t0);
+}
+
+}
+
+#endif
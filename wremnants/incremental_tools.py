@@ -0,0 +1,127 @@
+import glob
+import os
+import subprocess
+import sys
+from utilities import common, logging
+from utilities.hashing import hash_object, hash_file, file_fingerprint
+from utilities.io_tools import output_tools
+
+logger = logging.child_logger(__name__)
+
+# arguments that do not change the content of the results
+ignored_args = ["verbose", "noColorLogger", "nThreads", "outfolder", "postfix", "appendOutputFile", "forceDefaultName",
+    "filterProcs", "excludeProcs", "maxFiles", "dataPath", "oneMCfileEveryN", "memoryBudget", "profileColumns",
+    "skimDir", "skimColumns", "histStorage", "incremental", "aggregateGroups", "eoscp", "balanceWork",
+    "refreshFileLists", "fileListTTL", "theoryCorrCacheDir"]
+
+# arguments that only change the results of the W and Z signal samples
+signal_args = ["pdfs", "altPdfOnlyCentral", "theoryCorr", "theoryCorrAltOnly", "ewTheoryCorr", "skipHelicity", "highptscales"]
+
+def git_state(path):
+    # commit of the git checkout at path and the location, size and modification time of the files changed w.r.t. it,
+    # None if path is not in a git checkout
+    def git(*cmd):
+        return subprocess.run(["git", "-C", path, *cmd], capture_output=True, text=True, check=True).stdout.split()
+    try:
+        commit = git("rev-parse", "HEAD")[0]
+        changed = git("diff", "--name-only", "--relative", "HEAD") + git("ls-files", "--others", "--exclude-standard")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit, [file_fingerprint(os.path.join(path, f)) for f in sorted(changed) if os.path.isfile(os.path.join(path, f))]
+
+def code_fingerprint(script):
+    # content of the histmaker script, of the python modules of the analysis it imported (those used by build_graph
+    # are imported before the fingerprint is made) and of the compiled helpers, plus the state of the correction files
+    base_dir = os.path.realpath(common.base_dir)
+    sources = {os.path.realpath(script)}
+    for module in list(sys.modules.values()):
+        source = getattr(module, "__file__", None)
+        if isinstance(source, str) and source.endswith(".py") and os.path.realpath(source).startswith(base_dir + os.sep):
+            sources.add(os.path.realpath(source))
+    sources = sorted(sources) + sorted(glob.glob(f"{common.wremnants_dir}/include/**/*", recursive=True))
+    # the correction files are identified by the commit of their repository if possible,
+    # otherwise by location, size and modification time of all files
+    corrections = git_state(common.data_dir)
+    if corrections is None:
+        corrections = []
+        for root, dirs, files in os.walk(common.data_dir):
+            dirs.sort()
+            corrections += [file_fingerprint(os.path.join(root, f)) for f in sorted(files)]
+    return hash_object([(os.path.relpath(f, base_dir), hash_file(f)) for f in sources if os.path.isfile(f)], corrections)
+
+class IncrementalOutput(object):
+    """
+    Reuse the results of an existing output file for the datasets whose fingerprint did not change.
+    The fingerprint covers the file list, the relevant arguments, the histmaker script, the python and C++ code
+    of the analysis and the correction files,
+    results of aggregated groups are reused if none of the members changed.
+    """
+    def __init__(self, outfile, args, datasets, groups_to_aggregate=[], scale_to_data=True):
+        self.outfile = output_tools.analysis_output_path(outfile, args)
+        self.fingerprints = self.make_fingerprints(args, datasets, groups_to_aggregate, scale_to_data)
+        self.infile = None
+        self.reused = []
+
+        if not os.path.isfile(self.outfile):
+            logger.info(f"No previous output {self.outfile}, all datasets are processed")
+            return
+
+        from utilities.io_tools import merge_tools
+        self.infile = merge_tools.ResultsFile(self.outfile)
+        for key, (fingerprint, members) in self.fingerprints.items():
+            if key not in self.infile.keys():
+                continue
+            result = self.infile.results[key]
+            if isinstance(result, dict) and result.get("fingerprint") == fingerprint:
+                logger.info(f"Reuse the results of {key} from {self.outfile}")
+                self.reused.append(key)
+
+    def make_fingerprints(self, args, datasets, groups_to_aggregate, scale_to_data):
+        code = code_fingerprint(sys.argv[0])
+        script = os.path.basename(sys.argv[0])
+        all_args = {k : v for k, v in vars(args).items() if k not in ignored_args}
+        background_args = {k : v for k, v in all_args.items() if k not in signal_args}
+
+        per_dataset = {}
+        for dataset in datasets:
+            relevant_args = all_args if dataset.name in common.vprocs_all else background_args
+            per_dataset[dataset.name] = hash_object(script, dataset.name, sorted(dataset.filepaths), relevant_args, code)
+
+        # the scale of the simulation is applied when reading the results, except for aggregated groups
+        # whose members are summed with the scale depending on the luminosity of the data
+        data = hash_object(sorted(per_dataset[d.name] for d in datasets if d.is_data))
+
+        fingerprints = {}
+        for dataset in datasets:
+            fingerprint = per_dataset[dataset.name]
+            aggregated = scale_to_data and dataset.group in groups_to_aggregate
+            if aggregated and not dataset.is_data:
+                fingerprint = hash_object(fingerprint, data)
+            key = dataset.group if aggregated else dataset.name
+            fingerprints.setdefault(key, ([], []))
+            fingerprints[key][0].append(fingerprint)
+            fingerprints[key][1].append(dataset.name)
+
+        return {key : (hash_object(sorted(fps)), members) for key, (fps, members) in fingerprints.items()}
+
+    def datasets_to_run(self, datasets):
+        skipped = [name for key in self.reused for name in self.fingerprints[key][1]]
+        if skipped:
+            logger.info(f"Skip {len(skipped)} unchanged datasets: {', '.join(skipped)}")
+        return [d for d in datasets if d.name not in skipped]
+
+    def add_reused(self, resultdict):
+        # lazily loaded results of the reused datasets, e.g. to get the luminosity for the scaling of the simulation,
+        # they are marked such that they are not scaled again and copied as they are to the output
+        for key in self.reused:
+            resultdict[key] = {**self.infile.results[key], "reused" : True}
+
+    def set_fingerprints(self, resultdict):
+        for key, result in resultdict.items():
+            if key in self.fingerprints and isinstance(result, dict) and not result.get("reused", False):
+                result["fingerprint"] = self.fingerprints[key][0]
+
+    def close(self):
+        if self.infile is not None:
+            self.infile.close()
+            self.infile = None
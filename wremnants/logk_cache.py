@@ -0,0 +1,76 @@
+from utilities import logging
+from utilities.hashing import hash_object, file_fingerprint, UnhashableError
+
+import os
+import pickle
+import tempfile
+import lz4.frame
+
+logger = logging.child_logger(__name__)
+
+# increase when the content of the cache entries or the computation of the logk arrays changes
+logk_cache_version = 3
+
+# entries of the systematic definition in CardTool.systematics that determine the logk arrays
+logk_syst_keys = ["action", "actionArgs", "actionRequiresNomi", "decorrelation", "preOpMap", "preOpArgs", "scale", "symmetrize", "mirror", 
+    "mirrorDownVarEqualToUp", "mirrorDownVarEqualToNomi", "systAxes", "systAxesFlow", "labelsByAxis", "baseName", "skipEntries", 
+    "systNameReplace", "systNamePrepend", "formatWithValue", "name", "cacheKey"]
+# entries holding the functions applied to the histograms, they are replaced by the cacheKey of the systematic if it is given
+logk_syst_functions = ["action", "preOpMap"]
+
+class LogkCache(object):
+    # content addressed on-disk cache for the logk arrays of a (channel, process, systematic)
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(self.path):
+            logger.info(f"Creating logk cache directory {self.path}")
+            os.makedirs(self.path)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, infile, syst, fit_axes, *args):
+        # infile is identified by path, size and modification time, the systematic by the relevant entries of its definition,
+        # functions by their name, code and the values they capture. Returns None if the definition can not be hashed
+        # (e.g. a function capturing an object), the systematic then needs a cacheKey describing what its functions do
+        entries = {k: syst.get(k) for k in logk_syst_keys}
+        if syst.get("cacheKey") is not None:
+            entries.update({k: None for k in logk_syst_functions})
+        try:
+            return hash_object(logk_cache_version, file_fingerprint(infile), entries, list(fit_axes), *args)
+        except UnhashableError as e:
+            logger.warning(f"The logk of systematic {syst.get('name')} are not cached, it needs a cacheKey: {e}")
+            return None
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.pkl.lz4")
+
+    def get(self, key):
+        filename = self.filename(key)
+        if not os.path.isfile(filename):
+            self.misses += 1
+            return None
+        try:
+            with lz4.frame.open(filename, "rb") as f:
+                value = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, RuntimeError) as e:
+            logger.warning(f"Failed to read logk cache entry {filename} ({e}), it will be recomputed")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write to a temporary file first such that concurrent readers never see partial entries
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+        try:
+            with lz4.frame.open(os.fdopen(fd, "wb"), "wb") as f:
+                pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, filename)
+        except Exception:
+            os.remove(tmpname)
+            raise
+
+    def summary(self):
+        return f"Logk cache {self.path}: {self.hits} hits, {self.misses} misses"
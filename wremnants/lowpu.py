@@ -1,13 +1,9 @@
 
-import narf
+from wremnants import headers
 
 # load lowPU specific libs
 #ROOT.gInterpreter.AddIncludePath(f"{pathlib.Path(__file__).parent}/include/")
-narf.clingutils.Declare('#include "lowpu_utils.h"')
-narf.clingutils.Declare('#include "lowpu_efficiencies.h"')
-narf.clingutils.Declare('#include "lowpu_prefire.h"')
-narf.clingutils.Declare('#include "lowpu_rochester.h"')
-narf.clingutils.Declare('#include "electron_selections.h"')
+headers.register("lowpu_utils.h", "lowpu_efficiencies.h", "lowpu_prefire.h", "lowpu_rochester.h", "electron_selections.h")
 
 
 def lepSF_systs(df, results, sName, sVars, defineExpr, baseName, baseAxes, baseCols):
@@ -5,6 +5,7 @@ import narf
 from utilities import rdf_tools
 from utilities import common, logging
 from utilities import boostHistHelpers as hh
+from wremnants import headers
 import uproot
 import numpy as np
 import warnings
@@ -16,8 +17,7 @@ import pickle
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "muon_calibration.h"')
-narf.clingutils.Declare('#include "lowpu_utils.h"')
+headers.register("muon_calibration.h", "lowpu_utils.h")
 
 data_dir = common.data_dir
 
@@ -9,11 +9,11 @@ import pickle
 import lz4.frame
 
 from utilities import common
-
-narf.clingutils.Declare('#include "muon_efficiencies_binned.h"')
+from wremnants import headers
 
 data_dir = common.data_dir
 
+@headers.requires("muon_efficiencies_binned.h")
 def make_muon_efficiency_helpers_binned(filename = data_dir + "/muonSF/allSmooth_GtoH.root",
                                         era = None, is_w_like = False, max_pt = np.inf,
                                         usePseudoSmoothing=False):
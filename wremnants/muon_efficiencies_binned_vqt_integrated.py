@@ -9,12 +9,11 @@ import pickle
 import lz4.frame
 
 from utilities import common
-
-narf.clingutils.Declare('#include "muon_efficiencies_binned.h"')
-narf.clingutils.Declare('#include "muon_efficiencies_binned_vqt_integrated.h"')
+from wremnants import headers
 
 data_dir = common.data_dir
 
+@headers.requires("muon_efficiencies_binned.h", "muon_efficiencies_binned_vqt_integrated.h")
 def make_muon_efficiency_helpers_binned_vqt_integrated(filename = data_dir + "/muonSF/allSmooth_GtoH.root", filenamevqt = data_dir + "/muonSF/allSmooth_GtoH.root", filenamevqttriggerplus = "/gpfs/ddn/cms/user/bruschin/newfit3/egm_tnp_analysis/plots/triggerefficiencies17012023/efficiencies_GtoH/mu_trigger_plus/allEfficiencies_2D.root", filenamevqttriggerminus = "/gpfs/ddn/cms/user/bruschin/newfit3/egm_tnp_analysis/plots/triggerefficiencies17012023/efficiencies_GtoH/mu_trigger_minus/allEfficiencies_2D.root",
                                                        era = None, is_w_like = False, max_pt = np.inf,
                                                        usePseudoSmoothing=False,
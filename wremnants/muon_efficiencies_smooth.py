@@ -13,10 +13,9 @@ import os.path
 from utilities import boostHistHelpers as hh
 from utilities import common, logging
 from utilities.io_tools import input_tools
+from wremnants import headers
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "muon_efficiencies_smooth.h"')
-
 data_dir = common.data_dir
 
 def cloneAxis(ax, overflow=False, underflow=False, newName=None):
@@ -30,9 +29,10 @@ def cloneAxis(ax, overflow=False, underflow=False, newName=None):
         quit()
     return newax
 
+@headers.requires("muon_efficiencies_smooth.h")
 def make_muon_efficiency_helpers_smooth(filename = data_dir + "/muonSF/allSmooth_GtoHout_vtxAgnIso.root",
                                         era = None,
-                                        what_analysis = ROOT.wrem.AnalysisType.Wmass,
+                                        what_analysis = None,
                                         max_pt = np.inf,
                                         isoEfficiencySmoothing = False,
                                         smooth3D=False,
@@ -40,6 +40,10 @@ def make_muon_efficiency_helpers_smooth(filename = data_dir + "/muonSF/allSmooth
     
     logger.debug(f"Make efficiency helper smooth")
 
+    # default (Wmass) resolved here, the enum is only available once the headers are declared
+    if what_analysis is None:
+        what_analysis = ROOT.wrem.AnalysisType.Wmass
+
     # need the following hack to call the helpers with this enum class from python
     if what_analysis == ROOT.wrem.AnalysisType.Wmass:
         templateAnalysisArg = "wrem::AnalysisType::Wmass"
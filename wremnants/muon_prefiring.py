@@ -1,13 +1,12 @@
 import ROOT
 import pathlib
 import hist
-import narf.clingutils
 from utilities import common
-
-narf.clingutils.Declare('#include "muon_prefiring.h"')
+from wremnants import headers
 
 data_dir = common.data_dir
 
+@headers.requires("muon_prefiring.h")
 def make_muon_prefiring_helpers(filename = data_dir + "/muonSF/L1MuonPrefiringParametriations_histograms.root", era = None):
 
     fin = ROOT.TFile.Open(filename);
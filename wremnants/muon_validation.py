@@ -7,8 +7,9 @@ from functools import reduce
 from utilities import common, logging
 from utilities import boostHistHelpers as hh
 from wremnants.muon_calibration import get_jpsi_scale_param_cov_mat
+from wremnants import headers
 
-narf.clingutils.Declare('#include "muon_validation.h"')
+headers.register("muon_validation.h")
 
 logger = logging.child_logger(__name__)
 
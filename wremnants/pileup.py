@@ -1,15 +1,13 @@
 import ROOT
 import pathlib
 import hist
-import narf
 import numpy as np
 import boost_histogram as bh
 from utilities import common, logging
+from wremnants import headers
 
 logger = logging.child_logger(__name__)
 
-narf.clingutils.Declare('#include "pileup.h"')
-
 data_dir = common.data_dir
 
 eradict = { "2016B" : "B",
@@ -40,6 +38,7 @@ fileDict = {
     }
 }
 
+@headers.requires("pileup.h")
 def make_pileup_helper(era = None, cropHighWeight = 5.,
                        filename_data = None,
                        filename_mc = None):
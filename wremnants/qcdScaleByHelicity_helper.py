@@ -4,6 +4,7 @@ import pickle
 import lz4.frame
 from .correctionsTensor_helper import makeCorrectionsTensor
 from utilities import common, logging
+from wremnants import headers
 import numpy as np
 
 logger = logging.child_logger(__name__)
@@ -14,6 +15,7 @@ logger = logging.child_logger(__name__)
 # the input files for this, and the corresponding gen axis definitions
 # are produced from wremnants/scripts/histmakers/w_z_gen_dists.py
 
+@headers.requires("theory_corrections.h")
 def makeQCDScaleByHelicityHelper(is_w_like = False, filename=None):
     if filename is None:
         #
@@ -10,12 +10,12 @@ import os
 import array
 from utilities import common as common
 from utilities.io_tools import input_tools
+from wremnants import headers
 
 import tensorflow as tf
 
 
-ROOT.gInterpreter.Declare('#include "recoil_tools.h"')
-ROOT.gInterpreter.Declare('#include "recoil_helper.h"')
+headers.register("recoil_tools.h", "recoil_helper.h")
 logger = logging.getLogger("wremnants").getChild(__name__.split(".")[-1])
 
 
@@ -0,0 +1,107 @@
+import json
+import os
+import re
+from utilities import logging
+from utilities.hashing import hash_object
+
+logger = logging.child_logger(__name__)
+
+# bump to invalidate existing skims when the content of the snapshots changes
+skim_version = 1
+
+# arguments that change the trigger and muon selection (including the corrected muon kinematics)
+selection_args = ["era", "pt", "trackerMuons", "isolationDefinition", "noTrigger", "makeMCefficiency", "halfStat",
+    "muonCorrData", "muonCorrMC", "muonCorrMag", "biasCalibration", "smearing"]
+
+# input branches kept in the skims (regular expressions), covering what the histmakers read after the selection
+default_columns = [
+    "run", "luminosityBlock", "event", "genWeight", "fixedGridRho.*",
+    "n?Muon(_.*)?", "n?TrigObj(_.*)?", "HLT_.*Mu.*", "Flag_.*", "PV_.*", "Pileup_.*", "L1PreFiringWeight_.*",
+    "n?Jet(_.*)?", "n?Electron(_.*)?", "n?Photon(_.*)?",
+    "MET_.*", "RawMET_.*", "PuppiMET_.*", "RawPuppiMET_.*", "DeepMETResolutionTune_.*", "GenMET_.*",
+    "n?GenPart(_.*)?", "n?GenDressedLepton(_.*)?", "GenVtx_.*", "Generator_.*",
+    "n?LHE.*", "n?MEParamWeight.*", "n?PSWeight",
+]
+
+class Skimmer(object):
+    """
+    Snapshot of the events passing the trigger and muon selection, keyed by the selection arguments and the input files.
+    Datasets with an existing skim are read from it, the others are skimmed lazily in the same event loop.
+    The sum of weights, number of events and luminosity of the unskimmed inputs are stored next to each skim.
+    """
+    def __init__(self, skimDir, selection, columns=None):
+        self.skimDir = skimDir
+        self.selection = selection
+        self.columns = [re.compile(c) for c in (columns if columns else default_columns)]
+        self.skimmed = {} # dataset name -> metadata of the skim that is read
+        self.snapshots = {} # dataset name -> (key, temporary file, lazy snapshot result)
+        self.keys = {}
+
+    def key(self, dataset):
+        return hash_object(skim_version, dataset.name, sorted(dataset.filepaths), self.selection)
+
+    def path(self, dataset, key):
+        return os.path.join(self.skimDir, f"{dataset.name}_{key[:16]}.root")
+
+    def use_skims(self, datasets):
+        # point the datasets with an existing skim to the skimmed file
+        for dataset in datasets:
+            key = self.key(dataset)
+            self.keys[dataset.name] = key
+            path = self.path(dataset, key)
+            if not (os.path.isfile(path) and os.path.isfile(f"{path}.json")):
+                continue
+            with open(f"{path}.json") as f:
+                meta = json.load(f)
+            if meta.get("key") != key:
+                continue
+            logger.info(f"Read skim {path} for dataset {dataset.name}")
+            self.skimmed[dataset.name] = meta
+            dataset.filepaths = [path]
+        return datasets
+
+    def snapshot(self, df, dataset):
+        # to be called in build_graph after the selection, books the skim of datasets that are not skimmed yet
+        import ROOT
+        if dataset.name in self.skimmed or dataset.name not in self.keys:
+            return df
+        key = self.keys[dataset.name]
+        defined = set(str(c) for c in df.GetDefinedColumnNames())
+        columns = [str(c) for c in df.GetColumnNames() if str(c) not in defined and any(p.fullmatch(str(c)) for p in self.columns)]
+
+        os.makedirs(self.skimDir, exist_ok=True)
+        tmpfile = f"{self.path(dataset, key)}.tmp{os.getpid()}"
+        logger.info(f"Book skim of dataset {dataset.name} with {len(columns)} columns into {tmpfile}")
+        opts = ROOT.RDF.RSnapshotOptions()
+        opts.fLazy = True
+        snapshot = df.Snapshot("Events", tmpfile, ROOT.std.vector["std::string"](columns), opts)
+        self.snapshots[dataset.name] = (key, tmpfile, snapshot)
+        return df
+
+    def finalize(self, resultdict):
+        # after the event loop: restore the normalization of skimmed datasets and move newly written skims in place
+        for name, meta in self.skimmed.items():
+            if name not in resultdict:
+                continue
+            for k in ["weight_sum", "event_count", "lumi"]:
+                if k in meta and k in resultdict[name]:
+                    resultdict[name][k] = meta[k]
+
+        for name, (key, tmpfile, snapshot) in self.snapshots.items():
+            if name not in resultdict:
+                continue
+            result = resultdict[name]
+            path = tmpfile[:tmpfile.rindex(".tmp")]
+            meta = {"key" : key, "selection" : self.selection, "filepaths" : result["dataset"].get("filepaths"),
+                **{k : float(result[k]) for k in ["weight_sum", "event_count", "lumi"] if k in result}}
+            os.replace(tmpfile, path)
+            with open(f"{path}.json", "w") as f:
+                json.dump(meta, f, indent=2)
+            logger.info(f"Skim of dataset {name} written to {path}")
+        self.snapshots = {}
+
+def make_skimmer(args, extra_selection_args=[]):
+    if not getattr(args, "skimDir", None):
+        return None
+    selection = {k : getattr(args, k) for k in [*selection_args, *extra_selection_args] if hasattr(args, k)}
+    return Skimmer(args.skimDir, selection, args.skimColumns)
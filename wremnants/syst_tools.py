@@ -229,20 +229,8 @@ def scale_helicity_hist_to_variations(scale_hist, sum_axes=[], pt_ax="ptVgen", g
 
     return scale_variation_hist
 
-def decorrelateByAxis(hvar, hnom, axisToDecorrName, decorrEdges, newDecorrAxisName=None):
-
-    commonMessage = f"Requested to decorrelate uncertainty in histogram {hvar.name} by {axisToDecorrName} axis"
-    if axisToDecorrName not in hnom.axes.name:
-        raise ValueError(f"{commonMessage}, but available axes for nominal histogram are {hnom.axes.name}")
-    
-    # for convenience, broadcast the nominal into the same shape as hvar
-    # hvar may often have the same dimension as hnom, but sometimes it might have been mirrored and thus have at least the mirror axis
-    hnomAsVar = hh.broadcastSystHist(hnom, hvar)
-
-    ax = hnomAsVar.axes[axisToDecorrName]
-    axisToDecorrIndex = list(hnomAsVar.axes).index(ax)
-    logger.debug(f"Decorrelating versus axis {axisToDecorrName} with index {axisToDecorrIndex}")
-
+def decorrelation_bins(ax, decorrEdges, commonMessage=""):
+    # returns the edges of the decorrelation bins and the ranges [low, high) of the bins of the axis ax they contain
     if len(decorrEdges):
         if len(decorrEdges) < 3:
             raise ValueError(f"{commonMessage}, but less than 3 edges (thus 2 bins) were specified.")
@@ -252,7 +240,7 @@ def decorrelateByAxis(hvar, hnom, axisToDecorrName, decorrEdges, newDecorrAxisNa
             if all(not np.isclose(edge, j, atol=0.0001) for j in ax.edges):
                 badEdges.append(edge)
         if len(badEdges):
-            raise ValueError(f"Inconsistent edges specified to decorrelate uncertainty versus axis {axisToDecorrName}\n"
+            raise ValueError(f"Inconsistent edges specified to decorrelate uncertainty versus axis {ax.name}\n"
                              f"Original axis edges: {ax.edges}\n"
                              f"Decorrelation edges: {decorrEdges}\n"
                              f"Inconsistent edges:  {badEdges}")
@@ -260,16 +248,42 @@ def decorrelateByAxis(hvar, hnom, axisToDecorrName, decorrEdges, newDecorrAxisNa
         # empty array automatically uses all edges of the chosen axis
         decorrEdges = [x for x in ax.edges]
 
-    # add new axis to the broadcasted nominal (then we will copy the syst in the relevant bins)
-    axis_decorr_name = newDecorrAxisName if newDecorrAxisName != None else f"{axisToDecorrName}_decorr"
-    axis_decorr = hist.axis.Variable(decorrEdges, underflow=False, overflow=False, name=axis_decorr_name)
-    hvarnew = hh.addGenericAxis(hnomAsVar, axis_decorr)
-
+    ranges = []
     for isyst in range(len(decorrEdges)-1):
         indexLow = ax.index(decorrEdges[isyst] + 0.001) # add epsilon to ensure picking the bin on the right of the edge (note that the second bin index is excluded from the slice selection below)
         # for the upper edge add an additional protection for the very last edge in case the axis doesn't have the overflow bin, since the edge lookup might be undefined in that case
         # since the upper edge is no longer associated to the following bin, which would be the overflow bin, but to the inner bin (adding epsilon seems to work nonetheless, but it is probably by chance)
         indexHigh = ax.index(decorrEdges[isyst+1] + 0.001) if decorrEdges[isyst+1] < ax.edges[-1] else ax.size # it seems hist.overflow doesn't work inside slice()
+        ranges.append((indexLow, indexHigh))
+    return decorrEdges, ranges
+
+def decorrelation_axis(ax, decorrEdges, newDecorrAxisName=None, commonMessage=None):
+    # new axis of the decorrelated variations, and the ranges of bins of the axis ax for each of its bins
+    if commonMessage is None:
+        commonMessage = f"Requested to decorrelate uncertainty by {ax.name} axis"
+    decorrEdges, ranges = decorrelation_bins(ax, decorrEdges, commonMessage)
+    axis_decorr_name = newDecorrAxisName if newDecorrAxisName != None else f"{ax.name}_decorr"
+    return hist.axis.Variable(decorrEdges, underflow=False, overflow=False, name=axis_decorr_name), ranges
+
+def decorrelateByAxis(hvar, hnom, axisToDecorrName, decorrEdges, newDecorrAxisName=None):
+
+    commonMessage = f"Requested to decorrelate uncertainty in histogram {hvar.name} by {axisToDecorrName} axis"
+    if axisToDecorrName not in hnom.axes.name:
+        raise ValueError(f"{commonMessage}, but available axes for nominal histogram are {hnom.axes.name}")
+    
+    # for convenience, broadcast the nominal into the same shape as hvar
+    # hvar may often have the same dimension as hnom, but sometimes it might have been mirrored and thus have at least the mirror axis
+    hnomAsVar = hh.broadcastSystHist(hnom, hvar)
+
+    ax = hnomAsVar.axes[axisToDecorrName]
+    axisToDecorrIndex = list(hnomAsVar.axes).index(ax)
+    logger.debug(f"Decorrelating versus axis {axisToDecorrName} with index {axisToDecorrIndex}")
+
+    # add new axis to the broadcasted nominal (then we will copy the syst in the relevant bins)
+    axis_decorr, ranges = decorrelation_axis(ax, decorrEdges, newDecorrAxisName, commonMessage)
+    hvarnew = hh.addGenericAxis(hnomAsVar, axis_decorr)
+
+    for isyst, (indexLow, indexHigh) in enumerate(ranges):
         slices = [slice(None) if n != axisToDecorrIndex else slice(indexLow,indexHigh) for n in range(len(hnomAsVar.axes.name))]
         hvarnew.values(flow=False)[*slices, isyst] = hvar.values(flow=False)[*slices] # use values instead of view, because hvar has storage=Double(), while hnom (and hence hvarnew) has storage=Weight
 
@@ -529,8 +543,11 @@ def add_scaledByCondition_unc_hists(results, df, args, axes, cols, newWeightName
     results.append(scaledHist)
     return df
 
-def add_muon_efficiency_unc_hists(results, df, helper_stat, helper_syst, axes, cols, base_name="nominal", what_analysis=ROOT.wrem.AnalysisType.Wmass, smooth3D=False, addhelicity=False):
+def add_muon_efficiency_unc_hists(results, df, helper_stat, helper_syst, axes, cols, base_name="nominal", what_analysis=None, smooth3D=False, addhelicity=False):
     # TODO: update for dilepton
+    # the default (Wmass) is resolved here, such that the headers are not needed at import time
+    if what_analysis is None:
+        what_analysis = ROOT.wrem.AnalysisType.Wmass
     if what_analysis == ROOT.wrem.AnalysisType.Wmass:
         muon_columns_stat = ["goodMuons_pt0", "goodMuons_eta0",
                              "goodMuons_uT0", "goodMuons_charge0"]
@@ -6,48 +6,123 @@ import narf
 import numpy as np
 import lz4.frame
 import pickle
-import re
-import glob
 import h5py
+import collections.abc
 from .correctionsTensor_helper import makeCorrectionsTensor
 from utilities import boostHistHelpers as hh, common, logging
+from utilities.hashing import hash_object, hash_file, file_fingerprint
 from utilities.io_tools import input_tools
 from wremnants import theory_tools
+from wremnants import headers
 
 logger = logging.child_logger(__name__)
 
-def valid_theory_corrections():
-    corr_files = glob.glob(common.data_dir+"TheoryCorrections/*Corr*.pkl.lz4")
-    matches = [re.match("(^.*)Corr[W|Z]\.pkl\.lz4", os.path.basename(c)) for c in corr_files]
-    return [m[1] for m in matches if m]+["none"]
+# kept here for compatibility, defined in common such that the parser does not need to import this module
+valid_theory_corrections = common.valid_theory_corrections
+valid_ew_theory_corrections = common.valid_ew_theory_corrections
 
-def valid_ew_theory_corrections():
-    corr_files = glob.glob(common.data_dir+"TheoryCorrections/*ew*Corr*.pkl.lz4")
-    matches = [re.match("(^.*)Corr[W|Z]\.pkl\.lz4", os.path.basename(c)) for c in corr_files]
-    return [m[1] for m in matches if m]+["none"]
+# post-processed correction histograms, stored as .npy arrays of the values with the pickled axes
+corr_cache_dir = common.theory_corr_cache_dir
+# bump to invalidate the cached histograms
+corr_cache_version = 1
 
-def load_corr_helpers(procs, generators, make_tensor=True, base_dir=f"{common.data_dir}/TheoryCorrections/"):
-    corr_helpers = {}
-    for proc in procs:
-        corr_helpers[proc] = {}
+source_hashes = {}
+
+def source_hash(filename):
+    # content hash of the correction file, computed once per job and file version
+    fingerprint = file_fingerprint(filename)
+    if fingerprint not in source_hashes:
+        source_hashes[fingerprint] = hash_file(filename)
+    return source_hashes[fingerprint]
+
+def load_postprocessed_corr_hist(filename, proc, histname, cache_dir=corr_cache_dir):
+    # load_corr_hist followed by postprocess_corr_hist, cached in cache_dir (no caching if None)
+    if not cache_dir:
+        return postprocess_corr_hist(load_corr_hist(filename, proc, histname))
+
+    key = hash_object(corr_cache_version, source_hash(filename), proc, histname, postprocess_corr_hist, theory_tools.variation_shifts)
+    path = os.path.join(cache_dir, f"{os.path.basename(filename).replace('.pkl.lz4', '')}_{proc}_{key[:16]}")
+    if os.path.isfile(f"{path}.pkl") and os.path.isfile(f"{path}.npy"):
+        try:
+            with open(f"{path}.pkl", "rb") as f:
+                meta = pickle.load(f)
+            if meta["key"] == key:
+                corrh = hist.Hist(*meta["axes"], storage=meta["storage"])
+                # the helpers copy the values into their own tensors, the array is read normally
+                corrh.view(flow=True)[...] = np.load(f"{path}.npy")
+                logger.debug(f"Read cached correction histogram {path}")
+                return corrh
+        except Exception as e:
+            logger.warning(f"Could not read cached correction histogram {path}: {e}")
+
+    corrh = postprocess_corr_hist(load_corr_hist(filename, proc, histname))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # the data is written first, the metadata marks the entry as complete
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(f"{tmp}.npy", "wb") as f:
+            np.save(f, np.asarray(corrh.view(flow=True)))
+        os.replace(f"{tmp}.npy", f"{path}.npy")
+        with open(f"{tmp}.pkl", "wb") as f:
+            pickle.dump({"key" : key, "source" : filename, "axes" : list(corrh.axes), "storage" : corrh._storage_type()}, f)
+        os.replace(f"{tmp}.pkl", f"{path}.pkl")
+        logger.debug(f"Cached correction histogram in {path}")
+    except OSError as e:
+        logger.warning(f"Could not cache correction histogram in {cache_dir}: {e}")
+    return corrh
+
+class CorrectionHelpers(collections.abc.Mapping):
+    # theory correction helpers (or histograms) per process and generator,
+    # they are only made when a process is accessed, i.e. for the datasets that are actually processed
+    def __init__(self, procs, generators, make_tensor=True, base_dir=f"{common.data_dir}/TheoryCorrections/", cache_dir=corr_cache_dir):
+        self.generators = generators
+        self.make_tensor = make_tensor
+        self.base_dir = base_dir
+        self.cache_dir = cache_dir
+        self.files = {}
+        for proc in procs:
+            self.files[proc] = {}
+            for generator in generators:
+                fname = f"{base_dir}/{generator}Corr{proc[0]}.pkl.lz4"
+                if not os.path.isfile(fname):
+                    logger.warning(f"Did not find correction file for process {proc}, generator {generator}. No correction will be applied for this process!")
+                    continue
+                self.files[proc][generator] = fname
         for generator in generators:
-            fname = f"{base_dir}/{generator}Corr{proc[0]}.pkl.lz4"
-            if not os.path.isfile(fname):
-                logger.warning(f"Did not find correction file for process {proc}, generator {generator}. No correction will be applied for this process!")
-                continue
+            if not any([generator in self.files[proc] for proc in procs]):
+                logger.warning(f"Did not find correction for generator {generator} for any processes!")
+        self.helpers = {}
+
+    def make_helpers(self, proc):
+        helpers = {}
+        for generator, fname in self.files[proc].items():
             logger.debug(f"Make theory correction helper for file: {fname}")
-            corrh = load_corr_hist(fname, proc[0], get_corr_name(generator))
-            corrh = postprocess_corr_hist(corrh)
-            if not make_tensor:
-                corr_helpers[proc][generator] = corrh
+            corrh = load_postprocessed_corr_hist(fname, proc[0], get_corr_name(generator), self.cache_dir)
+            if not self.make_tensor:
+                helpers[generator] = corrh
             elif "Helicity" in generator:
-                corr_helpers[proc][generator] = makeCorrectionsTensor(corrh, ROOT.wrem.CentralCorrByHelicityHelper, tensor_rank=3)
+                headers.declare("theory_corrections.h")
+                helpers[generator] = makeCorrectionsTensor(corrh, ROOT.wrem.CentralCorrByHelicityHelper, tensor_rank=3)
             else:
-                corr_helpers[proc][generator] = makeCorrectionsTensor(corrh, weighted_corr=generator in theory_tools.theory_corr_weight_map)
-    for generator in generators:
-        if not any([generator in corr_helpers[proc] for proc in procs]):
-            logger.warning(f"Did not find correction for generator {generator} for any processes!")
-    return corr_helpers
+                helpers[generator] = makeCorrectionsTensor(corrh, weighted_corr=generator in theory_tools.theory_corr_weight_map)
+        return helpers
+
+    def __getitem__(self, proc):
+        if proc not in self.helpers:
+            self.helpers[proc] = self.make_helpers(proc)
+        return self.helpers[proc]
+
+    def __contains__(self, proc):
+        return proc in self.files
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+def load_corr_helpers(procs, generators, make_tensor=True, base_dir=f"{common.data_dir}/TheoryCorrections/", cache_dir=corr_cache_dir):
+    return CorrectionHelpers(procs, generators, make_tensor, base_dir, cache_dir)
 
 def make_corr_helper_fromnp(filename=f"{common.data_dir}/N3LLCorrections/inclusive_{{process}}_pT.npz", isW=True):
     if isW:
@@ -86,39 +161,13 @@ def load_corr_hist(filename, proc, histname):
         corrh = corr[proc][histname]
     return corrh
 
-def compute_envelope(h, name, entries, axis_name="vars", slice_axis = None, slice_val = None):
-
-    axis_idx = h.axes.name.index(axis_name)
-    hvars = h[{axis_name : entries}]
-
-    hvar_min = h[{axis_name : entries[0]}].copy()
-    hvar_max = h[{axis_name : entries[0]}].copy()
-
-    hvar_min.values()[...] = np.min(hvars.values(), axis=axis_idx)
-    hvar_max.values()[...] = np.max(hvars.values(), axis=axis_idx)
-
-    if slice_axis is not None:
-        s = hist.tag.Slicer()
-
-        hnom = h[{axis_name : entries[0]}]
-        slice_idx = h.axes[slice_axis].index(slice_val)
-
-        hvar_min[{slice_axis : s[:slice_idx]}] = hnom[{slice_axis : s[:slice_idx]}].view()
-        hvar_max[{slice_axis : s[:slice_idx]}] = hnom[{slice_axis : s[:slice_idx]}].view()
-
-    res = {}
-    res[f"{name}_Down"] = hvar_min
-    res[f"{name}_Up"] = hvar_max
-
-    return res
-
 def postprocess_corr_hist(corrh):
     # extend variations with some envelopes and special kinematic slices
 
     if "vars" not in corrh.axes.name:
         return corrh
 
-    additional_var_hists = {}
+    envelopes = {}
 
     renorm_scale_vars = ["pdf0", "kappaFO0.5-kappaf2.", "kappaFO2.-kappaf0.5"]
 
@@ -138,46 +187,59 @@ def postprocess_corr_hist(corrh):
     renorm_fact_resum_transition_scale_vars = renorm_fact_resum_scale_vars + transition_vars_exclusive
 
     if all(var in corrh.axes["vars"] for var in renorm_scale_vars):
-        additional_var_hists.update(compute_envelope(corrh, "renorm_scale_envelope", renorm_scale_vars))
+        envelopes["renorm_scale_envelope"] = {"type" : "envelope", "entries" : renorm_scale_vars}
 
         # same thing but restricted to qT>20GeV to capture only the fixed order part of the variation and
         # neglect the part at low pt which should be redundant with the TNPs
-        additional_var_hists.update(compute_envelope(corrh, "renorm_scale_pt20_envelope", renorm_scale_vars, slice_axis="qT", slice_val=20.))
+        envelopes["renorm_scale_pt20_envelope"] = {"type" : "envelope", "entries" : renorm_scale_vars, "slice_axis" : "qT", "slice_val" : 20.}
 
     if all(var in corrh.axes["vars"] for var in renorm_fact_scale_vars):
-        additional_var_hists.update(compute_envelope(corrh, "renorm_fact_scale_envelope", renorm_fact_scale_vars))
+        envelopes["renorm_fact_scale_envelope"] = {"type" : "envelope", "entries" : renorm_fact_scale_vars}
 
         # same thing but restricted to qT>20GeV to capture only the fixed order part of the variation and
         # neglect the part at low pt which should be redundant with the TNPs
-        additional_var_hists.update(compute_envelope(corrh, "renorm_fact_scale_pt20_envelope", renorm_fact_scale_vars, slice_axis="qT", slice_val=20.))
+        envelopes["renorm_fact_scale_pt20_envelope"] = {"type" : "envelope", "entries" : renorm_fact_scale_vars, "slice_axis" : "qT", "slice_val" : 20.}
 
     if all(var in corrh.axes["vars"] for var in renorm_fact_resum_scale_vars):
-        additional_var_hists.update(compute_envelope(corrh, "renorm_fact_resum_scale_envelope", renorm_fact_resum_scale_vars))
+        envelopes["renorm_fact_resum_scale_envelope"] = {"type" : "envelope", "entries" : renorm_fact_resum_scale_vars}
     if all(var in corrh.axes["vars"] for var in renorm_fact_resum_transition_scale_vars):
-        additional_var_hists.update(compute_envelope(corrh, "renorm_fact_resum_transition_scale_envelope", renorm_fact_resum_transition_scale_vars))
+        envelopes["renorm_fact_resum_transition_scale_envelope"] = {"type" : "envelope", "entries" : renorm_fact_resum_transition_scale_vars}
     if all(var in corrh.axes["vars"] for var in resum_scale_vars):
-        additional_var_hists.update(compute_envelope(corrh, "resum_scale_envelope", resum_scale_vars))
+        envelopes["resum_scale_envelope"] = {"type" : "envelope", "entries" : resum_scale_vars}
 
 
-    if not additional_var_hists:
+    if not envelopes:
         return corrh
 
-    vars_out = list(corrh.axes["vars"]) + list(additional_var_hists.keys())
+    # all envelopes in one pass, written directly into the values of the extended vars axis
+    shifts = theory_tools.variation_shifts(corrh, "vars", envelopes)
+    vars_in = list(corrh.axes["vars"])
+    vars_out = vars_in + [f"{name}_{d}" for name in envelopes.keys() for d in ["Down", "Up"]]
 
     vars_out_axis = hist.axis.StrCategory(vars_out, name="vars")
     corrh_tmp = hist.Hist(*corrh.axes[:-1], vars_out_axis, storage = corrh._storage_type())
 
-    for i, var in enumerate(vars_out_axis):
-        if var in corrh.axes["vars"]:
-            corrh_tmp[{"vars" : i}] = corrh[{"vars" : var}].view(flow=True)
-        else:
-            corrh_tmp[{"vars" : i}] = additional_var_hists[var].view(flow=True)
+    nvars = len(vars_in)
+    out_vals = corrh_tmp.values(flow=True)
+    out_vals[..., :nvars] = corrh.values(flow=True)[..., :nvars]
+    for i, (down, up) in enumerate(shifts.values()):
+        out_vals[..., nvars+2*i] = down
+        out_vals[..., nvars+2*i+1] = up
+
+    if corrh_tmp.storage_type == hist.storage.Weight:
+        # the variances of the envelopes are those of their nominal entry
+        in_vars = corrh.variances(flow=True)
+        out_vars = corrh_tmp.variances(flow=True)
+        out_vars[..., :nvars] = in_vars[..., :nvars]
+        for i, request in enumerate(envelopes.values()):
+            nominal = corrh.axes["vars"].index(request["entries"][0])
+            out_vars[..., nvars+2*i] = in_vars[..., nominal]
+            out_vars[..., nvars+2*i+1] = in_vars[..., nominal]
 
     corrh = corrh_tmp
 
     return corrh
 
-
 def get_corr_name(generator):
     # Hack for now
     label = generator.replace("1D", "")
@@ -262,6 +324,7 @@ def make_corr_by_helicity(ref_helicity_hist, target_sigmaul, target_sigma4, coef
     corr_coeffs = set_corr_ratio_flow(corr_coeffs)
     return corr_coeffs
 
+@headers.requires("theory_corrections.h")
 def make_qcd_uncertainty_helper_by_helicity(is_w_like = False, filename=None):
     if filename is None:
         filename = f"{common.data_dir}/angularCoefficients/w_z_moments.hdf5"
@@ -319,6 +382,7 @@ def make_qcd_uncertainty_helper_by_helicity(is_w_like = False, filename=None):
 
     return helper
 
+@headers.requires("theory_corrections.h")
 def make_helicity_test_corrector(is_w_like = False, filename = None):
 
     # load moments from file
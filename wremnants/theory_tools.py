@@ -5,12 +5,12 @@ import copy
 from math import pi
 from utilities import boostHistHelpers as hh,common,logging
 from wremnants import theory_corrections
+from wremnants import headers
 from scipy import ndimage
-import narf.clingutils
 from math import sqrt
 
 logger = logging.child_logger(__name__)
-narf.clingutils.Declare('#include "theoryTools.h"')
+headers.register("theoryTools.h")
 
 # this puts the bin centers at 0.5, 1.0, 2.0
 axis_muRfact = hist.axis.Variable(
@@ -736,51 +736,29 @@ def pdfNamesAsymHessian(entries, pdfset=""):
 def pdfNamesSymHessian(entries, pdfset=""):
     return [f"pdf{i+1}{pdfset.replace('pdf', '')}" for i in range(entries)]
 
-def pdfSymmetricShifts(hdiff, axis_name):
-    sq = hh.multiplyHists(hdiff, hdiff)
-    ss = sq[{axis_name : hist.sum}]
-    rss = hh.sqrtHist(ss)
-    return rss, rss
-
-def pdfAsymmetricShifts(hdiff, axis_name):
-    # Assuming that the last axis is the syst axis
-    # TODO: add some check to verify this
-    def shiftHist(vals, hdiff, axis_name):
-        hnew = hdiff[{axis_name : 0}]
-        vals = vals*vals
-        hnew[...] = np.sum(vals, axis=-1)
-        return hh.sqrtHist(hnew)
-
-    ax = hdiff.axes[axis_name] 
-    underflow = hdiff.axes[axis_name].traits.underflow
-    overflow = hdiff.axes[axis_name].traits.overflow
-    if type(ax) == hist.axis.StrCategory and all(["Up" in x or "Down" in x for x in ax][1:]):
-        # Remove the overflow from the categorical axis
-        end = int((ax.size-1)/2)
-        upvals = hdiff[{axis_name : [x for x in ax if "Up" in x]}].values(flow=True)[...,:end]
-        downvals = hdiff[{axis_name : [x for x in ax if "Down" in x]}].values(flow=True)[...,:end]
-        if upvals.shape != downvals.shape:
-            raise ValueError("Malformed PDF uncertainty hist! Expect equal number of up and down vars")
-    else:
-        end = ax.size+underflow
-        upvals = hdiff.values(flow=True)[...,1+underflow:end:2]
-        downvals = hdiff.values(flow=True)[...,2+underflow:end:2]
-
-    # The error sets are ordered up,down,up,down...
-    upshift = shiftHist(upvals, hdiff, axis_name)
-    downshift = shiftHist(downvals, hdiff, axis_name)
-    return upshift, downshift 
+# kept here for compatibility, defined with the histogram helpers such that they can be used without ROOT
+variation_positions = hh.variation_positions
+variation_shifts = hh.variation_shifts
+
+def variation_hists(h, axis_name, requests):
+    # histograms of the results of variation_shifts, the variances (if any) are those of the nominal entry
+    templates = {}
+    res = {}
+    for name, (down, up) in variation_shifts(h, axis_name, requests).items():
+        entries = requests[name].get("entries") if requests[name]["type"] == "envelope" else None
+        nominal = entries[0] if entries else 0
+        if nominal not in templates:
+            templates[nominal] = h[{axis_name : nominal}]
+        hists = []
+        for vals in (down, up):
+            hnew = templates[nominal].copy()
+            hnew.values(flow=True)[...] = vals
+            hists.append(hnew)
+        res[name] = tuple(hists)
+    return res
 
 def hessianPdfUnc(h, axis_name="pdfVar", uncType="symHessian", scale=1.):
-    underflow = h.axes[axis_name].traits.underflow
-    symmetric = uncType == "symHessian"
-    diff = hh.addHists(h, -1*h[{axis_name : 0}])*scale
-    if diff.axes[axis_name].traits.overflow:
-        diff[...,hist.overflow] = np.zeros_like(diff[{axis_name : 0}].view(flow=True))
-    shiftFunc = pdfSymmetricShifts if symmetric else pdfAsymmetricShifts
-    rssUp, rssDown = shiftFunc(diff, axis_name)
-    hUp = hh.addHists(h[{axis_name : 0}], 1*rssUp)
-    hDown = hh.addHists(h[{axis_name : 0}], -1*rssDown)
+    hDown, hUp = variation_hists(h, axis_name, {"pdf" : {"type" : uncType, "scale" : scale}})["pdf"]
     return hUp, hDown
 
 def pdfBugfixMSHT20(df , tensorPDFName):
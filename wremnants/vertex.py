@@ -1,18 +1,17 @@
 import ROOT
 import pathlib
 import hist
-import narf
 import numpy as np
 import boost_histogram as bh
 from utilities import common
 from utilities import common, logging
-
-narf.clingutils.Declare('#include "vertex.h"')
+from wremnants import headers
 
 logger = logging.child_logger(__name__)
 
 data_dir = common.data_dir
 
+@headers.requires("vertex.h")
 def make_vertex_helper(era = None, filename = None):
 
     eradict = { "2016PreVFP" :  "BtoF",